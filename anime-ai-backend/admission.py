@@ -0,0 +1,182 @@
+# admission.py
+# /chat 的准入控制：按客户端的令牌桶限流 + 全局并发上限 (有界等待队列) + 降级判断 + 小型 TTL 缓存
+# 过载时尽快给出 429 或更便宜的回复，而不是让请求在上游 LLM 前无限排队直到超时
+import os
+import time
+import math
+import threading
+from collections import OrderedDict
+
+# 每个客户端的持续速率 (请求/秒) 与突发容量。
+# 默认值只挡住明显的刷接口：正常连发几条 (含重试、流式续传) 不会被拦；
+# RATE_LIMIT_RPS=0 关闭限流 (如压测或已在网关层限流时)
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "2"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+# 在反向代理后部署时按 X-Forwarded-For 区分客户端
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"
+
+# 同时执行 RAG 流程的请求上限，以及允许排队等待的请求数与最长等待时间
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "8"))
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "16"))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "10"))
+# 在途请求数达到上限的这个比例 (或已有请求在排队) 时进入降级模式
+CHAT_DEGRADE_RATIO = float(os.getenv("CHAT_DEGRADE_RATIO", "0.75"))
+
+# 路由结果与回答的缓存
+ROUTER_CACHE_SIZE = int(os.getenv("ROUTER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "600"))
+
+
+class Overloaded(Exception):
+    """请求被拒绝，retry_after 为建议的重试间隔 (秒)"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """
+    按 key (客户端) 维护令牌桶，线程安全。
+    桶的数量有上限，最久未活跃的客户端先被淘汰 (淘汰后等同于满桶，不会误伤)。
+    """
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def acquire(self, key):
+        """取一个令牌；没有令牌时抛出 Overloaded"""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self.rejected += 1
+                raise Overloaded("rate_limited", math.ceil((1 - tokens) / self.rate))
+
+            self._buckets[key] = (tokens - 1, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+
+    def metrics(self):
+        with self._lock:
+            return {"clients": len(self._buckets), "rejected": self.rejected,
+                    "config": {"rps": self.rate, "burst": self.burst}}
+
+
+class ConcurrencyLimiter:
+    """
+    全局并发上限 + 有界等待队列。
+    - 在途请求未满：直接放行
+    - 已满但排队人数未满：最多等待 timeout 秒
+    - 队列已满或等待超时：抛出 Overloaded
+    """
+
+    def __init__(self, max_active, max_queue, timeout, degrade_ratio):
+        self.max_active = max(1, max_active)
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self.degrade_at = max(1, math.ceil(self.max_active * degrade_ratio))
+        self._cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self._stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+
+    def acquire(self):
+        with self._cond:
+            if self.active >= self.max_active:
+                if self.waiting >= self.max_queue:
+                    self._stats["rejected_queue_full"] += 1
+                    raise Overloaded("queue_full", max(1, math.ceil(self.timeout / 2)))
+
+                self._stats["queued"] += 1
+                self.waiting += 1
+                deadline = time.monotonic() + self.timeout
+                try:
+                    while self.active >= self.max_active:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats["rejected_timeout"] += 1
+                            raise Overloaded("queue_timeout", max(1, math.ceil(self.timeout / 2)))
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.active += 1
+            self._stats["admitted"] += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def under_pressure(self, holding=False):
+        """
+        是否应当降级：其他在途请求接近上限，或者已经有人在排队。
+        holding=True 表示调用方自己已占用一个名额，不把它算进去
+        (否则 CHAT_MAX_CONCURRENCY=1 时每个请求都会被自己触发降级)。
+        """
+        others = self.active - 1 if holding else self.active
+        return others >= self.degrade_at or self.waiting > 0
+
+    def metrics(self):
+        with self._cond:
+            return {"active": self.active, "waiting": self.waiting, **self._stats,
+                    "config": {"max_active": self.max_active, "max_queue": self.max_queue,
+                               "queue_timeout_s": self.timeout, "degrade_at": self.degrade_at}}
+
+
+class TTLCache:
+    """线程安全的 LRU 缓存，ttl=None 表示不过期"""
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (self.ttl is None or time.monotonic() - item[1] < self.ttl):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def metrics(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+def client_key(request):
+    """限流用的客户端标识"""
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
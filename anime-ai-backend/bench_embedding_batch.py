@@ -0,0 +1,64 @@
+# bench_embedding_batch.py
+# 对比逐条 embed_query 与微批处理在不同并发下的吞吐与延迟 (纯 CPU，不需要数据库和 API)
+#
+#   python bench_embedding_batch.py
+#   python bench_embedding_batch.py --concurrency 1,8,32 --duration 10 --max-wait-ms 2
+import time
+import argparse
+import threading
+
+from embedding_batcher import MicroBatchEmbeddings
+from sample_queries import QUERIES
+from vector_backend import EMBEDDING_MODEL_NAME, load_embeddings
+
+
+def run(embeddings, concurrency, duration):
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def loop(seed):
+        i = seed
+        while time.time() < deadline:
+            start = time.perf_counter()
+            embeddings.embed_query(QUERIES[i % len(QUERIES)])
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+            i += 1
+
+    threads = [threading.Thread(target=loop, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    return {
+        "qps": len(latencies) / duration,
+        "p50": latencies[len(latencies) // 2] * 1000,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1000,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="查询向量微批处理基准")
+    parser.add_argument("--concurrency", default="1,4,16,32")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=3)
+    args = parser.parse_args()
+
+    print(f"🔄 正在加载模型: {EMBEDDING_MODEL_NAME}")
+    base = load_embeddings()
+    batched = MicroBatchEmbeddings(base, args.max_batch_size, args.max_wait_ms)
+    base.embed_query("预热")
+
+    print(f"\n{'并发':>4}{'逐条 qps':>12}{'p50':>9}{'p95':>9}{'微批 qps':>12}{'p50':>9}{'p95':>9}")
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        plain = run(base, concurrency, args.duration)
+        micro = run(batched, concurrency, args.duration)
+        print(f"{concurrency:>4}{plain['qps']:>12.1f}{plain['p50']:>9.1f}{plain['p95']:>9.1f}"
+              f"{micro['qps']:>12.1f}{micro['p50']:>9.1f}{micro['p95']:>9.1f}")
+
+    print(f"\n📊 微批统计: {batched.metrics()}")
@@ -0,0 +1,147 @@
+# bench_workers.py
+# 对比 "进程内检索" 与 "sidecar 检索" 两种部署方式在 1/4/8 个 worker 下的内存与吞吐。
+# 只压 /retrieve (纯检索，不调用 LLM)，不消耗 API 额度。
+#
+#   python bench_workers.py                      # 默认: 两种模式 x 1/4/8 worker，每组压 20 秒
+#   python bench_workers.py --workers 1,4 --duration 10 --modes sidecar
+import os
+import sys
+import time
+import argparse
+import statistics
+import threading
+
+import httpx
+
+from process_utils import rss_mb, start, stop, wait_ready
+from sample_queries import QUERIES
+
+API_PORT = 8100
+SIDECAR_PORT = 8101
+
+def read_cmdline(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", 'rb') as f:
+            return f.read().replace(b"\0", b" ").decode(errors="ignore")
+    except OSError:
+        return ""
+
+
+def child_pids(pid):
+    """直接子进程 (扫描 /proc，仅 Linux)"""
+    children = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", encoding="utf-8") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        if ppid == pid:
+            children.append(int(name))
+    return children
+
+
+def worker_rss(master_pid, workers):
+    """uvicorn 单进程时 master 就是 worker；多 worker 时统计各子进程 (排除 multiprocessing 辅助进程)"""
+    if workers == 1:
+        return [rss_mb(master_pid)]
+    pids = [p for p in child_pids(master_pid) if "resource_tracker" not in read_cmdline(p)]
+    return [rss_mb(p) for p in pids]
+
+
+def run_load(base_url, concurrency, duration):
+    """concurrency 个线程在 duration 秒内循环请求 /retrieve，返回 (延迟列表, 错误数)"""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def loop(seed):
+        i = seed
+        with httpx.Client(base_url=base_url, timeout=30) as client:
+            while time.time() < deadline:
+                start_time = time.perf_counter()
+                try:
+                    res = client.post("/retrieve", json={"query": QUERIES[i % len(QUERIES)], "k": 6})
+                    ok = res.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                elapsed = time.perf_counter() - start_time
+                with lock:
+                    (latencies if ok else errors).append(elapsed)
+                i += 1
+
+    threads = [threading.Thread(target=loop, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, len(errors)
+
+
+def bench(mode, workers, concurrency, duration):
+    env = dict(os.environ)
+    env.setdefault("DEEPSEEK_API_KEY", "bench-placeholder")
+    env["VECTOR_BACKEND"] = "sidecar" if mode == "sidecar" else "local"
+    env["VECTOR_SERVICE_URL"] = f"http://127.0.0.1:{SIDECAR_PORT}"
+    # /retrieve 默认不挂载；压测线程都来自本机，关掉按客户端限流，并发上限放宽到压测并发数
+    env["RETRIEVE_ENDPOINT"] = "1"
+    env.setdefault("RATE_LIMIT_RPS", "0")
+    env.setdefault("CHAT_MAX_CONCURRENCY", str(max(concurrency, 8)))
+
+    sidecar = api = None
+    try:
+        if mode == "sidecar":
+            sidecar = start([sys.executable, "vector_service.py", "--port", str(SIDECAR_PORT)], env)
+            if not wait_ready(f"http://127.0.0.1:{SIDECAR_PORT}/health"):
+                raise RuntimeError("sidecar 启动超时")
+
+        api = start([sys.executable, "-m", "uvicorn", "main:app", "--port", str(API_PORT),
+                     "--workers", str(workers)], env)
+        base_url = f"http://127.0.0.1:{API_PORT}"
+        if not wait_ready(f"{base_url}/health"):
+            raise RuntimeError("API 启动超时")
+
+        # 预热：确保每个 worker 都已完成初始化
+        run_load(base_url, workers, 2)
+        latencies, errors = run_load(base_url, concurrency, duration)
+
+        rss = worker_rss(api.pid, workers)
+        sidecar_rss = rss_mb(sidecar.pid) if sidecar else 0.0
+        latencies.sort()
+        return {
+            "mode": mode,
+            "workers": workers,
+            "rss_per_worker": statistics.mean(rss) if rss else 0.0,
+            "rss_total": sum(rss) + sidecar_rss,
+            "sidecar_rss": sidecar_rss,
+            "rps": len(latencies) / duration,
+            "p50": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+            "p95": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0,
+            "errors": errors,
+        }
+    finally:
+        stop(api)
+        stop(sidecar)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="进程内 vs sidecar 检索的多 worker 基准")
+    parser.add_argument("--modes", default="local,sidecar")
+    parser.add_argument("--workers", default="1,4,8")
+    parser.add_argument("--concurrency", type=int, default=16, help="压测并发线程数")
+    parser.add_argument("--duration", type=float, default=20, help="每组压测秒数")
+    args = parser.parse_args()
+
+    rows = []
+    for mode in args.modes.split(","):
+        for workers in [int(w) for w in args.workers.split(",")]:
+            print(f"⏱️  {mode} x {workers} worker ...")
+            rows.append(bench(mode, workers, args.concurrency, args.duration))
+
+    print(f"\n{'模式':<8}{'worker':>7}{'RSS/worker(MB)':>16}{'sidecar(MB)':>13}{'总RSS(MB)':>11}"
+          f"{'req/s':>9}{'p50(ms)':>9}{'p95(ms)':>9}{'错误':>6}")
+    for r in rows:
+        print(f"{r['mode']:<8}{r['workers']:>7}{r['rss_per_worker']:>16.0f}{r['sidecar_rss']:>13.0f}"
+              f"{r['rss_total']:>11.0f}{r['rps']:>9.1f}{r['p50']:>9.1f}{r['p95']:>9.1f}{r['errors']:>6}")
@@ -1,11 +1,17 @@
 import os
+import sys
 import glob
-import shutil
-from langchain_community.document_loaders import TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import json
+import argparse
 from langchain_community.vectorstores import Chroma
 
+from story_chunker import chunk_story_file
+from file_hash import file_sha256
+from character import CHARACTERS, DEFAULT_CHARACTER, get_character
+from story_index import build_manifest_path, canonical_file_id, file_metadata, load_index_map
+from vector_backend import EMBEDDING_MODEL_NAME, describe_embeddings, load_embeddings
+from vector_bundle import write_bundle
+
 # ================= 配置区 =================
 # 获取当前脚本所在目录 (即 anime-ai-backend)
 CURRENT_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -19,8 +25,28 @@ DATA_SOURCE_DIR = os.path.join(PROJECT_ROOT, "data_source")
 # 数据库依然存在当前脚本目录下即可
 DB_PERSIST_DIR = os.path.join(CURRENT_SCRIPT_DIR, "chroma_db")
 INDEX_MAP_FILE = os.path.join(DB_PERSIST_DIR, "index_map.txt")
+# 记录每个文件的内容哈希与 file_idx，供增量构建使用
+BUILD_MANIFEST_FILE = build_manifest_path(INDEX_MAP_FILE)
+
+COLLECTION_NAME = "aya_memory_v3"
+
+# 世界观字典与二进制向量包 (--export-bundle)
+GLOSSARY_FILE = os.path.join(DATA_SOURCE_DIR, "00_glossary.txt")
+BUNDLE_FILE = os.path.join(DB_PERSIST_DIR, f"{COLLECTION_NAME}.bundle")
 
-EMBEDDING_MODEL_NAME = "shibing624/text2vec-base-chinese"
+
+def use_character(key):
+    """切换到某个角色的数据目录 / collection / 路由索引 (见 character.py 注册表)"""
+    global DATA_SOURCE_DIR, DB_PERSIST_DIR, INDEX_MAP_FILE, BUILD_MANIFEST_FILE, COLLECTION_NAME
+    global GLOSSARY_FILE, BUNDLE_FILE
+    character = get_character(key)
+    DATA_SOURCE_DIR = character.data_source_dir
+    DB_PERSIST_DIR = character.persist_dir
+    INDEX_MAP_FILE = character.index_map_path
+    BUILD_MANIFEST_FILE = build_manifest_path(INDEX_MAP_FILE)
+    COLLECTION_NAME = character.collection_name
+    GLOSSARY_FILE = character.glossary_path
+    BUNDLE_FILE = character.bundle_path
 
 
 # =========================================
@@ -59,88 +85,289 @@ def extract_file_summary(file_path):
             else:
                 summary += "剧情档案"
 
-    except Exception as e:
+    except Exception:
         summary += "未知档案"
 
     return summary
 
 
-def process_memory_file(file_path):
-    # ... (保持原本的切分逻辑不变，为了节省篇幅省略) ...
-    # 这里直接复制你之前确认过的 process_memory_file 函数内容
+def process_memory_file(file_path, file_index):
+    """按头部标签与【章节】结构切分，片段之间不再重叠"""
     filename = os.path.basename(file_path)
     try:
-        loader = TextLoader(file_path, encoding='utf-8')
-        raw_docs = loader.load()
+        with open(file_path, 'r', encoding='utf-8') as f:
+            text = f.read()
     except Exception:
         return []
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=600, chunk_overlap=150,
-        separators=["\n\n", "\n", "【", "。", "！", "？"]
-    )
-    docs = text_splitter.split_documents(raw_docs)
+    return chunk_story_file(filename, text, file_index)
 
-    final_docs = []
-    for doc in docs:
-        content = doc.page_content.strip()
-        if not content: continue
-        doc.page_content = f"【记忆来源：{filename}】\n{content}"
-        doc.metadata = {"source": filename, "category": "aya_memory"}
-        final_docs.append(doc)
-    return final_docs
+
+def scan_source_files():
+    """返回 {file_id: 文件路径}，按规范 ID 排序"""
+    txt_files = glob.glob(os.path.join(DATA_SOURCE_DIR, "*.txt"))
+    paths = {canonical_file_id(os.path.basename(p)): p for p in txt_files}
+    return dict(sorted(paths.items()))
+
+
+def save_build_state(paths, file_index, hashes):
+    """
+    按 file_idx 顺序写出路由索引表，并保存构建清单 (file_idx 以清单为准)。
+    """
+    ordered = sorted(file_index, key=file_index.get)
+    with open(INDEX_MAP_FILE, 'w', encoding='utf-8') as f:
+        f.write("\n".join(extract_file_summary(paths[i]) for i in ordered))
+    print(f"📍 路由索引表已生成: {INDEX_MAP_FILE}")
+
+    manifest = {"files": {i: {"idx": file_index[i], "hash": hashes[i]} for i in ordered}}
+    with open(BUILD_MANIFEST_FILE, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
 
 
 def build_database():
-    # 1. 清理旧数据
+    # 1. 清理旧数据 (只删除本角色的 collection，同目录下其他角色的数据保持不动)
     if os.path.exists(DB_PERSIST_DIR):
-        print(f"🗑️  正在清理旧数据库: {DB_PERSIST_DIR}")
-        shutil.rmtree(DB_PERSIST_DIR)
+        import chromadb
+        client = chromadb.PersistentClient(path=DB_PERSIST_DIR)
+        if COLLECTION_NAME in [c if isinstance(c, str) else c.name for c in client.list_collections()]:
+            print(f"🗑️  正在清理旧数据: {DB_PERSIST_DIR} / {COLLECTION_NAME}")
+            client.delete_collection(COLLECTION_NAME)
 
-    # 必须重新创建目录以存放 index_map.txt
+    # 必须确保目录存在以存放 index_map.txt
     os.makedirs(DB_PERSIST_DIR, exist_ok=True)
 
     print(f"📂 开始扫描记忆库: {DATA_SOURCE_DIR} ...")
-    txt_files = glob.glob(os.path.join(DATA_SOURCE_DIR, "*.txt"))
+    paths = scan_source_files()
 
-    if not txt_files:
+    if not paths:
         print("❌ 目录为空")
         return
 
+    # 按规范 ID 排序，行号即 file_idx，与 index_map.txt 的顺序保持一致
+    file_index = {file_id: i for i, file_id in enumerate(paths)}
+    hashes = {}
     all_docs = []
-    index_lines = []  # 📍 用于存储路由表内容
 
     # 2. 遍历处理
-    for txt_file in txt_files:
-        filename = os.path.basename(txt_file)
-
-        # A. 生成索引条目
-        summary_line = extract_file_summary(txt_file)
-        index_lines.append(summary_line)
-
-        # B. 生成向量数据
-        docs = process_memory_file(txt_file)
+    for file_id, txt_file in paths.items():
+        hashes[file_id] = file_sha256(txt_file)
+        docs = process_memory_file(txt_file, file_index)
         if docs:
             all_docs.extend(docs)
-            print(f"   📖 处理: {filename} -> {len(docs)} 片段 | 索引: {summary_line}")
+            print(f"   📖 处理: {os.path.basename(txt_file)} -> {len(docs)} 片段")
 
-    # 3. 保存路由索引表到 chroma_db 文件夹
-    with open(INDEX_MAP_FILE, 'w', encoding='utf-8') as f:
-        f.write("\n".join(sorted(index_lines)))
-    print(f"📍 路由索引表已生成: {INDEX_MAP_FILE}")
+    # 3. 保存路由索引表与构建清单到 chroma_db 文件夹
+    save_build_state(paths, file_index, hashes)
 
     # 4. 向量化存库
     print(f"\n🚀 正在向量化 {len(all_docs)} 条数据...")
-    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+    print(f"🧠 Embedding 模型: {describe_embeddings()}")
+    embeddings = load_embeddings()
     Chroma.from_documents(
         documents=all_docs,
         embedding=embeddings,
         persist_directory=DB_PERSIST_DIR,
-        collection_name="aya_memory_v3"
+        collection_name=COLLECTION_NAME
     )
 
     print(f"✅ 构建完成！数据与索引均已保存至 {DB_PERSIST_DIR}")
 
 
+def update_database():
+    """
+    增量构建：只重新向量化内容有变化的文件，删除已不存在的文件。
+    已有文件保持原来的 file_idx，新文件追加在末尾。
+    """
+    if not os.path.exists(BUILD_MANIFEST_FILE):
+        print("⚠️ 未找到构建清单，执行全量构建")
+        return build_database()
+
+    with open(BUILD_MANIFEST_FILE, 'r', encoding='utf-8') as f:
+        previous = json.load(f)["files"]
+
+    paths = scan_source_files()
+    hashes = {file_id: file_sha256(p) for file_id, p in paths.items()}
+
+    file_index = {i: previous[i]["idx"] for i in paths if i in previous}
+    next_idx = max(file_index.values(), default=-1) + 1
+    for file_id in paths:
+        if file_id not in file_index:
+            file_index[file_id] = next_idx
+            next_idx += 1
+
+    changed = [i for i in paths if previous.get(i, {}).get("hash") != hashes[i]]
+    removed = [i for i in previous if i not in paths]
+
+    if not changed and not removed:
+        print("✅ 记忆库没有变化，无需更新")
+        return
+
+    print(f"🔄 增量更新: {len(changed)} 个文件有变化，{len(removed)} 个文件被删除")
+    print(f"🧠 Embedding 模型: {describe_embeddings()}")
+    embeddings = load_embeddings()
+    vector_db = Chroma(
+        persist_directory=DB_PERSIST_DIR,
+        embedding_function=embeddings,
+        collection_name=COLLECTION_NAME
+    )
+
+    for file_id in changed + removed:
+        if file_id in previous:
+            vector_db._collection.delete(where={"file_id": file_id})
+
+    new_docs = []
+    for file_id in changed:
+        docs = process_memory_file(paths[file_id], file_index)
+        new_docs.extend(docs)
+        print(f"   📖 处理: {os.path.basename(paths[file_id])} -> {len(docs)} 片段")
+
+    if new_docs:
+        print(f"\n🚀 正在向量化 {len(new_docs)} 条数据...")
+        vector_db.add_documents(new_docs)
+
+    save_build_state(paths, file_index, hashes)
+    print("✅ 增量更新完成！")
+
+
+def open_collection():
+    """直接打开已有的 Chroma collection (校验/迁移不需要加载 Embedding 模型)"""
+    import chromadb
+    client = chromadb.PersistentClient(path=DB_PERSIST_DIR)
+    return client.get_collection(COLLECTION_NAME)
+
+
+def validate_database(collection=None):
+    """
+    检查已有 chroma_db 的 metadata 是否符合规范：
+    每个片段都带 file_id / file_idx，且与 index_map.txt 一一对应。
+    返回问题列表，空列表表示通过。
+    """
+    _, file_index = load_index_map(INDEX_MAP_FILE)
+    if not file_index:
+        return [f"未找到或无法解析路由索引: {INDEX_MAP_FILE}"]
+
+    collection = collection or open_collection()
+    records = collection.get(include=["metadatas"])
+
+    problems = []
+    seen = set()
+    for doc_id, meta in zip(records["ids"], records["metadatas"]):
+        meta = meta or {}
+        file_id = meta.get("file_id")
+        if file_id is None:
+            problems.append(f"{doc_id}: 缺少 file_id (source={meta.get('source')})")
+            continue
+        if file_id not in file_index:
+            problems.append(f"{doc_id}: file_id={file_id} 不在 index_map.txt 中")
+            continue
+        if meta.get("file_idx") != file_index[file_id]:
+            problems.append(f"{doc_id}: file_idx={meta.get('file_idx')} 与索引表不一致 (应为 {file_index[file_id]})")
+        if meta.get("source") != f"{file_id}.txt":
+            problems.append(f"{doc_id}: source={meta.get('source')} 不是规范文件名")
+        seen.add(file_id)
+
+    for file_id in file_index:
+        if file_id not in seen:
+            problems.append(f"{file_id}: 索引表中存在，但数据库里没有任何片段")
+
+    return problems
+
+
+def migrate_database(batch_size=500):
+    """
+    原地迁移旧库：根据 source 推导 file_id / file_idx 并规范化 source，
+    不需要重新向量化。
+    """
+    _, file_index = load_index_map(INDEX_MAP_FILE)
+    if not file_index:
+        print(f"❌ 未找到或无法解析路由索引: {INDEX_MAP_FILE}")
+        return 0
+
+    collection = open_collection()
+    records = collection.get(include=["metadatas"])
+
+    ids, metadatas = [], []
+    for doc_id, meta in zip(records["ids"], records["metadatas"]):
+        meta = dict(meta or {})
+        file_id = canonical_file_id(meta.get("file_id") or meta.get("source", ""))
+        if file_id not in file_index:
+            print(f"   ⚠️ 跳过无法识别的片段: {doc_id} (source={meta.get('source')})")
+            continue
+        new_meta = {**meta, **file_metadata(file_id, file_index)}
+        if new_meta != meta:
+            ids.append(doc_id)
+            metadatas.append(new_meta)
+
+    for start in range(0, len(ids), batch_size):
+        collection.update(ids=ids[start:start + batch_size], metadatas=metadatas[start:start + batch_size])
+
+    print(f"🔧 已迁移 {len(ids)}/{len(records['ids'])} 条片段的 metadata")
+    return len(ids)
+
+
+def export_bundle(dtype="float16"):
+    """
+    把已有 collection 连同路由索引、世界观字典导出为一个二进制向量包，
+    供 VECTOR_BACKEND=bundle 的服务端 mmap 加载 (不需要加载 Embedding 模型)。
+    """
+    index_text, file_index = load_index_map(INDEX_MAP_FILE)
+    if not index_text:
+        print(f"❌ 未找到路由索引: {INDEX_MAP_FILE}，请先构建数据库")
+        return None
+
+    glossary_text = ""
+    if os.path.exists(GLOSSARY_FILE):
+        with open(GLOSSARY_FILE, 'r', encoding='utf-8') as f:
+            glossary_text = f.read()
+
+    records = open_collection().get(include=["embeddings", "documents", "metadatas"])
+    print(f"📦 正在导出 {len(records['ids'])} 条片段 ({dtype}) -> {BUNDLE_FILE}")
+    header = write_bundle(
+        BUNDLE_FILE,
+        records["embeddings"],
+        records["documents"],
+        records["metadatas"],
+        file_index,
+        index_map_text=index_text,
+        glossary_text=glossary_text,
+        collection_name=COLLECTION_NAME,
+        embedding_model=EMBEDDING_MODEL_NAME,
+        dtype=dtype,
+    )
+    size = os.path.getsize(BUNDLE_FILE) / 1024 / 1024
+    print(f"✅ 导出完成: {header['count']} 条 x {header['dim']} 维, {len(header['files'])} 个文件, {size:.1f} MB")
+    return header
+
+
 if __name__ == "__main__":
-    build_database()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="构建 / 校验 / 迁移丸山彩的记忆库")
+    parser.add_argument("--validate", action="store_true", help="只校验已有 chroma_db 的 metadata")
+    parser.add_argument("--migrate", action="store_true", help="把旧库的 metadata 迁移为规范格式后再校验")
+    parser.add_argument("--incremental", action="store_true", help="只重建内容有变化的文件")
+    parser.add_argument("--export-bundle", action="store_true",
+                        help="(构建完成后) 把数据库导出为 mmap 加载的二进制向量包")
+    parser.add_argument("--bundle-dtype", default="float16", choices=["float16", "float32"],
+                        help="向量包中向量矩阵的精度")
+    parser.add_argument("--character", default=DEFAULT_CHARACTER, choices=sorted(CHARACTERS),
+                        help="要构建的角色 (决定数据目录与 collection)")
+    args = parser.parse_args()
+    use_character(args.character)
+
+    if args.migrate:
+        migrate_database()
+
+    if args.migrate or args.validate:
+        issues = validate_database()
+        for issue in issues[:50]:
+            print(f"   ❌ {issue}")
+        if issues:
+            print(f"❌ 校验未通过，共 {len(issues)} 个问题")
+            sys.exit(1)
+        print("✅ 校验通过：所有片段均带有规范的 file_id / file_idx")
+    elif args.incremental:
+        update_database()
+    elif not args.export_bundle:
+        build_database()
+
+    if args.export_bundle:
+        export_bundle(args.bundle_dtype)
\ No newline at end of file
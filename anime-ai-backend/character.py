@@ -1,4 +1,13 @@
 # character.py
+import os
+from dataclasses import dataclass
+from typing import List, Optional
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BASE_DIR)
+DEFAULT_DB_DIR = os.path.join(BASE_DIR, "chroma_db")
+DEFAULT_DATA_SOURCE_DIR = os.path.join(PROJECT_ROOT, "data_source")
+DEFAULT_GLOSSARY_PATH = os.path.join(DEFAULT_DATA_SOURCE_DIR, "00_glossary.txt")
 
 # 角色设定：你可以随意修改这里的设定
 CHARACTER_NAME = "丸山彩 (Maruyama Aya)"
@@ -38,4 +47,73 @@ SYSTEM_PROMPT = f"""
 """
 
 def get_character_prompt():
-    return {"role": "system", "content": SYSTEM_PROMPT}
\ No newline at end of file
+    return {"role": "system", "content": SYSTEM_PROMPT}
+
+
+# ==================== 角色注册表 ====================
+@dataclass
+class Character:
+    """
+    一个可对话的角色。
+    所有角色共用同一个 Embedding 模型；collection_name 决定向量库命名空间，
+    file_ids 可以进一步把检索限制在 collection 内的部分文件上 (None 表示不限制)。
+    """
+    key: str
+    name: str
+    short_name: str
+    band: str
+    system_prompt: str
+    speech_style: str
+    fallback_reply: str
+    error_reply: str
+    collection_name: str
+    data_source_dir: str = DEFAULT_DATA_SOURCE_DIR
+    persist_dir: str = DEFAULT_DB_DIR
+    glossary_path: str = DEFAULT_GLOSSARY_PATH
+    index_map_path: Optional[str] = None
+    bundle_path: Optional[str] = None
+    file_ids: Optional[List[str]] = None
+    # 服务过载、请求被拒绝 (429) 时返回给前端的台词
+    busy_reply: str = "现在找我聊天的人有点多，请稍等一下再来吧~"
+
+    def __post_init__(self):
+        # 多个 collection 共用一个 chroma_db 目录时，各自的路由索引不能互相覆盖
+        if self.index_map_path is None:
+            self.index_map_path = os.path.join(self.persist_dir, f"{self.collection_name}_index_map.txt")
+        # build_vector_db.py --export-bundle 的输出 (VECTOR_BACKEND=bundle 时使用)
+        if self.bundle_path is None:
+            self.bundle_path = os.path.join(self.persist_dir, f"{self.collection_name}.bundle")
+
+    def prompt(self):
+        return {"role": "system", "content": self.system_prompt}
+
+
+CHARACTERS = {}
+DEFAULT_CHARACTER = "aya"
+
+
+def register_character(character):
+    CHARACTERS[character.key] = character
+    return character
+
+
+def get_character(key=None):
+    """按 key 取角色，未注册时抛出 KeyError"""
+    return CHARACTERS[key or DEFAULT_CHARACTER]
+
+
+register_character(Character(
+    key="aya",
+    name=CHARACTER_NAME,
+    short_name="丸山彩",
+    band="Pastel*Palettes",
+    system_prompt=SYSTEM_PROMPT,
+    speech_style="""- 基于片段内容，用丸山彩软萌、努力的口吻回答。
+    - 多使用颜文字 (✨, 💦, ( > < ))。
+    - 第一人称是“彩”或“我”。""",
+    fallback_reply="那个……彩有点记不太清了( > < ) 或者是彩还没经历过这件事？\n如果可以的话，能告诉我更多细节吗？💦",
+    error_reply="呜呜...脑子突然一片空白...彩、彩是不是又搞砸了？( > < )",
+    busy_reply="呜哇，一下子来了好多粉丝，彩有点忙不过来了💦 稍等一下下再和彩说话好吗？( > < )",
+    collection_name="aya_memory_v3",
+    index_map_path=os.path.join(DEFAULT_DB_DIR, "index_map.txt"),
+))
\ No newline at end of file
@@ -0,0 +1,199 @@
+# chat_stream.py
+# 客户端离开后及时停止后端流程 + 可续传的流式回复 (SSE)
+#
+# 一个请求在执行期间绑定一个"取消令牌"，流程在每次调用上游 LLM 之前 (以及流式生成的每一段之间)
+# 调用 checkpoint()，令牌表示客户端已经不要这个结果时抛出 RequestCancelled，后续的 LLM 调用不再发出、
+# 正在进行的流式生成立即关闭上游连接，把并发名额和 API 额度留给还在等待的用户。
+#   - /chat：DisconnectWatcher，客户端断开 TCP 连接即视为取消
+#   - /chat/stream：ChatStream，流程在后台线程里执行，事件带递增 id 缓存在内存中；
+#     连接意外断开后客户端可在 STREAM_RESUME_GRACE 秒内带 Last-Event-ID 重连，从断点继续接收；
+#     超过宽限期无人重连，或客户端显式取消 (DELETE)，才视为取消
+# 注意：续传依赖进程内存，多 worker 部署时需要按 stream_id 做会话保持
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import anyio
+
+from admission import TTLCache
+
+# 连接断开后等待客户端重连的时间，超过后取消生成
+STREAM_RESUME_GRACE = float(os.getenv("STREAM_RESUME_GRACE", "10"))
+# 流 (含已完成的) 在内存中保留的时间与数量，期间可以续传
+STREAM_RETENTION = float(os.getenv("STREAM_RETENTION", "300"))
+STREAM_REGISTRY_SIZE = int(os.getenv("STREAM_REGISTRY_SIZE", "1024"))
+# SSE 推送的轮询间隔，以及无新事件时发送心跳注释的间隔 (防止代理断开空闲连接)
+STREAM_POLL_INTERVAL = 0.05
+STREAM_HEARTBEAT = 15.0
+# /chat 检查客户端是否断开的最小间隔 (每次检查都要切回事件循环)
+DISCONNECT_CHECK_INTERVAL = 0.25
+
+
+class RequestCancelled(Exception):
+    """客户端已经不需要这个请求的结果"""
+
+
+_current_watch = contextvars.ContextVar("cancel_watch", default=None)
+
+
+@contextmanager
+def watch(token):
+    """在当前线程的流程中绑定取消令牌 (需实现 abandoned())，期间 checkpoint() 检查它"""
+    reset = _current_watch.set(token)
+    try:
+        yield token
+    finally:
+        _current_watch.reset(reset)
+
+
+def current_watch():
+    return _current_watch.get()
+
+
+def checkpoint():
+    """客户端已离开时抛出 RequestCancelled；不在 watch() 内时什么也不做"""
+    token = _current_watch.get()
+    if token is not None and token.abandoned():
+        raise RequestCancelled()
+
+
+class DisconnectWatcher:
+    """同步接口 (线程池) 里检查 HTTP 连接是否已断开"""
+
+    def __init__(self, request):
+        self.request = request
+        self._checked = 0.0
+        self._gone = False
+
+    def abandoned(self):
+        now = time.monotonic()
+        if self._gone or now - self._checked < DISCONNECT_CHECK_INTERVAL:
+            return self._gone
+        self._checked = now
+        try:
+            self._gone = anyio.from_thread.run(self.request.is_disconnected)
+        except RuntimeError:
+            # 不在 AnyIO 工作线程里 (例如脚本直接调用)，无从判断
+            pass
+        return self._gone
+
+
+class ChatStream:
+    """
+    一次流式回复：后台线程 push 事件，任意个 SSE 连接按游标读取。
+    事件 id 即它在 events 中的下标；done / error 之后不再接受新事件。
+    """
+
+    def __init__(self, stream_id, resume_grace=STREAM_RESUME_GRACE):
+        self.id = stream_id
+        self.resume_grace = resume_grace
+        self.events = []
+        self.done = False
+        self.cancelled = False
+        self.subscribers = 0
+        self.detached_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def push(self, event, data):
+        with self._lock:
+            if self.done:
+                return
+            self.events.append((event, data))
+            if event in ("done", "error"):
+                self.done = True
+
+    def read(self, cursor):
+        """返回 (cursor 之后的事件, 是否已结束)"""
+        with self._lock:
+            return self.events[cursor:], self.done
+
+    def attach(self):
+        with self._lock:
+            self.subscribers += 1
+
+    def detach(self):
+        with self._lock:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self.detached_at = time.monotonic()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def abandoned(self):
+        with self._lock:
+            if self.cancelled:
+                return True
+            return self.subscribers == 0 and time.monotonic() - self.detached_at > self.resume_grace
+
+
+class StreamRegistry:
+    """stream_id -> ChatStream，过期或超出数量的流被淘汰 (淘汰后无法续传)"""
+
+    def __init__(self, max_size=STREAM_REGISTRY_SIZE, retention=STREAM_RETENTION):
+        self._streams = TTLCache(max_size, retention)
+        self._lock = threading.Lock()
+        self.stats = {"opened": 0, "resumed": 0, "completed": 0, "cancelled": 0}
+
+    def open(self):
+        stream = ChatStream(uuid.uuid4().hex)
+        self._streams.put(stream.id, stream)
+        self.count("opened")
+        return stream
+
+    def get(self, stream_id):
+        return self._streams.get(stream_id)
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return {**stats, "size": self._streams.metrics()["size"],
+                "config": {"resume_grace_s": STREAM_RESUME_GRACE, "retention_s": STREAM_RETENTION}}
+
+
+def format_event(event_id, event, data):
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def parse_last_event_id(value):
+    """Last-Event-ID 头 -> 最后收到的事件下标，缺省或非法时为 -1 (从头发送)"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+async def sse_events(stream, last_event_id=-1):
+    """
+    把流中 last_event_id 之后的事件推给一个 SSE 连接，直到 done / error。
+    连接断开时 Starlette 取消这个生成器，finally 中登记离开，开始计算重连宽限期。
+    """
+    cursor = last_event_id + 1
+    idle = 0.0
+    stream.attach()
+    try:
+        while True:
+            events, done = stream.read(cursor)
+            for offset, (event, data) in enumerate(events):
+                yield format_event(cursor + offset, event, data)
+            cursor += len(events)
+            if done:
+                return
+            if events:
+                idle = 0.0
+            elif idle >= STREAM_HEARTBEAT:
+                yield ": ping\n\n"
+                idle = 0.0
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+            idle += STREAM_POLL_INTERVAL
+    finally:
+        stream.detach()
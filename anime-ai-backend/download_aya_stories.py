@@ -2,18 +2,54 @@ import json
 import requests
 import os
 import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+
+from file_hash import file_sha256
+
+# 可选依赖：有 ijson 时流式解析索引，内存占用与索引大小无关
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 # 1. 你的源文件
 INDEX_FILE = 'bandstories.5.json'
 # 2. 保存位置
 OUTPUT_DIR = 'raw_scenarios'
+# 3. 下载进度清单 (断点续传 + ETag 缓存)
+MANIFEST_NAME = 'manifest.json'
+# 4. 剧本清单缓存 (索引文件哈希不变时跳过解析)
+STORIES_MANIFEST_NAME = 'stories_manifest.json'
 
-# 丸山彩所属乐队 ID (Pastel*Palettes = 4)
-TARGET_BAND_ID = 4
+# 默认下载的乐队 ID (Pastel*Palettes = 4)，可用 --bands 指定多个
+TARGET_BAND_IDS = [4]
 
-# Bestdori 剧本服务器地址
+# bandstories 中多语言字段的顺序: 日 / 英 / 繁 / 简 / 韩
+LANG_JP = 0
+LANG_CN = 3
+
+# Bestdori 剧本服务器地址 (离线测试时可用 --base-url 指向本地桩服务器)
 BASE_URL = "https://bestdori.com/assets/jp/scenario/band/"
 
+# 并发与限流：对公共服务器保持礼貌
+MAX_WORKERS = 4
+REQUESTS_PER_SECOND = 2.0
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+REQUEST_TIMEOUT = (5, 20)  # (连接, 读取) 秒
+
+# 伪装成浏览器 (防止被服务器拦截)
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+}
+
+# 这些状态码值得重试，其余 4xx 直接判定失败
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
 
 def get_legacy_filename(scenario_id):
     """
@@ -40,92 +76,290 @@ def get_legacy_filename(scenario_id):
         return None
 
 
-def download_scripts():
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
+class RateLimiter:
+    """线程安全的简单限流器：保证相邻两次请求的间隔不小于 1/rate 秒"""
 
-    with open(INDEX_FILE, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
 
-    print(f"📂 正在解析 {INDEX_FILE}...")
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
 
-    download_list = []
 
-    # 解析 JSON
-    for chapter_key, chapter_data in data.items():
-        if chapter_data.get('bandId') != TARGET_BAND_ID:
-            continue
+class DownloadManifest:
+    """
+    记录下载进度，写在 OUTPUT_DIR/manifest.json：
+    - scenarios: 每个剧本的 ETag / Last-Modified / 实际命中的文件名
+    - band_formats: 每个乐队命中的文件名格式 ("new" / "legacy")，避免重复探测
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {"scenarios": {}, "band_formats": {}}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.data.update(json.load(f))
+            except (OSError, ValueError):
+                print(f"⚠️ 清单损坏，将重新生成: {path}")
 
-        chapter_title = chapter_data.get('mainTitle', ['未知章节'])[0]
-        stories = chapter_data.get('stories', {})
+    def get(self, scenario_id):
+        with self.lock:
+            return dict(self.data["scenarios"].get(scenario_id, {}))
 
-        for story_key, story_info in stories.items():
-            scenario_id = story_info.get('scenarioId')
-            episode_title = story_info.get('title', ['未知'])[0]
+    def band_format(self, band_key):
+        with self.lock:
+            return self.data["band_formats"].get(band_key)
 
-            if scenario_id:
-                download_list.append({
-                    "id": scenario_id,
-                    "title": episode_title
-                })
+    def record(self, scenario_id, band_key, fmt, entry):
+        with self.lock:
+            self.data["scenarios"][scenario_id] = entry
+            if fmt:
+                self.data["band_formats"][band_key] = fmt
+            self._save()
 
-    print(f"✅ 找到 {len(download_list)} 个剧本，开始智能下载...\n")
+    def _save(self):
+        # 先写临时文件再替换，中途被打断也不会留下半个 JSON
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
 
-    success_count = 0
 
-    for i, item in enumerate(download_list):
-        scenario_id = item['id']
-        title = item['title']
+def create_session(pool_size):
+    """带连接池的 Session，所有线程复用 TCP/TLS 连接"""
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-        # 构造两种可能的文件名
-        # 1. 新格式: band4-001.json
-        file_name_new = f"{scenario_id}.json"
-        # 2. 旧格式: 004_01.json
-        file_name_old = get_legacy_filename(scenario_id)
 
-        # 默认保存为 scenario_id.json (方便后续处理统一)
-        save_path = os.path.join(OUTPUT_DIR, file_name_new)
+def fetch_with_retry(session, url, limiter, headers=None):
+    """
+    GET 请求，网络错误 / 429 / 5xx 按指数退避重试。
+    返回最终的 Response；重试耗尽时抛出最后一次的异常。
+    """
+    last_error = None
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(BACKOFF_BASE * (2 ** (attempt - 1)) * (1 + random.random()))
+        limiter.wait()
+        try:
+            res = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            last_error = e
+            continue
 
-        if os.path.exists(save_path):
-            print(f"[{i + 1}] ⏭️ 跳过: {title}")
+        if res.status_code in RETRY_STATUS and attempt < MAX_RETRIES:
+            retry_after = res.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                time.sleep(int(retry_after))
             continue
+        return res
+
+    raise last_error
+
+
+def candidate_filenames(scenario_id, preferred):
+    """按乐队已知的格式排序候选文件名，命中过的格式排在最前"""
+    candidates = [("new", f"{scenario_id}.json")]
+    legacy_name = get_legacy_filename(scenario_id)
+    if legacy_name:
+        candidates.append(("legacy", legacy_name))
+    if preferred:
+        candidates.sort(key=lambda c: c[0] != preferred)
+    return candidates
+
+
+def download_one(session, limiter, manifest, item, base_url, output_dir, revalidate):
+    """
+    下载单个剧本。返回 (状态, 说明)，状态为 done / skipped / unchanged / failed。
+    """
+    scenario_id = item['id']
+    band_key = scenario_id.split('-')[0]
+    save_path = os.path.join(output_dir, f"{scenario_id}.json")
+    entry = manifest.get(scenario_id)
+    has_file = os.path.exists(save_path)
 
-        print(f"[{i + 1}] ⬇️ 尝试下载: {title} ({scenario_id})...", end="")
+    if has_file and not revalidate:
+        return "skipped", "已存在"
+
+    for fmt, file_name in candidate_filenames(scenario_id, manifest.band_format(band_key)):
+        # 已有文件时带上条件请求头，没变化的剧本服务器只回 304
+        cond_headers = {}
+        if has_file and entry.get("file_name") == file_name:
+            if entry.get("etag"):
+                cond_headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                cond_headers["If-Modified-Since"] = entry["last_modified"]
 
-        # --- 第一次尝试：新文件名 ---
-        url_new = f"{BASE_URL}{file_name_new}"
         try:
-            res = requests.get(url_new)
-            if res.status_code == 200:
-                with open(save_path, 'wb') as f:
-                    f.write(res.content)
-                print(" ✅ (新格式)")
-                success_count += 1
-                time.sleep(0.5)
-                continue  # 成功了就进入下一个循环
-        except:
+            res = fetch_with_retry(session, f"{base_url}{file_name}", limiter, cond_headers)
+        except requests.RequestException as e:
+            return "failed", f"网络错误: {e}"
+
+        if res.status_code == 304:
+            return "unchanged", f"未变化 ({file_name})"
+
+        if res.status_code == 200:
+            tmp_path = f"{save_path}.part"
+            with open(tmp_path, 'wb') as f:
+                f.write(res.content)
+            os.replace(tmp_path, save_path)
+
+            manifest.record(scenario_id, band_key, fmt, {
+                "title": item['title'],
+                "file_name": file_name,
+                "etag": res.headers.get("ETag"),
+                "last_modified": res.headers.get("Last-Modified"),
+                "downloaded_at": int(time.time()),
+            })
+            return "done", "新格式" if fmt == "new" else f"旧格式: {file_name}"
+
+        if res.status_code != 404:
+            return "failed", f"HTTP {res.status_code}"
+
+    return "failed", "均失败 (404)"
+
+
+def pick_lang(values, lang):
+    """多语言数组取指定语言，缺失时回退到日文"""
+    if not values:
+        return None
+    if lang < len(values) and values[lang]:
+        return values[lang]
+    return values[LANG_JP]
+
+
+def iter_band_chapters(index_file, band_ids):
+    """
+    逐个章节解析索引，只产出目标乐队的章节。
+    有 ijson 时边读边解析，任何时刻内存里只有一个章节；否则退回 json.load。
+    """
+    with open(index_file, 'rb') as f:
+        if ijson is not None:
+            chapters = ijson.kvitems(f, '')
+        else:
+            print("⚠️ 未安装 ijson，将整体加载索引 (pip install ijson 可流式解析)")
+            chapters = json.load(f).items()
+
+        for chapter_key, chapter_data in chapters:
+            if chapter_data.get('bandId') in band_ids:
+                yield chapter_key, chapter_data
+
+
+def extract_scenarios(index_file, band_ids):
+    """从索引中提取精简的剧本清单：ID / 乐队 / 标题 / 发布时间"""
+    scenarios = []
+    seen_ids = set()
+
+    for _, chapter_data in iter_band_chapters(index_file, band_ids):
+        chapter_title = pick_lang(chapter_data.get('subTitle'), LANG_JP) or '未知章节'
+
+        for story_info in chapter_data.get('stories', {}).values():
+            scenario_id = story_info.get('scenarioId')
+            # 同一个剧本可能出现在多个章节里，并发下载前先去重
+            if not scenario_id or scenario_id in seen_ids:
+                continue
+            seen_ids.add(scenario_id)
+
+            published_at = pick_lang(story_info.get('publishedAt'), LANG_JP)
+            scenarios.append({
+                "id": scenario_id,
+                "band_id": int(chapter_data.get('bandId')),
+                "chapter": chapter_title,
+                "title": pick_lang(story_info.get('title'), LANG_JP) or '未知',
+                "title_cn": pick_lang(story_info.get('title'), LANG_CN),
+                "published_at": int(published_at) if published_at else None,
+            })
+    return scenarios
+
+
+def load_scenario_list(index_file, band_ids, output_dir):
+    """
+    读取剧本清单。索引文件哈希与乐队列表都没变时直接使用缓存，
+    否则重新流式解析并写回缓存。
+    """
+    cache_path = os.path.join(output_dir, STORIES_MANIFEST_NAME)
+    source_hash = file_sha256(index_file)
+    band_ids = sorted(set(band_ids))
+
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get("source_hash") == source_hash and cached.get("band_ids") == band_ids:
+                print(f"⚡ 索引未变化，使用缓存清单: {cache_path}")
+                return cached["scenarios"]
+        except (OSError, ValueError, KeyError):
             pass
 
-        # --- 第二次尝试：旧文件名 ---
-        if file_name_old:
-            url_old = f"{BASE_URL}{file_name_old}"
-            try:
-                res = requests.get(url_old)
-                if res.status_code == 200:
-                    with open(save_path, 'wb') as f:
-                        f.write(res.content)
-                    print(f" ✅ (旧格式: {file_name_old})")
-                    success_count += 1
-                    time.sleep(0.5)
-                    continue
-            except:
-                pass
-
-        print(" ❌ 均失败 (404)")
-
-    print(f"\n🎉 下载完成！成功: {success_count}/{len(download_list)}")
+    print(f"📂 正在解析 {index_file} (乐队: {band_ids})...")
+    scenarios = extract_scenarios(index_file, band_ids)
+
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"source_hash": source_hash, "band_ids": band_ids, "scenarios": scenarios},
+                  f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, cache_path)
+    return scenarios
+
+
+def download_scripts(base_url=BASE_URL, output_dir=OUTPUT_DIR, workers=MAX_WORKERS,
+                     rate=REQUESTS_PER_SECOND, revalidate=False, band_ids=TARGET_BAND_IDS,
+                     index_file=INDEX_FILE):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    download_list = load_scenario_list(index_file, band_ids, output_dir)
+
+    print(f"✅ 找到 {len(download_list)} 个剧本，开始并发下载 (并发 {workers}, 限速 {rate}/s)...\n")
+
+    manifest = DownloadManifest(os.path.join(output_dir, MANIFEST_NAME))
+    limiter = RateLimiter(rate)
+    session = create_session(workers)
+    counts = {"done": 0, "skipped": 0, "unchanged": 0, "failed": 0}
+    icons = {"done": "✅", "skipped": "⏭️", "unchanged": "💤", "failed": "❌"}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(download_one, session, limiter, manifest, item, base_url, output_dir, revalidate): item
+            for item in download_list
+        }
+        for i, future in enumerate(as_completed(futures)):
+            item = futures[future]
+            status, detail = future.result()
+            counts[status] += 1
+            print(f"[{i + 1}/{len(download_list)}] {icons[status]} {item['title']} ({item['id']}) {detail}")
+
+    session.close()
+    print(f"\n🎉 下载完成！新下载: {counts['done']}，未变化: {counts['unchanged']}，"
+          f"跳过: {counts['skipped']}，失败: {counts['failed']} / {len(download_list)}")
     print("请运行清洗脚本 process_aya_memory.py 继续。")
+    return counts
 
 
 if __name__ == '__main__':
-    download_scripts()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="并发下载 Bestdori 乐队剧本")
+    parser.add_argument("--base-url", default=BASE_URL, help="剧本服务器地址 (可指向本地桩服务器做离线测试)")
+    parser.add_argument("--output", default=OUTPUT_DIR, help="保存目录")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="最大并发数")
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND, help="每秒最多请求数")
+    parser.add_argument("--revalidate", action="store_true", help="对已下载的剧本发送条件请求检查更新")
+    parser.add_argument("--bands", default=",".join(map(str, TARGET_BAND_IDS)),
+                        help="要下载的乐队 ID，逗号分隔 (如 1,2,3,4,5)")
+    parser.add_argument("--index", default=INDEX_FILE, help="bandstories 索引文件")
+    args = parser.parse_args()
+
+    bands = [int(b) for b in args.bands.split(",") if b.strip()]
+    download_scripts(args.base_url, args.output, args.workers, args.rate, args.revalidate, bands, args.index)
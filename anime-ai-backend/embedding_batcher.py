@@ -0,0 +1,126 @@
+# embedding_batcher.py
+# 查询向量的动态微批处理：把并发请求的查询攒成一批，只做一次前向计算
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+
+class _Pending:
+    __slots__ = ("text", "future", "enqueued_at")
+
+    def __init__(self, text):
+        self.text = text
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatchEmbeddings(Embeddings):
+    """
+    包装任意 Embeddings，对 embed_query 做动态微批处理。
+
+    - 后台线程取出第一条查询后，最多再等 max_wait_ms 或凑满 max_batch_size 条，
+      然后一次 embed_documents 算完整批，再分别唤醒各个调用方。
+    - 低负载时 (上一批只有 1 条、队列里也没有别的查询) 不等待，直接计算，
+      单用户延迟不受影响。
+    - 前向计算进行期间到达的查询会自然排队，下一批一起处理。
+    """
+
+    def __init__(self, base, max_batch_size=32, max_wait_ms=3.0):
+        self.base = base
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._last_batch_size = 1
+        self._stats = {
+            "batches": 0,
+            "items": 0,
+            "max_batch_size": 0,
+            "queue_wait_ms": 0.0,
+            "forward_ms": 0.0,
+        }
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    # ---------- Embeddings 接口 ----------
+    def embed_query(self, text):
+        pending = _Pending(text)
+        self._queue.put(pending)
+        return pending.future.result()
+
+    def embed_documents(self, texts):
+        # 大批量 (如构建索引) 本身已经是批处理，直接交给底层模型
+        if len(texts) >= self.max_batch_size:
+            return self.base.embed_documents(texts)
+        pendings = [_Pending(t) for t in texts]
+        for p in pendings:
+            self._queue.put(p)
+        return [p.future.result() for p in pendings]
+
+    # ---------- 后台批处理 ----------
+    def _collect(self):
+        batch = [self._queue.get()]
+
+        # 先把已经在排队的查询全部带上
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # 有并发迹象时才在窗口内继续等待
+        if len(batch) > 1 or self._last_batch_size > 1:
+            deadline = batch[0].enqueued_at + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            try:
+                vectors = self.base.embed_documents([p.text for p in batch])
+            except Exception as e:
+                for p in batch:
+                    p.future.set_exception(e)
+                vectors = None
+            finished = time.perf_counter()
+
+            if vectors is not None:
+                for p, vector in zip(batch, vectors):
+                    p.future.set_result(vector)
+
+            self._last_batch_size = len(batch)
+            with self._lock:
+                self._stats["batches"] += 1
+                self._stats["items"] += len(batch)
+                self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(batch))
+                self._stats["queue_wait_ms"] += sum(started - p.enqueued_at for p in batch) * 1000
+                self._stats["forward_ms"] += (finished - started) * 1000
+
+    # ---------- 监控 ----------
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        batches = stats["batches"] or 1
+        items = stats["items"] or 1
+        return {
+            "batches": stats["batches"],
+            "items": stats["items"],
+            "avg_batch_size": round(stats["items"] / batches, 2),
+            "max_batch_size": stats["max_batch_size"],
+            "avg_queue_wait_ms": round(stats["queue_wait_ms"] / items, 3),
+            "avg_forward_ms": round(stats["forward_ms"] / batches, 3),
+            "queue_depth": self._queue.qsize(),
+            "config": {"max_batch_size": self.max_batch_size, "max_wait_ms": self.max_wait * 1000},
+        }
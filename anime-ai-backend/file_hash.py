@@ -0,0 +1,12 @@
+# file_hash.py
+# 下载 / 转换 / 建库三个脚本共用的文件内容哈希，用来判断源文件是否变化、能否跳过
+import hashlib
+
+
+def file_sha256(path):
+    """按 1MB 分块计算文件的 SHA-256，大文件也不会整体读入内存"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
@@ -0,0 +1,128 @@
+# intent_classifier.py
+# 本地意图分类：用 Embedding 原型 (每类若干例句) 判断一句话是寒暄闲聊还是剧情提问。
+# 闲聊直接走人设对话，不再经过 重写 -> Router -> 检索 的 RAG 流程。
+#
+#   python intent_classifier.py            # 在标注集 LABELLED_SAMPLES 上评估，用于调整 INTENT_MARGIN
+#   python intent_classifier.py "早上好"
+#
+# 原型和 INTENT_MARGIN 还没有在线上的 text2vec-base-chinese 上校准过，默认关闭：
+# 剧情问题被误判成闲聊就会跳过检索直接编答案。先跑一遍评估，确认没有剧情问题被判成闲聊再开启。
+import os
+
+import numpy as np
+
+INTENT_CLASSIFIER = os.getenv("INTENT_CLASSIFIER", "0") == "1"
+# 闲聊得分需要比剧情得分高出的余量；拿不准时一律走 RAG，宁可多检索也不要漏掉剧情问题
+INTENT_MARGIN = float(os.getenv("INTENT_MARGIN", "0.03"))
+# 每一类取最相似的前几个原型求平均
+INTENT_TOP_N = 3
+
+CHITCHAT = "chitchat"
+STORY = "story"
+
+PROTOTYPES = {
+    CHITCHAT: [
+        "早上好", "晚上好", "晚安", "你好", "你好呀", "嗨", "在吗", "哈喽",
+        "谢谢", "谢谢你", "辛苦了", "再见", "拜拜", "明天见",
+        "哈哈哈", "好的", "嗯嗯", "原来如此", "好可爱", "你真棒", "加油",
+        "我今天好累", "我今天心情不好", "陪我聊聊天吧", "你在干什么",
+        "今天天气真好", "吃饭了吗", "我爱你", "你喜欢我吗", "我是你的粉丝",
+    ],
+    STORY: [
+        "日菜和纱夜是怎么和好的", "千圣的狗叫什么名字", "彩为什么想成为偶像",
+        "Pastel*Palettes 第一次演出发生了什么", "彩在快餐店打工的事", "千圣对彩有多严格",
+        "麻弥的口头禅是什么", "你还记得和花音一起打工的时候吗", "Marmalade解散的时候发生了什么",
+        "讲讲你们乐队的故事", "你和千圣是怎么认识的", "伊芙是哪国人",
+        "你们去海边打工那次怎么样了", "你第一次握手会的时候紧张吗", "彩的妹妹是个什么样的人",
+        "日菜为什么会加入乐队", "演唱会上出了什么意外", "你们拍丧尸电影那次发生了什么",
+    ],
+}
+
+
+# 评估用的标注集，与 PROTOTYPES 不重叠
+LABELLED_SAMPLES = [
+    ("早上好呀", CHITCHAT), ("谢谢彩", CHITCHAT), ("今天好无聊", CHITCHAT), ("晚安~", CHITCHAT),
+    ("你在吗", CHITCHAT), ("嘿嘿，谢谢你", CHITCHAT), ("好有意思", CHITCHAT), ("今天好热啊", CHITCHAT),
+    ("彩今天也要加油哦", CHITCHAT), ("我考试没考好", CHITCHAT), ("下次再聊", CHITCHAT), ("哈哈哈好可爱", CHITCHAT),
+    ("千圣的狗叫什么", STORY), ("彩和日菜一起做过什么", STORY), ("彩讨厌吃什么", STORY), ("ksm是谁", STORY),
+    ("你们的第一次演唱会成功了吗", STORY), ("她们之前为什么吵架", STORY), ("千圣也参加了吗", STORY),
+    ("后来大家是怎么重新振作的", STORY), ("和花音一起打工开心吗", STORY), ("伊芙的武士道是怎么回事", STORY),
+    ("麻弥喜欢什么器材", STORY), ("你生日是哪天", STORY),
+]
+
+
+class IntentClassifier:
+    """
+    原型向量在初始化时算好并归一化；分类时只需要一次查询向量 + 一次小矩阵乘法。
+    embeddings 可以是本地模型，也可以是 sidecar 的 RemoteEmbeddings。
+    """
+
+    def __init__(self, embeddings, prototypes=None, margin=INTENT_MARGIN, top_n=INTENT_TOP_N):
+        self.embeddings = embeddings
+        self.margin = margin
+        self.top_n = top_n
+        self.labels = []
+        self.matrices = []
+        for label, examples in (prototypes or PROTOTYPES).items():
+            self.labels.append(label)
+            self.matrices.append(self._normalize(embeddings.embed_documents(examples)))
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.clip(norms, 1e-9, None)
+
+    def scores(self, text):
+        """每一类的得分：与该类最相似的 top_n 个原型的平均余弦相似度"""
+        query = self._normalize(self.embeddings.embed_query(text))
+        result = {}
+        for label, matrix in zip(self.labels, self.matrices):
+            sims = np.sort(matrix @ query)[::-1][:self.top_n]
+            result[label] = float(sims.mean())
+        return result
+
+    def classify(self, text):
+        """返回 (意图, 各类得分)；闲聊得分需领先 margin 才判为闲聊"""
+        scores = self.scores(text)
+        if scores.get(CHITCHAT, 0.0) - scores.get(STORY, 0.0) >= self.margin:
+            return CHITCHAT, scores
+        return STORY, scores
+
+
+def evaluate(classifier, samples=LABELLED_SAMPLES):
+    """
+    在标注集上评估，返回 {"accuracy", "story_as_chitchat", "chitchat_as_story", "errors"}。
+    story_as_chitchat 是危险的一类错误 (跳过检索)，开启前必须为 0。
+    """
+    errors = []
+    for text, expected in samples:
+        label, scores = classifier.classify(text)
+        if label != expected:
+            errors.append((text, expected, scores))
+    return {
+        "accuracy": 1 - len(errors) / len(samples),
+        "story_as_chitchat": sum(1 for _, expected, _ in errors if expected == STORY),
+        "chitchat_as_story": sum(1 for _, expected, _ in errors if expected == CHITCHAT),
+        "errors": errors,
+    }
+
+
+if __name__ == "__main__":
+    import sys
+    from vector_backend import describe_embeddings, load_embeddings
+
+    print(f"🔄 正在加载模型: {describe_embeddings()}")
+    classifier = IntentClassifier(load_embeddings())
+    if sys.argv[1:]:
+        for text in sys.argv[1:]:
+            label, scores = classifier.classify(text)
+            detail = ", ".join(f"{k}={v:.3f}" for k, v in scores.items())
+            print(f"{'💬' if label == CHITCHAT else '📖'} {label:<9} {text}  ({detail})")
+    else:
+        result = evaluate(classifier)
+        print(f"📊 准确率 {result['accuracy']:.1%}  剧情->闲聊 {result['story_as_chitchat']}  "
+              f"闲聊->剧情 {result['chitchat_as_story']}  (margin={classifier.margin})")
+        for text, expected, scores in result["errors"]:
+            detail = ", ".join(f"{k}={v:.3f}" for k, v in scores.items())
+            print(f"   ❌ 应为 {expected:<9} {text}  ({detail})")
@@ -0,0 +1,225 @@
+# loadtest_chat.py
+# /chat 的离线压测：虚拟用户按真实的多轮对话节奏 (带历史、带思考时间) 持续发消息，
+# 报告吞吐、p50/p95/p99、错误率，以及按 Server-Timing 响应头拆分的各阶段耗时。
+#
+#   python loadtest_chat.py --spawn                         # 自动启动 mock_deepseek.py + main.py
+#   python loadtest_chat.py --spawn --users 1,8,32 --duration 30 --mock-args "--ttft lognormal:800,0.5"
+#   python loadtest_chat.py --base-url http://127.0.0.1:8000  # 压一个已经在运行的后端
+#
+# --spawn 不访问 DeepSeek，但 main.py 启动时仍会加载 Embedding 模型：
+# 只有 HuggingFace 缓存里已有 shibing624/text2vec-base-chinese 时才能完全离线运行。
+# 错误率只统计 5xx、连接错误和超时；429 属于准入控制的正常拒绝，单独列出。
+import os
+import sys
+import json
+import time
+import random
+import shlex
+import argparse
+import threading
+
+import httpx
+
+from process_utils import start, stop, wait_ready
+from request_metrics import percentile
+
+API_PORT = 8100
+MOCK_PORT = 9100
+
+# 每段对话是一个虚拟用户依次发送的消息：寒暄 + 剧情追问，接近真实的聊天节奏
+CONVERSATIONS = [
+    ["你好呀", "彩的自我介绍", "你为什么想成为偶像", "谢谢彩，加油！"],
+    ["早上好", "千圣对彩有多严格", "那千圣的狗叫什么名字", "哈哈哈好可爱"],
+    ["日菜和纱夜是怎么和好的", "她们之前为什么吵架", "原来如此"],
+    ["在吗", "彩在快餐店打工的事", "和花音一起打工开心吗", "晚安~"],
+    ["Pastel*Palettes 第一次演出发生了什么", "后来大家是怎么重新振作的", "你真棒"],
+    ["我今天心情不好", "陪我聊聊天吧", "彩讨厌吃什么", "嘿嘿，谢谢你"],
+    ["麻弥的口头禅是什么", "伊芙的武士道是怎么回事", "拜拜"],
+    ["你们拍丧尸电影那次发生了什么", "千圣也参加了吗", "好有意思"],
+]
+
+
+def parse_server_timing(header):
+    """"rewrite;dur=412.3, total;dur=1503.9" -> {"rewrite": 412.3, "total": 1503.9} (毫秒)"""
+    stages = {}
+    for item in (header or "").split(","):
+        parts = [p.strip() for p in item.split(";")]
+        if not parts[0]:
+            continue
+        for p in parts[1:]:
+            if p.startswith("dur="):
+                try:
+                    stages[parts[0]] = float(p[4:])
+                except ValueError:
+                    pass
+    return stages
+
+
+def run_users(base_url, users, duration, think_ms, seed=0):
+    """users 个虚拟用户在 duration 秒内循环对话，返回每个请求的记录"""
+    records = []
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def user_loop(user_id):
+        rng = random.Random(seed * 1000 + user_id)
+        with httpx.Client(base_url=base_url, timeout=120) as client:
+            while time.time() < deadline:
+                history = []
+                for message in rng.choice(CONVERSATIONS):
+                    if time.time() >= deadline:
+                        return
+                    # 与前端一致：history 里带上当前这条用户消息，只发最近 6 条
+                    history.append({"role": "user", "content": message})
+                    started = time.perf_counter()
+                    try:
+                        res = client.post("/chat", json={"message": message, "history": history[-6:]})
+                        status = res.status_code
+                        reply = res.json().get("text", "") if status == 200 else ""
+                        stages = parse_server_timing(res.headers.get("server-timing"))
+                    except (httpx.HTTPError, ValueError):
+                        status, reply, stages = "error", "", {}
+                    elapsed = time.perf_counter() - started
+
+                    with lock:
+                        records.append({"status": status, "latency": elapsed, "stages": stages,
+                                        "finished": time.time()})
+                    if status != 200:
+                        break
+                    history.append({"role": "ai", "content": reply})
+                    # 用户阅读回复、打字的时间
+                    time.sleep(rng.expovariate(1000 / think_ms) if think_ms > 0 else 0)
+
+    threads = [threading.Thread(target=user_loop, args=(n,)) for n in range(users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return records
+
+
+def is_error(status):
+    """5xx 与连接错误 / 超时 ("error") 算错误；429 等 4xx 是服务端有意拒绝"""
+    return status == "error" or status >= 500
+
+
+def summarize(records, duration):
+    ok = sorted(r["latency"] for r in records if r["status"] == 200)
+    statuses = {}
+    for r in records:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+
+    stage_samples = {}
+    for r in records:
+        if r["status"] != 200:
+            continue
+        for name, ms in r["stages"].items():
+            stage_samples.setdefault(name, []).append(ms)
+    stages = {}
+    for name, samples in stage_samples.items():
+        samples.sort()
+        stages[name] = {
+            "count": len(samples),
+            "avg_ms": round(sum(samples) / len(samples), 1),
+            "p50_ms": round(percentile(samples, 0.50), 1),
+            "p95_ms": round(percentile(samples, 0.95), 1),
+        }
+
+    total = len(records) or 1
+    return {
+        "requests": len(records),
+        "throughput_rps": round(len(ok) / duration, 2),
+        "p50_ms": round(percentile(ok, 0.50) * 1000, 1) if ok else None,
+        "p95_ms": round(percentile(ok, 0.95) * 1000, 1) if ok else None,
+        "p99_ms": round(percentile(ok, 0.99) * 1000, 1) if ok else None,
+        "error_rate": round(sum(1 for r in records if is_error(r["status"])) / total, 4),
+        "rejected_429": statuses.get("429", 0),
+        "statuses": statuses,
+        "stages": stages,
+    }
+
+
+def print_report(rows):
+    print(f"\n{'用户数':>6}{'请求':>7}{'req/s':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'错误率':>8}{'429':>6}")
+    for users, s in rows:
+        fmt = lambda v: f"{v:>10.0f}" if v is not None else f"{'-':>10}"
+        print(f"{users:>6}{s['requests']:>7}{s['throughput_rps']:>8.2f}{fmt(s['p50_ms'])}{fmt(s['p95_ms'])}"
+              f"{fmt(s['p99_ms'])}{s['error_rate']:>8.1%}{s['rejected_429']:>6}")
+
+    for users, s in rows:
+        print(f"\n⏱️  各阶段耗时 ({users} 用户，仅成功请求，来自 Server-Timing)")
+        print(f"   {'阶段':<10}{'次数':>7}{'平均(ms)':>10}{'p50(ms)':>10}{'p95(ms)':>10}")
+        for name, st in sorted(s["stages"].items(), key=lambda x: x[0] == "total"):
+            print(f"   {name:<10}{st['count']:>7}{st['avg_ms']:>10.1f}{st['p50_ms']:>10.1f}{st['p95_ms']:>10.1f}")
+
+
+def fetch_json(url):
+    try:
+        return httpx.get(url, timeout=5).json()
+    except (httpx.HTTPError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/chat 多轮对话离线压测")
+    parser.add_argument("--base-url", default="", help="压测已有后端；不填且使用 --spawn 时自动启动")
+    parser.add_argument("--spawn", action="store_true",
+                        help="启动 mock_deepseek.py 与 main.py (需已缓存 HF Embedding 模型才能离线)")
+    parser.add_argument("--api-workers", type=int, default=1, help="--spawn 时 uvicorn 的 worker 数")
+    parser.add_argument("--mock-args", default="", help="传给 mock_deepseek.py 的参数，如 \"--ttft fixed:300\"")
+    parser.add_argument("--users", default="1,8,32", help="虚拟用户数，逗号分隔依次压测")
+    parser.add_argument("--duration", type=float, default=30, help="每组压测秒数")
+    parser.add_argument("--think-ms", type=float, default=1000, help="两条消息之间的平均思考时间")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default="", help="把完整结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    mock = api = None
+    base_url = args.base_url
+    try:
+        if args.spawn:
+            env = dict(os.environ)
+            env["DEEPSEEK_API_KEY"] = "loadtest-placeholder"
+            env["DEEPSEEK_BASE_URL"] = f"http://127.0.0.1:{MOCK_PORT}"
+            # 所有虚拟用户来自同一个 IP，关掉按客户端限流，只保留全局并发控制
+            env.setdefault("RATE_LIMIT_RPS", "0")
+
+            mock = start([sys.executable, "mock_deepseek.py", "--port", str(MOCK_PORT),
+                          "--seed", str(args.seed)] + shlex.split(args.mock_args), env)
+            if not wait_ready(f"http://127.0.0.1:{MOCK_PORT}/health", timeout=60):
+                raise RuntimeError("mock_deepseek 启动超时")
+
+            api = start([sys.executable, "-m", "uvicorn", "main:app", "--port", str(API_PORT),
+                         "--workers", str(args.api_workers)], env)
+            base_url = base_url or f"http://127.0.0.1:{API_PORT}"
+            if not wait_ready(f"{base_url}/health"):
+                raise RuntimeError("API 启动超时")
+        elif not base_url:
+            parser.error("需要 --base-url 或 --spawn")
+
+        rows = []
+        for users in [int(u) for u in args.users.split(",")]:
+            print(f"🚦 {users} 个虚拟用户，压测 {args.duration:.0f} 秒 ...")
+            records = run_users(base_url, users, args.duration, args.think_ms, args.seed)
+            rows.append((users, summarize(records, args.duration)))
+
+        print_report(rows)
+
+        backend_metrics = fetch_json(f"{base_url}/metrics")
+        if backend_metrics and backend_metrics.get("paths"):
+            print("\n🧭 后端路径分布 (/metrics，累计):")
+            for path, m in backend_metrics["paths"].items():
+                print(f"   {path:<13}{m['count']:>7} 次  占比 {m['share']:.1%}  p50 {m['p50_ms']} ms  p95 {m['p95_ms']} ms")
+        mock_stats = fetch_json(f"http://127.0.0.1:{MOCK_PORT}/stats") if args.spawn else None
+        if mock_stats:
+            print(f"\n🧪 mock 上游调用: {mock_stats['requests']} 次 {mock_stats['by_kind']}")
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump({"config": vars(args), "results": {str(u): s for u, s in rows},
+                           "backend_metrics": backend_metrics, "mock_stats": mock_stats},
+                          f, ensure_ascii=False, indent=1)
+            print(f"\n💾 结果已写入 {args.json}")
+    finally:
+        stop(api)
+        stop(mock)
@@ -1,31 +1,66 @@
 import os
 import sys
-import glob
-from fastapi import FastAPI
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List
 from dotenv import load_dotenv
 from openai import OpenAI
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
 
 # 1. 路径与环境设置
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
 
-# 加载环境变量 (.env)
+# 加载环境变量 (.env)，须在导入本地模块之前，后者会读取环境变量配置
 env_path = os.path.join(current_dir, '.env')
 if os.path.exists(env_path):
     load_dotenv(env_path)
 
-# 配置 DeepSeek 客户端
+from admission import (
+    ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, CHAT_DEGRADE_RATIO, CHAT_MAX_CONCURRENCY, CHAT_MAX_QUEUE,
+    CHAT_QUEUE_TIMEOUT, RATE_LIMIT_BURST, RATE_LIMIT_RPS, ROUTER_CACHE_SIZE,
+    ConcurrencyLimiter, Overloaded, TTLCache, TokenBucketLimiter, client_key
+)
+from character import CHARACTERS, DEFAULT_CHARACTER
+from chat_stream import (
+    ChatStream, DisconnectWatcher, RequestCancelled, StreamRegistry,
+    checkpoint, current_watch, parse_last_event_id, sse_events, watch
+)
+from intent_classifier import CHITCHAT, INTENT_CLASSIFIER, IntentClassifier
+from request_metrics import Counters, PathMetrics, request_timer, stage
+from story_index import (
+    load_index_map, parse_router_output, build_file_filter, build_keyword_index, keyword_route,
+    parse_glossary_aliases, query_similarity, doc_file_id, index_character_names, query_characters,
+    doc_has_characters, fill_docs, scoped_search, restrict_index_map, self_alias_names
+)
+from vector_backend import (
+    describe_embeddings, BUNDLE_EMBEDDINGS, VECTOR_BACKEND, RemoteEmbeddings, RemoteVectorStore, embedding_metrics,
+    load_query_embeddings, open_bundle, open_chroma, sample_metadata
+)
+
+# 配置 DeepSeek 客户端 (压测时可把 DEEPSEEK_BASE_URL 指向 mock_deepseek.py)
 DEEPSEEK_KEY = os.getenv("DEEPSEEK_API_KEY")
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
 client = OpenAI(
     api_key=DEEPSEEK_KEY,
-    base_url="https://api.deepseek.com"
+    base_url=DEEPSEEK_BASE_URL
 )
 
+# 每次回答使用的片段数
+RETRIEVAL_K = 6
+# 预检索：在 LLM 重写/路由的同时先用用户原话检索，结果够用就直接采用 (见 start_speculative_search)
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "1") == "1"
+SPECULATIVE_K = int(os.getenv("SPECULATIVE_K", "24"))
+SPECULATIVE_MIN_SIMILARITY = float(os.getenv("SPECULATIVE_MIN_SIMILARITY", "0.6"))
+SPECULATIVE_WORKERS = int(os.getenv("SPECULATIVE_WORKERS", "8"))
+# 调试/压测用的 /retrieve (只检索不调用 LLM)：默认不挂载，开启后同样经过准入控制，k 有上限
+RETRIEVE_ENDPOINT = os.getenv("RETRIEVE_ENDPOINT", "0") == "1"
+RETRIEVE_MAX_K = int(os.getenv("RETRIEVE_MAX_K", "20"))
+
 # 初始化 FastAPI
 app = FastAPI()
 app.add_middleware(
@@ -43,80 +78,172 @@ class ChatMessage(BaseModel):
     content: str
 
 
+class RetrieveRequest(BaseModel):
+    query: str
+    character: str = DEFAULT_CHARACTER
+    file_ids: List[str] = []
+    k: int = 6
+
+
 class ChatRequest(BaseModel):
     message: str
     history: List[ChatMessage] = []
+    character: str = DEFAULT_CHARACTER
 
 
 # ==================== 资源初始化 ====================
 print("🔄 正在初始化系统 (最终工程版)...")
 
-# 1. 智能配置路径
-# 获取 main.py 所在的文件夹
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-# 获取上一级目录 (chatbot1)
-PROJECT_ROOT = os.path.dirname(BASE_DIR)
-
-# 修正：指向上一级的 data_source
-DATA_SOURCE_DIR = os.path.join(PROJECT_ROOT, "data_source")
-# 指向当前目录下的 chroma_db
-DB_PERSIST_DIR = os.path.join(BASE_DIR, "chroma_db")
-
-INDEX_MAP_PATH = os.path.join(DB_PERSIST_DIR, "index_map.txt")
-GLOSSARY_PATH = os.path.join(DATA_SOURCE_DIR, "00_glossary.txt")
-
-# 2. 加载 Embedding 模型 (必须与构建时一致)
-# 推荐: shibing624/text2vec-base-chinese
-EMBEDDING_MODEL_NAME = "shibing624/text2vec-base-chinese"
-try:
-    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
-    print(f"✅ Embedding 模型已加载: {EMBEDDING_MODEL_NAME}")
-except Exception as e:
-    print(f"❌ 模型加载失败: {e}")
-    sys.exit(1)
-
-# 3. 加载向量数据库 (从硬盘读取)
-vector_db = None
-if os.path.exists(DB_PERSIST_DIR):
+# 1. 加载 Embedding 模型 (必须与构建时一致，所有角色共用一份)
+# sidecar 模式下模型在 vector_service.py 里，worker 只做 I/O
+embeddings = None
+if VECTOR_BACKEND == "sidecar":
+    print("🔌 检索后端: sidecar (vector_service.py)")
+elif VECTOR_BACKEND == "bundle" and BUNDLE_EMBEDDINGS == "remote":
+    # 向量包在本进程检索，查询向量交给 sidecar：启动时只需映射文件
+    embeddings = RemoteEmbeddings()
+    print("🔌 查询向量: sidecar /embed (vector_service.py)")
+else:
     try:
-        print(f"📂 正在挂载向量数据库: {DB_PERSIST_DIR}")
-        vector_db = Chroma(
-            persist_directory=DB_PERSIST_DIR,
-            embedding_function=embeddings,
-            collection_name="aya_memory_v3"  # 必须与 build_vector_db.py 中的名称一致
+        embeddings = load_query_embeddings()
+        print(f"✅ Embedding 模型已加载: {describe_embeddings()}")
+    except Exception as e:
+        print(f"❌ 模型加载失败: {e}")
+        sys.exit(1)
+
+# 同一个 (目录, collection) 只挂载一次，多个角色可以共用
+_vector_dbs = {}
+# 同一份字典只读一次
+_text_cache = {}
+
+
+def open_vector_db(character):
+    persist_dir, collection_name = character.persist_dir, character.collection_name
+    key = (persist_dir, collection_name)
+    if key in _vector_dbs:
+        return _vector_dbs[key]
+
+    vector_db = None
+    if VECTOR_BACKEND == "sidecar":
+        vector_db = RemoteVectorStore(collection_name)
+    elif VECTOR_BACKEND == "bundle":
+        try:
+            print(f"📦 正在映射向量包: {character.bundle_path}")
+            vector_db = open_bundle(character.bundle_path, embeddings)
+            print(f"✅ 向量包已映射: {vector_db.count} 条片段 ({vector_db.header['dtype']})")
+        except Exception as e:
+            print(f"❌ 向量包加载失败: {e}")
+            print("💡 请先运行 'python build_vector_db.py --export-bundle'")
+    elif os.path.exists(persist_dir):
+        try:
+            print(f"📂 正在挂载向量数据库: {persist_dir} / {collection_name}")
+            vector_db = open_chroma(persist_dir, collection_name, embeddings)
+            print("✅ 知识库挂载成功！")
+        except Exception as e:
+            print(f"❌ 数据库挂载失败: {e}")
+            print("💡 请先运行 'python build_vector_db.py'")
+    else:
+        print(f"⚠️ 警告: 未找到数据库目录 {persist_dir}")
+        print("💡 请务必先运行 'python build_vector_db.py' 构建数据！")
+
+    _vector_dbs[key] = vector_db
+    return vector_db
+
+
+def read_text(path):
+    if path not in _text_cache:
+        _text_cache[path] = ""
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                _text_cache[path] = f.read()
+    return _text_cache[path]
+
+
+class CharacterRuntime:
+    """一个角色在运行时需要的全部资源：向量库、路由索引、世界观字典"""
+
+    def __init__(self, character):
+        self.character = character
+        self.vector_db = open_vector_db(character)
+
+        # 检查数据库 metadata 版本：旧库只有 source 字段，需要回退到旧的过滤方式
+        self.legacy_metadata = False
+        if self.vector_db:
+            try:
+                sample = sample_metadata(self.vector_db)
+                if sample is not None and "file_id" not in sample:
+                    self.legacy_metadata = True
+                    print("⚠️ 数据库 metadata 为旧格式，将按 source 过滤。")
+                    print("💡 运行 'python build_vector_db.py --migrate' 可原地升级。")
+            except Exception as e:
+                print(f"⚠️ 无法检查数据库 metadata: {e}")
+
+        # 加载动态剧情索引 (用于 Router)，file_ids 限定该角色可见的文件
+        # bundle 模式下路由索引和字典都已打包在向量包里，不再读文本文件
+        from_bundle = VECTOR_BACKEND == "bundle" and self.vector_db is not None
+        if from_bundle:
+            self.story_index_context, self.story_file_index = self.vector_db.index_map()
+        else:
+            self.story_index_context, self.story_file_index = load_index_map(character.index_map_path)
+        self.story_index_context, self.story_file_index = restrict_index_map(
+            self.story_index_context, self.story_file_index, character.file_ids
         )
-        print("✅ 知识库挂载成功！")
+        if self.story_index_context:
+            print(f"🗺️  [{character.key}] 已加载动态剧情索引: {len(self.story_file_index)} 个文件")
+        else:
+            print(f"⚠️ 严重警告: [{character.key}] 未找到 {character.index_map_path}！Router 将无法正确锁定文件。")
+            print("💡 请重新运行 build_vector_db.py 生成索引。")
+
+        # 加载世界观字典 (用于 Rewrite)
+        self.world_view_context = self.vector_db.glossary() if from_bundle else read_text(character.glossary_path)
+        if not self.world_view_context:
+            print(f"⚠️ [{character.key}] 未找到世界观字典，将使用通用重写模式")
+
+        # 降级模式下不调用 LLM 的本地路由：索引表关键词 + 字典昵称展开
+        self.keyword_index = build_keyword_index(self.story_index_context, self.story_file_index)
+        self.aliases = self.vector_db.aliases() if from_bundle else parse_glossary_aliases(self.world_view_context)
+
+        # 检索时按问题里提到的人物缩小范围 (见 story_index.query_characters)；角色自己的称呼不算
+        self.character_names = index_character_names(self.keyword_index)
+        self.self_names = self_alias_names(self.aliases, character.short_name)
+
+
+# 2. 为注册表中的每个角色准备运行时资源
+RUNTIMES = {key: CharacterRuntime(character) for key, character in CHARACTERS.items()}
+print(f"👥 已加载角色: {', '.join(RUNTIMES)}")
+
+# 3. 准入控制与缓存 (见 admission.py 的环境变量)
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_RPS, RATE_LIMIT_BURST)
+chat_limiter = ConcurrencyLimiter(CHAT_MAX_CONCURRENCY, CHAT_MAX_QUEUE, CHAT_QUEUE_TIMEOUT, CHAT_DEGRADE_RATIO)
+router_cache = TTLCache(ROUTER_CACHE_SIZE)
+answer_cache = TTLCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+chat_stats = Counters("degraded", "cached_answers", "cancelled")
+
+# 4. 意图分类 (闲聊直接走人设对话，INTENT_CLASSIFIER=1 时启用)，sidecar 模式下查询向量由检索服务计算
+intent_classifier = None
+if INTENT_CLASSIFIER:
+    try:
+        intent_classifier = IntentClassifier(embeddings if embeddings is not None else RemoteEmbeddings())
+        print("✅ 意图分类器已就绪")
     except Exception as e:
-        print(f"❌ 数据库挂载失败: {e}")
-        print("💡 请先运行 'python build_vector_db.py'")
-else:
-    print(f"⚠️ 警告: 未找到数据库目录 {DB_PERSIST_DIR}")
-    print("💡 请务必先运行 'python build_vector_db.py' 构建数据！")
-
-# 4. 加载动态剧情索引 (用于 Router)
-STORY_INDEX_CONTEXT = ""
-if os.path.exists(INDEX_MAP_PATH):
-    with open(INDEX_MAP_PATH, 'r', encoding='utf-8') as f:
-        STORY_INDEX_CONTEXT = f.read()
-    print(f"🗺️  已加载动态剧情索引: {len(STORY_INDEX_CONTEXT.splitlines())} 条记录")
-else:
-    print("⚠️ 严重警告: 未找到 index_map.txt！Router 将无法正确锁定文件。")
-    print("💡 请重新运行 build_vector_db.py 生成索引。")
-
-# 5. 加载世界观字典 (用于 Rewrite)
-WORLD_VIEW_CONTEXT = ""
-if os.path.exists(GLOSSARY_PATH):
-    with open(GLOSSARY_PATH, 'r', encoding='utf-8') as f:
-        WORLD_VIEW_CONTEXT = f.read()
-    print("📚 已加载世界观字典")
-else:
-    print("⚠️ 未找到 00_glossary.txt，将使用通用重写模式")
+        print(f"⚠️ 意图分类器初始化失败，所有消息都将走 RAG: {e}")
+path_metrics = PathMetrics()
+stage_metrics = PathMetrics(with_share=False)
+
+# 5. 预检索线程池
+speculation_pool = ThreadPoolExecutor(max_workers=SPECULATIVE_WORKERS, thread_name_prefix="speculative")
+speculation_stats = Counters("launched", "accepted", "query_changed", "scope_mismatch",
+                             "not_enough", "not_ready", "error")
+
+# 6. 流式回复 (/chat/stream)：每个流在后台线程里执行，线程数与并发名额一致
+stream_pool = ThreadPoolExecutor(max_workers=CHAT_MAX_CONCURRENCY, thread_name_prefix="chat-stream")
+chat_streams = StreamRegistry()
 
 
 # ==================== 🧠 核心 1：意图理解与重写 ====================
-def rewrite_query(user_msg: str, history: List[ChatMessage]):
+def rewrite_query(runtime: CharacterRuntime, user_msg: str, history: List[ChatMessage]):
     """利用对话历史和字典，将用户口语转换为精准搜索词"""
-    if not history and not WORLD_VIEW_CONTEXT:
+    if not history and not runtime.world_view_context:
         return user_msg
 
     history_text = "\n".join([f"{msg.role}: {msg.content}" for msg in history[-4:]])
@@ -126,7 +253,7 @@ def rewrite_query(user_msg: str, history: List[ChatMessage]):
     请利用下方的【世界观实体字典】，将用户口语化的问题转换为准确的搜索语句。
 
     【世界观实体字典】
-    {WORLD_VIEW_CONTEXT}
+    {runtime.world_view_context}
 
     【任务】
     1. 补全省略的主语。
@@ -142,15 +269,17 @@ def rewrite_query(user_msg: str, history: List[ChatMessage]):
     仅输出重写后的句子。
     """
 
+    checkpoint()
     try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": "你是一个精准的查询重写器。"},
-                {"role": "user", "content": rewrite_prompt}
-            ],
-            temperature=0.0
-        )
+        with stage("rewrite"):
+            response = client.chat.completions.create(
+                model=DEEPSEEK_MODEL,
+                messages=[
+                    {"role": "system", "content": "你是一个精准的查询重写器。"},
+                    {"role": "user", "content": rewrite_prompt}
+                ],
+                temperature=0.0
+            )
         return response.choices[0].message.content.strip()
     except Exception as e:
         print(f"Rewrite Error: {e}")
@@ -158,19 +287,25 @@ def rewrite_query(user_msg: str, history: List[ChatMessage]):
 
 
 # ==================== 🧠 核心 2：剧情范围锁定 (Router - 动态版) ====================
-def detect_story_scope(search_query: str):
+def detect_story_scope(runtime: CharacterRuntime, search_query: str):
     """
     根据 index_map.txt 动态判断需要检索哪些文件。
+    返回规范文件 ID 列表 (如 ["B2", "B7"])，无法确定时返回空列表。
     """
-    if not STORY_INDEX_CONTEXT:
-        return "NONE"
+    if not runtime.story_index_context:
+        return []
+
+    cache_key = (runtime.character.key, search_query)
+    cached = router_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
     scope_prompt = f"""
-    你是一个《BanG Dream!》Pastel*Palettes 乐队的剧情导航员。
+    你是一个《BanG Dream!》{runtime.character.band} 乐队的剧情导航员。
     你需要根据用户问题，从下方的【文件索引】中选出 **1到3个** 最相关的档案文件。
 
     【文件索引】
-    {STORY_INDEX_CONTEXT}
+    {runtime.story_index_context}
 
     【用户问题】
     {search_query}
@@ -186,77 +321,236 @@ def detect_story_scope(search_query: str):
     用户: "彩的自我介绍" -> 输出: B0.txt
     """
 
+    checkpoint()
     try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": "只输出文件名，用逗号分隔，无多余解释。"},
-                {"role": "user", "content": scope_prompt}
-            ],
-            temperature=0.0
-        )
+        with stage("router"):
+            response = client.chat.completions.create(
+                model=DEEPSEEK_MODEL,
+                messages=[
+                    {"role": "system", "content": "只输出文件名，用逗号分隔，无多余解释。"},
+                    {"role": "user", "content": scope_prompt}
+                ],
+                temperature=0.0
+            )
         file_scope = response.choices[0].message.content.strip()
 
-        # 简单清洗
-        if "txt" not in file_scope and file_scope != "NONE":
-            # 尝试提取可能的文件名
-            import re
-            files = re.findall(r'[A-Z]\d+\.txt', file_scope)
-            if files:
-                return ",".join(files)
-            return "NONE"
-
-        return file_scope
+        # 只保留 index_map.txt 中真实存在的文件
+        target_files = parse_router_output(file_scope, runtime.story_file_index)
+        router_cache.put(cache_key, target_files)
+        return target_files
 
     except Exception as e:
         print(f"Router Error: {e}")
-        return "NONE"
+        return []
+
+
+# ==================== 核心 3：生成回复 ====================
+def generate_reply(character, messages, temperature):
+    """
+    最终回复的 LLM 调用。在 watch() 内时以流式请求上游，每收到一段检查一次客户端是否还在，
+    离开则立刻关闭上游连接；当前令牌是 ChatStream 时同时把增量文本推给前端。
+    """
+    checkpoint()
+    token = current_watch()
+    try:
+        with stage("generate"):
+            if token is None:
+                response = client.chat.completions.create(
+                    model=DEEPSEEK_MODEL,
+                    messages=messages,
+                    temperature=temperature
+                )
+                return response.choices[0].message.content
+
+            upstream = client.chat.completions.create(
+                model=DEEPSEEK_MODEL,
+                messages=messages,
+                temperature=temperature,
+                stream=True
+            )
+            parts = []
+            try:
+                for chunk in upstream:
+                    checkpoint()
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        parts.append(delta)
+                        if isinstance(token, ChatStream):
+                            token.push("delta", {"text": delta})
+            finally:
+                upstream.close()
+            return "".join(parts)
+    except RequestCancelled:
+        raise
+    except Exception as e:
+        print(f"LLM Error: {e}")
+        return character.error_reply
 
 
 # ==================== 核心逻辑：生成回复 (RAG) ====================
-def conversational_rag(user_query: str, history: List[ChatMessage]):
-    # 1. 意图理解
-    print(f"\n🤔 用户原话: {user_query}")
-    search_query = rewrite_query(user_query, history)
-    print(f"🎯 检索用语: {search_query}")
+def local_story_scope(runtime: CharacterRuntime, search_query: str):
+    """降级模式的路由：优先用 LLM Router 的缓存结果，否则用本地关键词匹配"""
+    cached = router_cache.get((runtime.character.key, search_query))
+    if cached is not None:
+        return cached
+    return keyword_route(search_query, runtime.keyword_index, runtime.aliases)
+
+
+# ==================== 意图分流 ====================
+def classify_intent(user_query: str):
+    """返回 "chitchat" 或 "story"；分类器不可用或出错时按剧情问题处理"""
+    if intent_classifier is None:
+        return "story"
+    try:
+        label, scores = intent_classifier.classify(user_query)
+        print(f"🧩 意图: {label} ({', '.join(f'{k}={v:.3f}' for k, v in scores.items())})")
+        return label
+    except Exception as e:
+        print(f"Intent Error: {e}")
+        return "story"
 
-    # 2. 剧情范围锁定
-    target_files_str = detect_story_scope(search_query)
-    print(f"🧭 锁定范围: {target_files_str}")
 
-    context_text = ""
+def persona_chat(runtime: CharacterRuntime, user_query: str, history: List[ChatMessage]):
+    """寒暄闲聊：只用角色人设 (system prompt) + 对话历史，不检索"""
+    character = runtime.character
+    print(f"\n💬 [{character.key}] 闲聊: {user_query}")
+
+    messages = [character.prompt()]
+    for msg in history[-6:]:
+        messages.append({"role": "user" if msg.role == "user" else "assistant", "content": msg.content})
+    messages.append({"role": "user", "content": user_query})
+    return generate_reply(character, messages, temperature=0.8)
 
-    # 3. 精准检索
-    if vector_db and target_files_str != "NONE":
-        try:
-            target_files = [f.strip() for f in target_files_str.split(",") if "txt" in f]
-
-            if target_files:
-                # 使用 metadata 过滤器只检索相关文件
-                search_kwargs = {
-                    "k": 6,
-                    "filter": {"source": {"$in": target_files}}
-                }
-
-                docs = vector_db.similarity_search(search_query, **search_kwargs)
-
-                print("--- 🕵️‍♀️ 最终检索结果 ---")
-                for i, d in enumerate(docs):
-                    src = d.metadata.get('source')
-                    print(f"[{i + 1}] {src} | {d.page_content[:20]}...")
-                    context_text += f"{d.page_content}\n\n"
-                print("-----------------------")
-        except Exception as e:
-            print(f"检索出错: {e}")
+
+# ==================== 预检索 (与 LLM 重写/路由并行) ====================
+def start_speculative_search(runtime: CharacterRuntime, user_query: str):
+    """
+    用用户原话 + 本地关键词路由的范围 (无命中时不过滤) 提前检索一批较宽的候选片段。
+    返回 (原话, 预检索范围, Future)，未启用时返回 None。
+    """
+    if not (SPECULATIVE_RETRIEVAL and runtime.vector_db):
+        return None
+    scope = keyword_route(user_query, runtime.keyword_index, runtime.aliases)
+    search_filter = build_file_filter(scope, legacy=runtime.legacy_metadata) if scope else None
+    future = speculation_pool.submit(
+        runtime.vector_db.similarity_search, user_query, k=SPECULATIVE_K, filter=search_filter
+    )
+    speculation_stats.add("launched")
+    return user_query, scope, future
+
+
+def accept_speculative(speculation, search_query: str, target_files: List[str], people=()):
+    """
+    判断预检索结果能否代替正式检索，能则返回 top-k 片段，否则返回 None。
+    条件：重写后的查询与原话足够接近；预检索范围覆盖 Router 锁定的文件；
+    候选中属于这些文件 (且关键人物包含 people) 的片段不少于 k 条 (或预检索范围内的片段已全部取回)，
+    此时它们就是原话在目标文件内的精确 top-k，与 scoped_search 的结果一致。
+    """
+    if speculation is None:
+        return None
+    raw_query, scope, future = speculation
+
+    if not target_files:
+        future.cancel()
+        return None
+
+    reason = None
+    if query_similarity(raw_query, search_query) < SPECULATIVE_MIN_SIMILARITY:
+        reason = "query_changed"
+    elif scope and not set(target_files) <= set(scope):
+        reason = "scope_mismatch"
+    elif not future.done() and future.cancel():
+        # 线程池繁忙、预检索还没开始执行
+        reason = "not_ready"
+
+    if reason:
+        future.cancel()
+        speculation_stats.add(reason)
+        print(f"🔁 预检索未采用 ({reason})")
+        return None
+
+    try:
+        candidates = future.result()
+    except Exception as e:
+        print(f"预检索出错: {e}")
+        speculation_stats.add("error")
+        return None
+
+    wanted = set(target_files)
+    docs = [d for d in candidates if doc_file_id(d) in wanted]
+    narrowed = [d for d in docs if doc_has_characters(d, people)]
+    if len(narrowed) < RETRIEVAL_K and len(candidates) >= SPECULATIVE_K:
+        speculation_stats.add("not_enough")
+        print("🔁 预检索未采用 (not_enough)")
+        return None
+
+    speculation_stats.add("accepted")
+    print("⚡ 采用预检索结果")
+    return fill_docs(narrowed, docs, RETRIEVAL_K)
+
+
+def conversational_rag(runtime: CharacterRuntime, user_query: str, history: List[ChatMessage], degraded=False):
+    """degraded=True 时跳过 LLM 重写和 LLM Router，每个请求只调用一次上游 LLM"""
+    character = runtime.character
+
+    # 1. 意图理解 (同时在后台用原话预检索；降级模式本身不调用 LLM，无需预检索)
+    print(f"\n🤔 [{character.key}] 用户原话: {user_query}")
+    speculation = None if degraded else start_speculative_search(runtime, user_query)
+    try:
+        if degraded:
+            search_query = user_query
+            print("🐢 降级模式: 跳过查询重写，使用本地路由")
+        else:
+            search_query = rewrite_query(runtime, user_query, history)
+        print(f"🎯 检索用语: {search_query}")
+
+        # 2. 剧情范围锁定
+        if degraded:
+            target_files = local_story_scope(runtime, search_query)
+        else:
+            target_files = detect_story_scope(runtime, search_query)
+        print(f"🧭 锁定范围: {','.join(target_files) or 'NONE'}")
+
+        # 问题里提到的人物：优先检索他们作为关键人物出场的档案 (旧库没有人物字段)
+        people = [] if runtime.legacy_metadata else query_characters(
+            search_query, runtime.aliases, runtime.character_names, exclude=runtime.self_names
+        )
+        if people:
+            print(f"👥 关注人物: {','.join(people)}")
+
+        # 3. 精准检索 (预检索结果可用时直接采用，否则再按范围检索，两者合计为一个 retrieve 阶段)
+        docs = None
+        with stage("retrieve"):
+            try:
+                docs = accept_speculative(speculation, search_query, target_files, people)
+                if docs is None and runtime.vector_db and target_files:
+                    # 使用 metadata 过滤器只检索相关文件 (及相关人物)
+                    docs = scoped_search(runtime.vector_db, search_query, RETRIEVAL_K, target_files,
+                                         people, legacy=runtime.legacy_metadata)
+            except Exception as e:
+                print(f"检索出错: {e}")
+    finally:
+        # 请求中途被取消或出错时，还在排队的预检索不再占用线程池 (已采用或已完成时无影响)
+        if speculation is not None:
+            speculation[2].cancel()
+
+    context_text = ""
+    if docs:
+        print("--- 🕵️‍♀️ 最终检索结果 ---")
+        for i, d in enumerate(docs):
+            src = d.metadata.get('source')
+            print(f"[{i + 1}] {src} | {d.page_content[:20]}...")
+            context_text += f"{d.page_content}\n\n"
+        print("-----------------------")
 
     # 4. 防幻觉兜底
     if not context_text:
         print("⚠️ 未检索到信息，触发兜底回复。")
-        return "那个……彩有点记不太清了( > < ) 或者是彩还没经历过这件事？\n如果可以的话，能告诉我更多细节吗？💦"
+        return character.fallback_reply
 
     # 5. 生成回复
     final_prompt = f"""
-    你现在是《BanG Dream!》中的角色丸山彩（Maruyama Aya）。
+    你现在是《BanG Dream!》中的角色{character.name}。
     请完全沉浸在这个角色中，**严格仅根据下方的【相关回忆片段】**来回答粉丝的问题。
 
     【🚫 绝对禁令】
@@ -270,33 +564,24 @@ def conversational_rag(user_query: str, history: List[ChatMessage]):
     粉丝：{user_query}
 
     【回复要求】
-    - 基于片段内容，用丸山彩软萌、努力的口吻回答。
-    - 多使用颜文字 (✨, 💦, ( > < ))。
-    - 第一人称是“彩”或“我”。
+    {character.speech_style}
 
-    请作为丸山彩回复：
+    请作为{character.short_name}回复：
     """
-
-    try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[{"role": "user", "content": final_prompt}],
-            temperature=0.7
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        print(f"LLM Error: {e}")
-        return "呜呜...脑子突然一片空白...彩、彩是不是又搞砸了？( > < )"
+    return generate_reply(character, [{"role": "user", "content": final_prompt}], temperature=0.7)
 
 
 # ==================== API 接口 ====================
-@app.post("/chat")
-async def chat(request: ChatRequest):
-    response_text = conversational_rag(request.message, request.history)
+def get_runtime(character_key: str) -> CharacterRuntime:
+    runtime = RUNTIMES.get(character_key)
+    if runtime is None:
+        raise HTTPException(status_code=404, detail=f"未知角色: {character_key}")
+    return runtime
+
 
-    # 简单的情感分析（用于前端Live2D动作）
+def detect_emotion(check_text):
+    """简单的情感分析（用于前端Live2D动作）"""
     emotion = "idle"
-    check_text = response_text
     if any(k in check_text for k in ["呜", "难过", "对不起", "紧张", "哭", "💦", "搞砸"]):
         emotion = "cry"
     elif any(k in check_text for k in ["开心", "嘿嘿", "成功", "谢谢", "✨", "缤纷彩"]):
@@ -305,8 +590,225 @@ async def chat(request: ChatRequest):
         emotion = "shy"
     elif any(k in check_text for k in ["生气", "过分", "讨厌"]):
         emotion = "anger"
+    return emotion
+
+
+def answer_cache_key(request: ChatRequest):
+    """同一角色、同一句话、同一个上文 (最近一轮) 视为同一个问题"""
+    last_turn = request.history[-1].content if request.history else ""
+    return request.character, request.message.strip(), last_turn
+
+
+def cached_reply(cache_key):
+    text = answer_cache.get(cache_key)
+    if text is None:
+        return None
+    chat_stats.add("cached_answers")
+    print(f"♻️ 命中回答缓存: {cache_key[1][:20]}")
+    return {"text": text, "emotion": detect_emotion(text)}
+
+
+def overloaded_response(runtime: CharacterRuntime, error: Overloaded):
+    """快速拒绝：429 + Retry-After，text 字段让前端仍能以角色口吻提示"""
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(error.retry_after)},
+        content={"text": runtime.character.busy_reply, "emotion": "cry", "detail": error.reason},
+    )
 
-    return {"text": response_text, "emotion": emotion}
+
+# 注意：处理函数是同步的 def，FastAPI 会放进线程池执行；
+# 若写成 async def，阻塞的检索和 LLM 调用会卡住事件循环，并发请求只能排队
+@app.post("/chat")
+def chat(request: ChatRequest, http_request: Request, response: Response):
+    runtime = get_runtime(request.character)
+    with request_timer() as timer:
+        result = handle_chat(runtime, request, http_request)
+
+    # 各阶段耗时写进 Server-Timing 响应头 (浏览器开发者工具 / 压测脚本可直接读取)
+    for name, seconds in timer.stages.items():
+        stage_metrics.record(name, seconds)
+    target = result if isinstance(result, Response) else response
+    target.headers["Server-Timing"] = timer.server_timing()
+    return result
+
+
+def admit(runtime: CharacterRuntime, http_request: Request, cache_key=None):
+    """
+    准入控制。返回 None 表示已占用一个并发名额 (调用方负责 release)；
+    否则返回应直接给出的结果：缓存的回答 (dict，仅当给出 cache_key 时) 或 429 响应
+    """
+    # 1. 按客户端限流
+    try:
+        rate_limiter.acquire(client_key(http_request))
+    except Overloaded as e:
+        return overloaded_response(runtime, e)
+
+    # 2. 已经有压力时，能用缓存回答就不再进入队列
+    if cache_key is not None and chat_limiter.under_pressure():
+        reply = cached_reply(cache_key)
+        if reply:
+            return reply
+
+    # 3. 全局并发上限 (有界等待队列)，排不上队时退回缓存或 429
+    try:
+        with stage("queue"):
+            chat_limiter.acquire()
+    except Overloaded as e:
+        return (cache_key is not None and cached_reply(cache_key)) or overloaded_response(runtime, e)
+    return None
+
+
+def run_pipeline(runtime: CharacterRuntime, request: ChatRequest):
+    """寒暄闲聊走人设对话，剧情问题走完整 RAG；调用方须已占用并发名额"""
+    started = time.perf_counter()
+    with stage("intent"):
+        intent = classify_intent(request.message)
+    if intent == CHITCHAT:
+        path = "chitchat"
+        response_text = persona_chat(runtime, request.message, request.history)
+    else:
+        degraded = chat_limiter.under_pressure(holding=True)
+        if degraded:
+            chat_stats.add("degraded")
+        path = "rag_degraded" if degraded else "rag"
+        response_text = conversational_rag(runtime, request.message, request.history, degraded=degraded)
+    path_metrics.record(path, time.perf_counter() - started)
+
+    if response_text not in (runtime.character.fallback_reply, runtime.character.error_reply):
+        answer_cache.put(answer_cache_key(request), response_text)
+
+    return {"text": response_text, "emotion": detect_emotion(response_text)}
+
+
+def handle_chat(runtime: CharacterRuntime, request: ChatRequest, http_request: Request):
+    shortcut = admit(runtime, http_request, answer_cache_key(request))
+    if shortcut is not None:
+        return shortcut
+
+    # 4. 客户端断开 (前端取消了过期请求) 后不再发起后续的 LLM 调用
+    try:
+        with watch(DisconnectWatcher(http_request)):
+            return run_pipeline(runtime, request)
+    except RequestCancelled:
+        chat_stats.add("cancelled")
+        print("🚪 客户端已断开，停止处理")
+        return Response(status_code=499)
+    finally:
+        chat_limiter.release()
+
+
+# ==================== 流式回复 (SSE，可续传) ====================
+def run_chat_stream(runtime: CharacterRuntime, request: ChatRequest, stream: ChatStream):
+    """后台线程执行一次对话，事件写进 stream；结束 (含取消) 时释放并发名额"""
+    try:
+        with request_timer() as timer, watch(stream):
+            try:
+                stream.push("done", run_pipeline(runtime, request))
+                chat_streams.count("completed")
+            except RequestCancelled:
+                stream.push("error", {"detail": "cancelled"})
+                chat_streams.count("cancelled")
+                print(f"🚪 流 {stream.id[:8]} 已无人接收，停止生成")
+        for name, seconds in timer.stages.items():
+            stage_metrics.record(name, seconds)
+    except Exception as e:
+        print(f"Stream Error: {e}")
+        stream.push("error", {"detail": "internal_error"})
+    finally:
+        chat_limiter.release()
+
+
+def sse_response(stream: ChatStream, last_event_id=-1):
+    return StreamingResponse(
+        sse_events(stream, last_event_id),
+        media_type="text/event-stream",
+        # 关闭代理缓冲，增量文本才能逐段到达浏览器
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/chat/stream")
+def chat_stream(request: ChatRequest, http_request: Request):
+    """
+    流式版 /chat。SSE 事件：meta (stream_id) -> delta (增量文本)... -> done (完整 text + emotion) 或 error。
+    连接意外断开后 GET /chat/stream/{stream_id} 并带上 Last-Event-ID 续传；DELETE 同一地址立即取消生成。
+    """
+    runtime = get_runtime(request.character)
+    shortcut = admit(runtime, http_request, answer_cache_key(request))
+    if isinstance(shortcut, Response):
+        return shortcut
+
+    stream = chat_streams.open()
+    stream.push("meta", {"stream_id": stream.id})
+    if shortcut is not None:
+        stream.push("done", shortcut)
+    else:
+        stream_pool.submit(run_chat_stream, runtime, request, stream)
+    return sse_response(stream)
+
+
+@app.get("/chat/stream/{stream_id}")
+def resume_chat_stream(stream_id: str, http_request: Request):
+    stream = chat_streams.get(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail="流不存在或已过期")
+    chat_streams.count("resumed")
+    return sse_response(stream, parse_last_event_id(http_request.headers.get("last-event-id")))
+
+
+@app.delete("/chat/stream/{stream_id}")
+def cancel_chat_stream(stream_id: str):
+    stream = chat_streams.get(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail="流不存在或已过期")
+    stream.cancel()
+    return {"status": "cancelled"}
+
+
+def retrieve(request: RetrieveRequest, http_request: Request):
+    """只做向量检索、不调用 LLM，用于调试和压测检索链路 (RETRIEVE_ENDPOINT=1 时挂载)"""
+    runtime = get_runtime(request.character)
+    if not runtime.vector_db:
+        raise HTTPException(status_code=503, detail="向量数据库未挂载")
+
+    shortcut = admit(runtime, http_request)
+    if shortcut is not None:
+        return shortcut
+    try:
+        k = max(1, min(request.k, RETRIEVE_MAX_K))
+        search_filter = build_file_filter(request.file_ids, legacy=runtime.legacy_metadata) if request.file_ids else None
+        docs = runtime.vector_db.similarity_search(request.query, k=k, filter=search_filter)
+        return {"results": [{"source": d.metadata.get("source"), "text": d.page_content} for d in docs]}
+    finally:
+        chat_limiter.release()
+
+
+if RETRIEVE_ENDPOINT:
+    app.post("/retrieve")(retrieve)
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "backend": VECTOR_BACKEND, "characters": list(RUNTIMES)}
+
+
+@app.get("/metrics")
+def metrics():
+    return {
+        "embedding_batcher": embedding_metrics(embeddings),
+        "admission": {
+            "rate_limiter": rate_limiter.metrics(),
+            "concurrency": chat_limiter.metrics(),
+            "router_cache": router_cache.metrics(),
+            "answer_cache": answer_cache.metrics(),
+            **chat_stats.metrics(),
+        },
+        "speculative_retrieval": speculation_stats.metrics(),
+        "streams": chat_streams.metrics(),
+        "paths": path_metrics.metrics(),
+        "stages": stage_metrics.metrics(),
+    }
 
 
 if __name__ == "__main__":
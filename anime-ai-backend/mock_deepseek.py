@@ -0,0 +1,180 @@
+# mock_deepseek.py
+# 离线压测用的 OpenAI 兼容 mock 服务：按可配置的延迟分布返回 /chat/completions (支持 stream)，不消耗 API 额度。
+# 根据 prompt 区分 重写 / Router / 生成 三类调用，返回形状合理的内容，让后端走完整条链路。
+#
+#   python mock_deepseek.py                                    # 默认 127.0.0.1:9100
+#   python mock_deepseek.py --ttft lognormal:600,0.5 --tps 40 --error-rate 0.01
+# 然后以 DEEPSEEK_BASE_URL=http://127.0.0.1:9100 启动 main.py (或直接用 loadtest_chat.py --spawn)
+#
+# 延迟分布写法 (单位 ms):
+#   fixed:300 | uniform:200,1200 | normal:500,100 | lognormal:<中位数>,<sigma>
+import re
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+import argparse
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI()
+
+INDEX_LINE_PATTERN = re.compile(r'^\s*-\s*([^:：\s]+\.txt)\s*[:：]', re.M)
+QUESTION_PATTERN = re.compile(r'【用户(?:新)?问题】\s*\n\s*(.+)')
+REPLY_TEXT = "诶嘿嘿，这件事彩记得很清楚哦✨ 那时候大家一起努力排练，虽然彩紧张得差点咬到舌头💦 但最后还是成功了！"
+
+
+def parse_distribution(spec):
+    """把 "lognormal:600,0.5" 这样的写法解析成一个返回毫秒数的函数"""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError(f"未知的延迟分布: {spec}")
+
+
+class MockConfig:
+    # 首 token 延迟分布 (按调用类型可以分别设置，未设置时用 default)
+    ttft = {"default": parse_distribution("lognormal:500,0.4")}
+    # 每秒输出字符数 (近似看作 token)
+    tps = 50.0
+    # 生成回复的长度 (字符)
+    reply_chars = 120
+    error_rate = 0.0
+    stats = {"requests": 0, "streams": 0, "errors": 0, "by_kind": {}}
+
+
+config = MockConfig()
+
+
+def classify_call(messages):
+    """根据 prompt 判断是后端的哪一步在调用"""
+    system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+    last = messages[-1]["content"] if messages else ""
+    if "查询重写器" in system:
+        return "rewrite"
+    if "文件索引" in last:
+        return "router"
+    if "相关回忆片段" in last:
+        return "generate"
+    return "chitchat"
+
+
+def build_reply(kind, messages):
+    last = messages[-1]["content"] if messages else ""
+    if kind == "rewrite":
+        # 原样返回用户问题，相当于重写没有改动
+        match = QUESTION_PATTERN.search(last)
+        return match.group(1).strip() if match else last[-30:]
+    if kind == "router":
+        files = INDEX_LINE_PATTERN.findall(last)
+        if not files:
+            return "NONE"
+        question = QUESTION_PATTERN.search(last)
+        rng = random.Random(question.group(1) if question else last)
+        return ",".join(rng.sample(files, min(len(files), rng.randint(1, 3))))
+    return (REPLY_TEXT * (config.reply_chars // len(REPLY_TEXT) + 1))[:config.reply_chars]
+
+
+def completion_body(reply, model, stream_chunk=False, finish=None):
+    body = {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion.chunk" if stream_chunk else "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+    }
+    if stream_chunk:
+        body["choices"] = [{"index": 0, "delta": {"content": reply} if reply else {}, "finish_reason": finish}]
+    else:
+        body["choices"] = [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}]
+        body["usage"] = {"prompt_tokens": 0, "completion_tokens": len(reply), "total_tokens": len(reply)}
+    return body
+
+
+@app.post("/chat/completions")
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    payload = await request.json()
+    messages = payload.get("messages", [])
+    model = payload.get("model", "deepseek-chat")
+    kind = classify_call(messages)
+
+    config.stats["requests"] += 1
+    config.stats["by_kind"][kind] = config.stats["by_kind"].get(kind, 0) + 1
+
+    ttft = config.ttft.get(kind, config.ttft["default"])() / 1000
+    if random.random() < config.error_rate:
+        config.stats["errors"] += 1
+        await asyncio.sleep(ttft)
+        return JSONResponse(status_code=500, content={"error": {"message": "mock upstream error", "type": "server_error"}})
+
+    reply = build_reply(kind, messages)
+    per_char = 1.0 / config.tps if config.tps > 0 else 0.0
+
+    if not payload.get("stream"):
+        await asyncio.sleep(ttft + per_char * len(reply))
+        return completion_body(reply, model)
+
+    config.stats["streams"] += 1
+
+    async def events():
+        await asyncio.sleep(ttft)
+        for i in range(0, len(reply), 4):
+            piece = reply[i:i + 4]
+            yield f"data: {json.dumps(completion_body(piece, model, stream_chunk=True), ensure_ascii=False)}\n\n"
+            await asyncio.sleep(per_char * len(piece))
+        yield f"data: {json.dumps(completion_body('', model, stream_chunk=True, finish='stop'))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+
+@app.get("/stats")
+def stats():
+    return config.stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的 DeepSeek mock 服务 (离线压测用)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft", default="lognormal:500,0.4", help="首 token 延迟分布 (所有调用的默认值)")
+    parser.add_argument("--ttft-rewrite", default="", help="重写调用的首 token 延迟分布")
+    parser.add_argument("--ttft-router", default="", help="Router 调用的首 token 延迟分布")
+    parser.add_argument("--ttft-generate", default="", help="RAG 生成调用的首 token 延迟分布")
+    parser.add_argument("--tps", type=float, default=50.0, help="每秒输出字符数")
+    parser.add_argument("--reply-chars", type=int, default=120, help="生成回复的长度")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的概率")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    config.ttft["default"] = parse_distribution(args.ttft)
+    for kind in ("rewrite", "router", "generate"):
+        spec = getattr(args, f"ttft_{kind}")
+        if spec:
+            config.ttft[kind] = parse_distribution(spec)
+    config.tps = args.tps
+    config.reply_chars = args.reply_chars
+    config.error_rate = args.error_rate
+
+    print(f"🧪 mock DeepSeek: http://{args.host}:{args.port} (ttft={args.ttft}, tps={args.tps})")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,217 @@
+# onnx_embeddings.py
+# text2vec 的 ONNX Runtime 推理路径 (可选 int8 动态量化)，CPU 上更省内存、更快。
+#
+#   python onnx_embeddings.py export      # 导出 fp32 ONNX 并量化为 int8
+#   python onnx_embeddings.py validate    # 对比 fp32 PyTorch 与 ONNX 的检索排序，并报告冷启动/内存/延迟
+# 然后设置 EMBEDDING_BACKEND=onnx 即可在构建和查询中使用 (见 vector_backend.py)。
+# 默认仍是 hf：在真实模型上跑过 validate、确认 int8 的排序重合率和延迟后再切换。
+import os
+import sys
+import time
+import glob
+import argparse
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from process_utils import rss_mb
+
+CURRENT_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(CURRENT_SCRIPT_DIR)
+
+DEFAULT_ONNX_DIR = os.path.join(CURRENT_SCRIPT_DIR, "onnx_text2vec")
+FP32_FILE = "model.onnx"
+INT8_FILE = "model.int8.onnx"
+
+# 与 sentence-transformers 版 text2vec-base-chinese 的配置一致 (mean pooling, 不归一化)
+MAX_SEQ_LENGTH = 128
+ENCODE_BATCH_SIZE = 32
+
+
+class OnnxEmbeddings(Embeddings):
+    """用 ONNX Runtime 计算句向量，输出与 HuggingFaceEmbeddings 的 fp32 结果同分布"""
+
+    def __init__(self, model_dir=DEFAULT_ONNX_DIR, model_file=INT8_FILE, num_threads=None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_path = os.path.join(model_dir, model_file)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"未找到 ONNX 模型: {model_path}，请先运行 'python onnx_embeddings.py export'")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _encode(self, texts):
+        vectors = []
+        for start in range(0, len(texts), ENCODE_BATCH_SIZE):
+            batch = texts[start:start + ENCODE_BATCH_SIZE]
+            encoded = self.tokenizer(batch, padding=True, truncation=True,
+                                     max_length=MAX_SEQ_LENGTH, return_tensors="np")
+            feeds = {k: v.astype(np.int64) for k, v in encoded.items() if k in self.input_names}
+            token_embeddings = self.session.run(None, feeds)[0]
+
+            # mean pooling (忽略 padding)
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            summed = (token_embeddings * mask).sum(axis=1)
+            vectors.append(summed / np.clip(mask.sum(axis=1), 1e-9, None))
+        return np.concatenate(vectors).tolist() if vectors else []
+
+    def embed_documents(self, texts):
+        return self._encode(list(texts))
+
+    def embed_query(self, text):
+        return self._encode([text])[0]
+
+
+def export(model_name, out_dir=DEFAULT_ONNX_DIR, quantize=True):
+    """导出 ONNX (需要 torch + transformers)，可选 int8 动态量化 (需要 onnxruntime)"""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    tokenizer.save_pretrained(out_dir)
+
+    dummy = tokenizer(["导出用的示例句子"], return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in dummy]
+    dynamic_axes = {n: {0: "batch", 1: "sequence"} for n in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    fp32_path = os.path.join(out_dir, FP32_FILE)
+    print(f"📦 正在导出 ONNX: {fp32_path}")
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(dummy[n] for n in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        int8_path = os.path.join(out_dir, INT8_FILE)
+        print(f"🗜️  正在做 int8 动态量化: {int8_path}")
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+    for name in os.listdir(out_dir):
+        if name.endswith((".onnx", ".onnx.data")):
+            size = os.path.getsize(os.path.join(out_dir, name)) / 1024 / 1024
+            print(f"   {name}: {size:.1f} MB")
+    print("✅ 导出完成")
+
+
+# ==================== 校验与报告 ====================
+def load_corpus():
+    """用构建时同样的切分方式得到全部片段文本"""
+    from story_chunker import chunk_story_file
+    from story_index import canonical_file_id
+
+    paths = sorted(glob.glob(os.path.join(PROJECT_ROOT, "data_source", "*.txt")))
+    file_index = {canonical_file_id(os.path.basename(p)): i for i, p in enumerate(paths)}
+    texts = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            texts.extend(d.page_content for d in chunk_story_file(os.path.basename(path), f.read(), file_index))
+    return texts
+
+
+def top_k(query_vectors, doc_vectors, k):
+    q = np.asarray(query_vectors, dtype=np.float32)
+    d = np.asarray(doc_vectors, dtype=np.float32)
+    # Chroma 默认 L2 距离
+    dist = (q ** 2).sum(1)[:, None] - 2 * q @ d.T + (d ** 2).sum(1)[None, :]
+    return np.argsort(dist, axis=1)[:, :k]
+
+
+def measure(factory, queries, corpus):
+    """冷启动时间 / RSS 增量 / 单条查询延迟 / 片段与查询向量"""
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    embeddings = factory()
+    embeddings.embed_query("预热")
+    cold_start = time.perf_counter() - started
+
+    latencies = []
+    query_vectors = []
+    for q in queries:
+        t = time.perf_counter()
+        query_vectors.append(embeddings.embed_query(q))
+        latencies.append(time.perf_counter() - t)
+
+    doc_vectors = embeddings.embed_documents(corpus)
+    return {
+        "cold_start_s": cold_start,
+        "rss_delta_mb": rss_mb() - rss_before,
+        "p50_ms": float(np.median(latencies)) * 1000,
+        "query_vectors": query_vectors,
+        "doc_vectors": doc_vectors,
+    }
+
+
+def validate(model_dir=DEFAULT_ONNX_DIR, model_file=INT8_FILE, k=6, tolerance=0.8):
+    """
+    对比 fp32 (PyTorch) 与 ONNX 模型在同一批查询上的 top-k 检索结果。
+    平均重合率低于 tolerance 时返回 False。
+    """
+    from sample_queries import VALIDATION_QUERIES
+    from vector_backend import load_hf_embeddings
+
+    corpus = load_corpus()
+    queries = VALIDATION_QUERIES
+    print(f"🔎 校验语料: {len(corpus)} 个片段, {len(queries)} 条查询, top-{k}")
+
+    # ONNX 先测，避免 PyTorch 占用的内存干扰 RSS 统计
+    onnx = measure(lambda: OnnxEmbeddings(model_dir, model_file), queries, corpus)
+    ref = measure(load_hf_embeddings, queries, corpus)
+
+    ref_top = top_k(ref["query_vectors"], ref["doc_vectors"], k)
+    onnx_top = top_k(onnx["query_vectors"], onnx["doc_vectors"], k)
+    overlaps = [len(set(a) & set(b)) / k for a, b in zip(ref_top, onnx_top)]
+    top1 = np.mean([a[0] == b[0] for a, b in zip(ref_top, onnx_top)])
+
+    ref_q = np.asarray(ref["query_vectors"])
+    onnx_q = np.asarray(onnx["query_vectors"])
+    cosine = (ref_q * onnx_q).sum(1) / (np.linalg.norm(ref_q, axis=1) * np.linalg.norm(onnx_q, axis=1))
+
+    print(f"\n{'':<22}{'冷启动(s)':>10}{'RSS增量(MB)':>13}{'查询p50(ms)':>13}")
+    for name, r in (("fp32 PyTorch", ref), (f"ONNX {model_file}", onnx)):
+        print(f"{name:<22}{r['cold_start_s']:>10.2f}{r['rss_delta_mb']:>13.0f}{r['p50_ms']:>13.1f}")
+
+    mean_overlap = float(np.mean(overlaps))
+    print(f"\n📐 top-{k} 平均重合率: {mean_overlap:.3f} (阈值 {tolerance}) | top-1 一致率: {top1:.3f} "
+          f"| 查询向量余弦相似度: 最低 {cosine.min():.4f}, 平均 {cosine.mean():.4f}")
+
+    ok = mean_overlap >= tolerance
+    print("✅ 校验通过" if ok else "❌ 校验未通过：量化后排序偏差过大，建议改用 fp32 ONNX (--model-file model.onnx)")
+    return ok
+
+
+if __name__ == "__main__":
+    sys.path.append(CURRENT_SCRIPT_DIR)
+    from vector_backend import EMBEDDING_MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="text2vec 的 ONNX 导出 / 校验")
+    parser.add_argument("command", choices=["export", "validate"])
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME, help="HuggingFace 模型名")
+    parser.add_argument("--out", default=DEFAULT_ONNX_DIR, help="ONNX 模型目录")
+    parser.add_argument("--model-file", default=INT8_FILE, help="校验时使用的 ONNX 文件")
+    parser.add_argument("--no-quantize", action="store_true", help="只导出 fp32 ONNX")
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--tolerance", type=float, default=0.8, help="top-k 平均重合率下限")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.model, args.out, quantize=not args.no_quantize)
+    else:
+        sys.exit(0 if validate(args.out, args.model_file, args.k, args.tolerance) else 1)
@@ -0,0 +1,236 @@
+import os
+import re
+import json
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from file_hash import file_sha256
+from story_index import parse_glossary_aliases
+
+# 可选依赖：有 ijson 时流式读取剧本对白，大剧本也不会整体载入内存
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# ================= 配置区 =================
+CURRENT_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(CURRENT_SCRIPT_DIR)
+
+# download_aya_stories.py 的输出目录
+RAW_DIR = os.path.join(CURRENT_SCRIPT_DIR, "raw_scenarios")
+# 与 build_vector_db.py 读取的目录一致
+DATA_SOURCE_DIR = os.path.join(PROJECT_ROOT, "data_source")
+# 世界观字典：剧本里的说话人是日文名 (千聖 / イヴ)，按字典换成 [关键人物] 标签使用的简称 (千圣 / 伊芙)
+GLOSSARY_FILE = os.path.join(DATA_SOURCE_DIR, "00_glossary.txt")
+
+# download_aya_stories.py 生成的剧本清单 (标题 / 章节)
+STORIES_MANIFEST_NAME = "stories_manifest.json"
+# 转换进度：记录每个剧本的内容哈希，未变化的剧本直接跳过
+CONVERT_MANIFEST_NAME = "convert_manifest.json"
+
+# 头部 [关键人物] 最多列出的人数 (按台词数排序)
+MAX_KEY_CHARACTERS = 6
+# 每隔多少句台词插入一个【场景】标题，方便按章节切分
+LINES_PER_SECTION = 40
+
+SCENARIO_ID_PATTERN = re.compile(r'^band(\d+)-(\d+)$')
+
+
+# =========================================
+
+def memory_file_id(scenario_id):
+    """band4-001 -> E4_001 (E = Episode，与已有的 A/B/C/D/S 档案区分)"""
+    match = SCENARIO_ID_PATTERN.match(scenario_id)
+    if not match:
+        return None
+    return f"E{int(match.group(1))}_{int(match.group(2)):03d}"
+
+
+def load_speaker_names(glossary_path):
+    """
+    从世界观字典生成 {说话人(小写): 简称}。
+    简称取每行的第一个称呼，与 query_characters 按简称匹配 char:<name> 字段的约定一致。
+    """
+    if not os.path.exists(glossary_path):
+        return {}
+    with open(glossary_path, 'r', encoding='utf-8') as f:
+        aliases = parse_glossary_aliases(f.read())
+    return {alias: names[1] for alias, names in aliases.items()}
+
+
+def iter_talk_data(json_path):
+    """流式读取剧本中的对白 (Bestdori 格式: Base.talkData[])"""
+    with open(json_path, 'rb') as f:
+        if ijson is not None:
+            yield from ijson.items(f, 'Base.talkData.item')
+            return
+        data = json.load(f)
+    yield from (data.get("Base") or data).get("talkData", [])
+
+
+def extract_dialogue(json_path, speaker_names=None):
+    """返回 [(说话人, 台词)]，说话人为空的旁白记为 "旁白"；字典里有的说话人换成中文简称"""
+    speaker_names = speaker_names or {}
+    dialogue = []
+    for talk in iter_talk_data(json_path):
+        body = " ".join((talk.get("body") or "").split())
+        if not body:
+            continue
+        speaker = (talk.get("windowDisplayName") or "").strip() or "旁白"
+        speaker = speaker_names.get(speaker.lower(), speaker)
+        dialogue.append((speaker, body))
+    return dialogue
+
+
+def render_memory_file(file_id, info, dialogue):
+    """生成带 [档案类型]/[关键人物] 头部的记忆文件，格式与 extract_file_summary 的读取逻辑一致"""
+    speakers = Counter(s for s, _ in dialogue if s != "旁白")
+    key_characters = [name for name, _ in speakers.most_common(MAX_KEY_CHARACTERS)]
+    title = info.get("title_cn") or info.get("title") or file_id
+
+    lines = [
+        f"[ID: {file_id}_BandStory_{info.get('id', '')}]",
+        f"[档案类型: 乐队剧情原文 / {info.get('chapter', '未知章节')}]",
+        f"[关键人物: {', '.join(key_characters)}]",
+        f"[核心事件: {title}]",
+    ]
+
+    for start in range(0, len(dialogue), LINES_PER_SECTION):
+        part = start // LINES_PER_SECTION + 1
+        lines.append("")
+        lines.append(f"【{title}】" if part == 1 else f"【{title} ({part})】")
+        lines.extend(f"{speaker}：{body}" for speaker, body in dialogue[start:start + LINES_PER_SECTION])
+
+    return "\n".join(lines) + "\n"
+
+
+def convert_one(json_path, info, output_dir, speaker_names=None):
+    """转换单个剧本，返回 (scenario_id, 输出文件名, 台词数)；没有可用对白时输出文件名为 None。在子进程中执行"""
+    scenario_id = info["id"]
+    file_id = memory_file_id(scenario_id)
+    dialogue = extract_dialogue(json_path, speaker_names)
+    if not file_id or not dialogue:
+        return scenario_id, None, 0
+
+    out_name = f"{file_id}.txt"
+    tmp_path = os.path.join(output_dir, f"{out_name}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(render_memory_file(file_id, info, dialogue))
+    os.replace(tmp_path, os.path.join(output_dir, out_name))
+    return scenario_id, out_name, len(dialogue)
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def is_up_to_date(entry, source_hash, glossary_hash, output_dir):
+    """
+    清单记录与当前剧本、字典是否一致。
+    没有对白 (skipped) 或转换失败 (failed) 的剧本同样记入清单，源文件不变时不再反复处理；
+    转换成功的还要求输出文件仍然存在。
+    """
+    if entry.get("source_hash") != source_hash or entry.get("glossary_hash") != glossary_hash:
+        return False
+    if entry.get("status") in ("skipped", "failed"):
+        return True
+    return bool(entry.get("output")) and os.path.exists(os.path.join(output_dir, entry["output"]))
+
+
+def process_scenarios(raw_dir=RAW_DIR, output_dir=DATA_SOURCE_DIR, workers=None, force=False,
+                      glossary_path=GLOSSARY_FILE):
+    """
+    把 raw_scenarios/*.json 转成 data_source/E*.txt。
+    以剧本 JSON 与世界观字典的内容哈希判断是否需要重新转换，重复运行只会处理有变化的剧本。
+    返回本次写出的文件名列表。
+    """
+    stories = load_json(os.path.join(raw_dir, STORIES_MANIFEST_NAME), {}).get("scenarios", [])
+    story_info = {s["id"]: s for s in stories}
+
+    manifest_path = os.path.join(raw_dir, CONVERT_MANIFEST_NAME)
+    manifest = load_json(manifest_path, {})
+
+    # 字典变了 (比如补了说话人的日文名)，已转换的剧本也要重新生成
+    glossary_hash = file_sha256(glossary_path) if os.path.exists(glossary_path) else ""
+    speaker_names = load_speaker_names(glossary_path)
+
+    jobs = []
+    for name in sorted(os.listdir(raw_dir)):
+        scenario_id, ext = os.path.splitext(name)
+        if ext != ".json" or not SCENARIO_ID_PATTERN.match(scenario_id):
+            continue
+
+        json_path = os.path.join(raw_dir, name)
+        source_hash = file_sha256(json_path)
+        if not force and is_up_to_date(manifest.get(scenario_id, {}), source_hash, glossary_hash, output_dir):
+            continue
+
+        info = {"id": scenario_id, **story_info.get(scenario_id, {})}
+        jobs.append((json_path, info, source_hash))
+
+    if not jobs:
+        print("✅ 所有剧本均未变化，无需转换")
+        return []
+
+    print(f"🔄 需要转换 {len(jobs)} 个剧本...")
+    os.makedirs(output_dir, exist_ok=True)
+
+    written, skipped, failed = [], 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_one, path, info, output_dir, speaker_names) for path, info, _ in jobs]
+        for (_, info, source_hash), future in zip(jobs, futures):
+            scenario_id = info["id"]
+            previous = manifest.get(scenario_id, {})
+            entry = {"source_hash": source_hash, "glossary_hash": glossary_hash}
+            try:
+                _, out_name, count = future.result()
+            except Exception as e:
+                manifest[scenario_id] = {**entry, "status": "failed", "error": str(e)}
+                failed += 1
+                print(f"   ❌ 转换失败: {scenario_id} ({e})")
+                continue
+
+            if not out_name:
+                # 剧本更新后没有对白了：旧的记忆文件也要删掉，否则还会被建进向量库
+                stale = previous.get("output") and os.path.join(output_dir, previous["output"])
+                if stale and os.path.exists(stale):
+                    os.remove(stale)
+                manifest[scenario_id] = {**entry, "status": "skipped"}
+                skipped += 1
+                print(f"   ⚠️ 跳过: {scenario_id} (没有可用的对白)")
+                continue
+
+            manifest[scenario_id] = {**entry, "status": "ok", "output": out_name}
+            written.append(out_name)
+            print(f"   📝 {scenario_id} -> {out_name} ({count} 句台词)")
+
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+    print(f"🎉 转换完成: {len(written)} 个记忆文件已写入 {output_dir} (跳过 {skipped} 个, 失败 {failed} 个)")
+    if failed:
+        print("   失败的剧本已记入清单，修复后用 --force 重新转换。")
+    print("请运行 'python build_vector_db.py --incremental' 增量更新向量库。")
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把下载的剧本 JSON 转换为带标签的记忆文件")
+    parser.add_argument("--raw", default=RAW_DIR, help="剧本 JSON 目录")
+    parser.add_argument("--output", default=DATA_SOURCE_DIR, help="记忆文件输出目录")
+    parser.add_argument("--workers", type=int, default=None, help="并行进程数 (默认 CPU 核数)")
+    parser.add_argument("--force", action="store_true", help="忽略哈希，全部重新转换 (包括之前跳过或失败的剧本)")
+    parser.add_argument("--glossary", default=GLOSSARY_FILE, help="世界观字典，用于把说话人换成中文简称")
+    args = parser.parse_args()
+
+    process_scenarios(args.raw, args.output, args.workers, args.force, args.glossary)
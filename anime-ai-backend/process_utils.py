@@ -0,0 +1,47 @@
+# process_utils.py
+# 压测脚本共用的子进程管理：在后台启动服务、等待 /health 就绪、结束进程、读取常驻内存
+import os
+import time
+import subprocess
+
+import httpx
+
+CURRENT_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def rss_mb(pid="self"):
+    """进程常驻内存 (MB)，默认为当前进程；仅 Linux，读取失败时返回 0.0"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def wait_ready(url, timeout=300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(1)
+    return False
+
+
+def start(cmd, env):
+    return subprocess.Popen(cmd, cwd=CURRENT_SCRIPT_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop(proc):
+    if proc and proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=20)
+        except subprocess.TimeoutExpired:
+            proc.kill()
@@ -0,0 +1,134 @@
+# request_metrics.py
+# 按路径 / 阶段统计请求量与延迟分位数 (滑动窗口)，供 /metrics 使用；
+# 以及单个请求内各阶段的耗时 (写进 Server-Timing 响应头)
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Counters:
+    """一组命名计数器，多个请求线程同时累加也不会丢计数"""
+
+    def __init__(self, *names):
+        self._counts = dict.fromkeys(names, 0)
+        self._lock = threading.Lock()
+
+    def add(self, name, n=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class LatencyStats:
+    """一个路径的累计次数 + 最近 window 个样本的延迟分位数，线程安全"""
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+
+    def metrics(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total = self.count, self.total
+        return {
+            "count": count,
+            "avg_ms": round(total / count * 1000, 1) if count else None,
+            "p50_ms": round(percentile(samples, 0.50) * 1000, 1) if samples else None,
+            "p95_ms": round(percentile(samples, 0.95) * 1000, 1) if samples else None,
+            "p99_ms": round(percentile(samples, 0.99) * 1000, 1) if samples else None,
+        }
+
+
+class PathMetrics:
+    """多个路径 (如 chitchat / rag) 的延迟统计与流量占比 (with_share=False 时不计算占比)"""
+
+    def __init__(self, window=1000, with_share=True):
+        self.window = window
+        self.with_share = with_share
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    def record(self, path, seconds):
+        with self._lock:
+            stats = self._paths.get(path)
+            if stats is None:
+                stats = self._paths[path] = LatencyStats(self.window)
+        stats.record(seconds)
+
+    def metrics(self):
+        with self._lock:
+            paths = dict(self._paths)
+        result = {name: stats.metrics() for name, stats in paths.items()}
+        if not self.with_share:
+            return result
+        total = sum(m["count"] for m in result.values()) or 1
+        for m in result.values():
+            m["share"] = round(m["count"] / total, 3)
+        return result
+
+
+# ==================== 单个请求的分阶段计时 ====================
+_current_timer = contextvars.ContextVar("stage_timer", default=None)
+
+
+class StageTimer:
+    """记录一个请求内各阶段的耗时 (秒)，同名阶段累加"""
+
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Server-Timing 响应头，如 "rewrite;dur=412.3, router;dur=380.1, total;dur=1503.9" """
+        items = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        items.append(f"total;dur={self.total() * 1000:.1f}")
+        return ", ".join(items)
+
+
+@contextmanager
+def request_timer():
+    """在处理请求的线程里开启计时，期间 stage() 记录到这个计时器上"""
+    timer = StageTimer()
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """计时一个阶段；不在 request_timer() 内时什么也不做"""
+    timer = _current_timer.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.add(name, time.perf_counter() - started)
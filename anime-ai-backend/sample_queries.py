@@ -0,0 +1,16 @@
+# sample_queries.py
+# 压测与模型校验共用的示例查询 (不依赖任何模型或服务，可随意 import)
+
+QUERIES = [
+    "丸山彩的自我介绍",
+    "千圣对彩有多严格",
+    "日菜和纱夜是怎么和好的",
+    "彩在快餐店打工的事",
+    "Pastel*Palettes 第一次演出发生了什么",
+    "彩为什么想成为偶像",
+    "伊芙的武士道",
+    "麻弥喜欢什么器材",
+]
+
+# onnx_embeddings.py validate 额外加入几条细节类问题，排序差异更容易暴露
+VALIDATION_QUERIES = QUERIES + ["千圣的狗叫什么名字", "彩讨厌吃什么", "麻弥的口头禅", "日菜对姐姐的感情"]
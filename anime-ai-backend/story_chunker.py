@@ -0,0 +1,143 @@
+# story_chunker.py
+# 结构感知切分：解析剧情档案的头部标签与【章节】，按章节对齐生成片段
+import re
+
+from langchain_core.documents import Document
+
+from story_index import canonical_file_id, character_key, file_metadata
+
+# 单个片段的最大字数 (超长章节才会被继续切分，且不重叠)
+MAX_CHUNK_CHARS = 600
+
+# 头部标签: [关键人物: 彩, 千圣]
+HEADER_PATTERN = re.compile(r'^\[([^:：\]]+)[:：]\s*(.*?)\]?$')
+# 章节标题: 【千圣酱的魔鬼训练】
+SECTION_PATTERN = re.compile(r'^【(.+)】$')
+# 整理资料时残留的引用标记，对检索毫无帮助，只会浪费 token
+CITE_PATTERN = re.compile(r'\[cite_start\]|\[cite:\s*[\d,\s]*\]')
+# 超长段落按句子切开
+SENTENCE_PATTERN = re.compile(r'(?<=[。！？!?…])')
+
+# 头部标签 -> metadata 字段
+TAG_FIELDS = {
+    "ID": "story_id",
+    "档案类型": "stage",
+    "剧情阶段": "stage",
+    "关键人物": "characters",
+    "核心事件": "event",
+    "核心数据": "event",
+}
+
+
+def normalize_character(name):
+    """'步美 (Ayumi)' / '真白(Mashiro)' -> '步美' / '真白'"""
+    return re.split(r'\s*[（(]', name.strip(), maxsplit=1)[0].strip()
+
+
+def parse_story_file(text):
+    """
+    拆出头部标签和章节。
+    返回 (tags, sections)：tags 为 {标签名: 内容}，sections 为 [(章节标题, 正文行列表)]。
+    第一个【标题】之前的正文归入标题为空的章节。
+    """
+    tags = {}
+    sections = []
+    title, body = "", []
+    in_header = True
+
+    for raw_line in text.splitlines():
+        line = CITE_PATTERN.sub("", raw_line).strip()
+        if not line:
+            continue
+
+        if in_header:
+            match = HEADER_PATTERN.match(line)
+            if match:
+                tags[match.group(1).strip()] = match.group(2).strip()
+                continue
+            in_header = False
+
+        match = SECTION_PATTERN.match(line)
+        if match:
+            if title or body:
+                sections.append((title, body))
+            title, body = match.group(1).strip(), []
+            continue
+
+        body.append(line)
+
+    if title or body:
+        sections.append((title, body))
+    return tags, sections
+
+
+def split_long_line(line, limit):
+    """单行超过上限时按句子切开，实在切不开再硬切"""
+    pieces, current = [], ""
+    for sentence in SENTENCE_PATTERN.split(line):
+        while len(sentence) > limit:
+            pieces.append(sentence[:limit])
+            sentence = sentence[limit:]
+        if current and len(current) + len(sentence) > limit:
+            pieces.append(current)
+            current = ""
+        current += sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def chunk_section(title, lines, limit=MAX_CHUNK_CHARS):
+    """
+    章节不超过上限时整体作为一个片段；
+    否则按行贪心装箱，续片段重复章节标题以保留上下文，片段之间不重叠。
+    """
+    heading = f"【{title}】" if title else ""
+    budget = max(limit - len(heading) - 4, limit // 2)
+
+    units = []
+    for line in lines:
+        units.extend(split_long_line(line, budget) if len(line) > budget else [line])
+
+    chunks, current = [], []
+    size = 0
+    for unit in units:
+        if current and size + len(unit) + 1 > budget:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(unit)
+        size += len(unit) + 1
+    if current:
+        chunks.append(current)
+
+    texts = []
+    for i, chunk in enumerate(chunks):
+        head = heading if i == 0 or not heading else f"{heading}(续)"
+        texts.append("\n".join(([head] if head else []) + chunk))
+    return texts
+
+
+def chunk_story_file(filename, text, file_index, category="aya_memory"):
+    """把一个剧情档案切成按章节对齐、携带人物/事件/章节 metadata 的 Document 列表"""
+    file_id = canonical_file_id(filename)
+    tags, sections = parse_story_file(text)
+
+    base_meta = {**file_metadata(file_id, file_index), "category": category}
+    for tag, field in TAG_FIELDS.items():
+        if tags.get(tag) and field not in base_meta:
+            base_meta[field] = tags[tag]
+
+    # Chroma 的 metadata 只支持标量，人物列表额外展开成布尔字段，便于按人物过滤
+    characters = [normalize_character(n) for n in re.split(r'[,，、]', tags.get("关键人物", ""))]
+    for name in filter(None, characters):
+        base_meta[character_key(name)] = True
+
+    docs = []
+    for section_idx, (title, lines) in enumerate(sections):
+        for part_idx, content in enumerate(chunk_section(title, lines)):
+            metadata = {**base_meta, "section": title, "section_idx": section_idx, "part_idx": part_idx}
+            docs.append(Document(
+                page_content=f"【记忆来源：{filename}】\n{content}",
+                metadata=metadata,
+            ))
+    return docs
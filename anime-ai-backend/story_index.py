@@ -0,0 +1,302 @@
+# story_index.py
+# 剧情文件的统一命名空间：构建端 (build_vector_db.py) 与查询端 (main.py / app.py) 共用
+import os
+import re
+import json
+
+# 路由索引每一行的格式: "- B0.txt: 角色档案 / ..."
+INDEX_LINE_PATTERN = re.compile(r'^-\s*([^:：\s]+)\s*[:：]')
+# 与 index_map.txt 同目录的构建清单，记录增量构建后固定下来的 file_idx
+# (xxx_index_map.txt 对应 xxx_build_manifest.json)
+INDEX_MAP_SUFFIX = "index_map.txt"
+BUILD_MANIFEST_SUFFIX = "build_manifest.json"
+# 从路由输出里切出候选 token (文件名、ID)
+ROUTER_TOKEN_PATTERN = re.compile(r'[A-Za-z0-9_\-]+')
+
+
+def canonical_file_id(name):
+    """
+    把各种写法的文件名统一成规范 ID。
+    "B2.txt" / "data_source/B2.txt" / "data_source\\B2.txt" / "B2" -> "B2"
+    """
+    base = re.split(r'[\\/]', name.strip().strip('"\'`'))[-1]
+    stem, ext = os.path.splitext(base)
+    if ext.lower() == ".txt":
+        return stem
+    return base
+
+
+def build_manifest_path(index_map_path):
+    """index_map.txt 对应的构建清单路径"""
+    directory, name = os.path.split(index_map_path)
+    if name.endswith(INDEX_MAP_SUFFIX):
+        name = name[:-len(INDEX_MAP_SUFFIX)] + BUILD_MANIFEST_SUFFIX
+    else:
+        name = f"{name}.{BUILD_MANIFEST_SUFFIX}"
+    return os.path.join(directory, name)
+
+
+def load_index_map(index_map_path):
+    """
+    读取 index_map.txt。
+    返回 (原始文本, {file_id: file_idx})。file_idx 优先取同目录构建清单中的记录
+    (增量构建删除文件后行号会出现空洞)，没有清单时即该文件在索引表中的行号。
+    """
+    if not os.path.exists(index_map_path):
+        return "", {}
+
+    with open(index_map_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+
+    file_index = {}
+    for line in text.splitlines():
+        match = INDEX_LINE_PATTERN.match(line.strip())
+        if match:
+            file_id = canonical_file_id(match.group(1))
+            file_index.setdefault(file_id, len(file_index))
+
+    manifest_path = build_manifest_path(index_map_path)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            recorded = json.load(f).get("files", {})
+        file_index = {i: recorded[i]["idx"] if i in recorded else idx for i, idx in file_index.items()}
+    return text, file_index
+
+
+def parse_router_output(router_text, file_index):
+    """
+    把 Router (LLM) 的输出解析成规范 ID 列表，只保留 index_map 中真实存在的文件。
+    无法识别或输出 NONE 时返回空列表。
+    """
+    if not router_text:
+        return []
+
+    file_ids = []
+    for token in ROUTER_TOKEN_PATTERN.findall(router_text.replace(".txt", " ")):
+        file_id = canonical_file_id(token)
+        if file_id in file_index and file_id not in file_ids:
+            file_ids.append(file_id)
+    return file_ids
+
+
+def restrict_index_map(index_text, file_index, file_ids):
+    """
+    把路由索引限定在 file_ids 上 (角色注册表里的 file_ids)，返回 (索引文本, {file_id: file_idx})。
+    file_idx 保持原值，与向量库里的 metadata 一致；file_ids 为 None 时原样返回。
+    """
+    if file_ids is None:
+        return index_text, file_index
+    allowed = {canonical_file_id(i) for i in file_ids}
+    file_index = {i: idx for i, idx in file_index.items() if i in allowed}
+    index_text = "\n".join(
+        line for line in index_text.splitlines()
+        if parse_router_output(line.split(":", 1)[0], file_index)
+    )
+    return index_text, file_index
+
+
+def build_file_filter(file_ids, legacy=False):
+    """
+    生成 Chroma 的 metadata 过滤条件。
+    新版数据库按 file_id 精确匹配；legacy=True 时兼容只有 source 字段的旧库。
+    """
+    key = "source" if legacy else "file_id"
+    values = [f"{i}.txt" for i in file_ids] if legacy else list(file_ids)
+
+    if len(values) == 1:
+        return {key: values[0]}
+    return {key: {"$in": values}}
+
+
+def character_key(name):
+    """人物在 metadata 中对应的布尔字段名，如 千圣 -> char:千圣"""
+    return f"char:{name}"
+
+
+def build_character_filter(name):
+    """只检索关键人物中包含 name 的档案片段"""
+    return {character_key(name): True}
+
+
+def combine_filters(*filters):
+    """把多个过滤条件用 $and 合并，忽略空条件"""
+    filters = [f for f in filters if f]
+    if not filters:
+        return None
+    if len(filters) == 1:
+        return filters[0]
+    return {"$and": filters}
+
+
+def file_metadata(file_id, file_index):
+    """构建时写入每个片段的基础 metadata"""
+    return {
+        "source": f"{file_id}.txt",
+        "file_id": file_id,
+        "file_idx": file_index[file_id],
+    }
+
+
+# ==================== 本地关键词路由 (降级模式下代替 LLM Router) ====================
+# 字典里的昵称行: "- 香澄 / Kasumi / ksm = 户山香澄 (Popipa主唱/吉他)"
+GLOSSARY_ALIAS_PATTERN = re.compile(r'^-\s*(.+?)\s*=\s*([^(（]+)')
+# 英文短语内部的逗号 ("Hello, Happy World!") 不切开，否则 "hello" 会被当成一个人物/事件词条
+SUMMARY_TERM_SPLIT = re.compile(r'[/，、()（）]|(?<![A-Za-z]),|,(?!\s*[A-Za-z])')
+# 单字昵称 (心 / 熊 / 兰 ...) 会作为普通汉字出现在句子里，只在被空格或标点隔开时才算提到
+SHORT_ALIAS_MIN_LEN = 2
+QUERY_TOKEN_SPLIT = re.compile(r'[\W_]+')
+# 关键词路由的最低命中分：词条命中按字数计分，共有的中文二元组每个 0.5 分。
+# 低于此分的文件不参与路由 (寒暄、"哈哈好可爱" 之类只有一两个字巧合的查询)，全部不足时返回空列表
+KEYWORD_ROUTE_MIN_SCORE = 1.5
+
+
+def parse_glossary_aliases(glossary_text):
+    """从世界观字典解析 {昵称(小写): [全名, 昵称...]}，用于在不调用 LLM 时展开查询里的简称"""
+    aliases = {}
+    for line in glossary_text.splitlines():
+        match = GLOSSARY_ALIAS_PATTERN.match(line.strip())
+        if not match:
+            continue
+        names = [n.strip() for n in match.group(1).split("/") if n.strip()]
+        expansion = [match.group(2).strip()] + names
+        for name in names:
+            aliases.setdefault(name.lower(), expansion)
+    return aliases
+
+
+def mentioned_aliases(query, aliases):
+    """
+    查询里提到的昵称，按字典顺序返回 [(昵称, 展开)]。
+    两个字以上的昵称按子串匹配；单字昵称必须是一个独立的 token ("兰？" 算，"开心" 里的 "心" 不算)。
+    """
+    lowered = query.lower()
+    tokens = set(QUERY_TOKEN_SPLIT.split(lowered))
+    return [
+        (alias, names) for alias, names in aliases.items()
+        if (alias in tokens if len(alias) < SHORT_ALIAS_MIN_LEN else alias in lowered)
+    ]
+
+
+def _bigrams(text):
+    text = re.sub(r'\s+', '', text.lower())
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _route_bigrams(text):
+    """路由打分只看含中文的二元组，英文字母组合 ("ll" / "lo") 太容易巧合"""
+    return {b for b in _bigrams(text) if not b.isascii()}
+
+
+def build_keyword_index(index_text, file_index):
+    """把 index_map.txt 的每一行预处理成 (file_id, 关键词列表, 字符二元组)"""
+    entries = []
+    for line in index_text.splitlines():
+        match = INDEX_LINE_PATTERN.match(line.strip())
+        if not match:
+            continue
+        file_id = canonical_file_id(match.group(1))
+        if file_id not in file_index:
+            continue
+        description = line.split(":", 1)[1] if ":" in line else line.split("：", 1)[-1]
+        terms = [t.strip(" .…") for t in SUMMARY_TERM_SPLIT.split(description)]
+        terms = [t.lower() for t in terms if t and t not in ("本人", "角色档案", "剧情档案")]
+        entries.append((file_id, terms, _route_bigrams(description)))
+    return entries
+
+
+def keyword_route(query, keyword_index, aliases=None, limit=3):
+    """
+    不调用 LLM 的路由：按 人物/事件关键词命中 (权重为词长) + 字符二元组重合 给文件打分，
+    返回得分不低于最高分一半的前 limit 个规范 ID。
+    得分低于 KEYWORD_ROUTE_MIN_SCORE 的文件不参与，全部不足时返回空列表，由调用方不限范围检索。
+    """
+    expanded = query.lower()
+    for _, names in mentioned_aliases(query, aliases or {}):
+        expanded += " " + " ".join(names).lower()
+    query_bigrams = _route_bigrams(expanded)
+
+    scored = []
+    for file_id, terms, bigrams in keyword_index:
+        score = sum(len(t) for t in terms if t in expanded) + 0.5 * len(query_bigrams & bigrams)
+        if score >= KEYWORD_ROUTE_MIN_SCORE:
+            scored.append((score, file_id))
+    if not scored:
+        return []
+
+    scored.sort(key=lambda x: -x[0])
+    best = scored[0][0]
+    return [file_id for score, file_id in scored[:limit] if score >= best / 2]
+
+
+def query_similarity(a, b):
+    """两条查询的字符二元组 Jaccard 相似度 (0~1)，用于判断重写前后的查询是否仍然接近"""
+    if a.strip() == b.strip():
+        return 1.0
+    x, y = _bigrams(a), _bigrams(b)
+    if not x or not y:
+        return 0.0
+    return len(x & y) / len(x | y)
+
+
+def index_character_names(keyword_index):
+    """索引表里出现过的全部词条 (含各档案的关键人物)，用来判断一个名字是否是可过滤的人物"""
+    return {t for _, terms, _ in keyword_index for t in terms}
+
+
+def self_alias_names(aliases, full_name):
+    """字典里指向 full_name 的全部称呼 (角色自己)，检索按人物缩小范围时要排除"""
+    return {n for names in aliases.values() if names[0] == full_name for n in names}
+
+
+def query_characters(query, aliases, known_names, exclude=()):
+    """
+    查询中提到的人物，返回它们在 [关键人物] 标签里的写法 (即 char:<name> 字段名中的 name)。
+    昵称经字典展开后，按 简称 -> 其它昵称 -> 全名 的顺序取第一个在索引表里出现过的名字
+    (标签里写的是简称)；乐队名等非人物词条不会命中。
+    """
+    found = []
+    for _, names in mentioned_aliases(query, aliases):
+        name = next((n for n in names[1:] + names[:1] if n.lower() in known_names), None)
+        if name and name not in exclude and name not in found:
+            found.append(name)
+    return found
+
+
+def doc_has_characters(doc, names):
+    """片段所属档案的关键人物是否包含 names 中的全部人物"""
+    return all(doc.metadata.get(character_key(n)) for n in names)
+
+
+def doc_file_id(doc):
+    """检索结果片段所属的规范文件 ID (兼容只有 source 字段的旧库)"""
+    return doc.metadata.get("file_id") or canonical_file_id(doc.metadata.get("source", ""))
+
+
+def fill_docs(primary, extra, k):
+    """primary 在前，用 extra 中未出现过的片段补足 k 条"""
+    result = list(primary[:k])
+    seen = {(doc_file_id(d), d.page_content) for d in result}
+    for doc in extra:
+        if len(result) >= k:
+            break
+        key = (doc_file_id(doc), doc.page_content)
+        if key not in seen:
+            seen.add(key)
+            result.append(doc)
+    return result
+
+
+def scoped_search(vector_db, query, k, file_ids, names=(), legacy=False):
+    """
+    在 file_ids 范围内检索。names 非空时优先取关键人物包含这些人物的档案片段，
+    不足 k 条再用同一范围内的其它片段补齐；旧库没有人物字段，直接按文件检索。
+    """
+    file_filter = build_file_filter(file_ids, legacy=legacy)
+    if not names or legacy:
+        return vector_db.similarity_search(query, k=k, filter=file_filter)
+
+    character_filter = combine_filters(file_filter, *[build_character_filter(n) for n in names])
+    docs = vector_db.similarity_search(query, k=k, filter=character_filter)
+    if len(docs) < k:
+        docs = fill_docs(docs, vector_db.similarity_search(query, k=k, filter=file_filter), k)
+    return docs
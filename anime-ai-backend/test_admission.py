@@ -0,0 +1,110 @@
+# test_admission.py
+# 准入控制的单元测试：令牌桶、有界等待队列、降级阈值
+#   python -m pytest -q anime-ai-backend/test_admission.py
+import time
+import threading
+
+import pytest
+
+import admission
+from admission import ConcurrencyLimiter, Overloaded, TokenBucketLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_burst_refill_and_per_client(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    limiter = TokenBucketLimiter(rate=2, burst=3)
+
+    for _ in range(3):
+        limiter.acquire("a")
+    with pytest.raises(Overloaded) as e:
+        limiter.acquire("a")
+    assert e.value.reason == "rate_limited" and e.value.retry_after == 1
+    # 其他客户端不受影响
+    limiter.acquire("b")
+
+    # 0.5 秒补回 1 个令牌
+    clock.now += 0.5
+    limiter.acquire("a")
+    with pytest.raises(Overloaded):
+        limiter.acquire("a")
+    assert limiter.metrics()["rejected"] == 2
+
+
+def test_token_bucket_disabled_with_zero_rate():
+    limiter = TokenBucketLimiter(rate=0, burst=1)
+    for _ in range(100):
+        limiter.acquire("a")
+
+
+def test_queue_full_and_timeout():
+    limiter = ConcurrencyLimiter(max_active=1, max_queue=1, timeout=0.2, degrade_ratio=0.75)
+    limiter.acquire()
+
+    # 第二个请求进入队列，超时后被拒绝
+    errors = []
+
+    def waiter():
+        try:
+            limiter.acquire()
+        except Overloaded as e:
+            errors.append(e.reason)
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    while limiter.waiting == 0:
+        time.sleep(0.001)
+    # 队列已满时立即拒绝
+    with pytest.raises(Overloaded) as e:
+        limiter.acquire()
+    assert e.value.reason == "queue_full"
+    t.join()
+    assert errors == ["queue_timeout"]
+
+    metrics = limiter.metrics()
+    assert metrics["rejected_queue_full"] == 1 and metrics["rejected_timeout"] == 1
+
+
+def test_queued_request_admitted_after_release():
+    limiter = ConcurrencyLimiter(max_active=1, max_queue=1, timeout=5, degrade_ratio=0.75)
+    limiter.acquire()
+    admitted = threading.Event()
+
+    def waiter():
+        limiter.acquire()
+        admitted.set()
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    while limiter.waiting == 0:
+        time.sleep(0.001)
+    limiter.release()
+    t.join(timeout=5)
+    assert admitted.is_set() and limiter.active == 1
+
+
+def test_degrade_threshold_does_not_count_own_slot():
+    # 并发上限为 1：单独一个请求不应被自己触发降级
+    single = ConcurrencyLimiter(max_active=1, max_queue=4, timeout=1, degrade_ratio=0.75)
+    assert not single.under_pressure()
+    single.acquire()
+    assert not single.under_pressure(holding=True)
+    # 进门前看到别人占着名额：有压力
+    assert single.under_pressure()
+
+    # 上限 4、比例 0.75 -> 其他 3 个在途请求时开始降级
+    limiter = ConcurrencyLimiter(max_active=4, max_queue=4, timeout=1, degrade_ratio=0.75)
+    assert limiter.degrade_at == 3
+    for _ in range(3):
+        limiter.acquire()
+    assert not limiter.under_pressure(holding=True)
+    limiter.acquire()
+    assert limiter.under_pressure(holding=True)
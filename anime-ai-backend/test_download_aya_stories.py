@@ -0,0 +1,149 @@
+# test_download_aya_stories.py
+# 下载器的离线测试：本地 http.server 桩服务器模拟 Bestdori，
+# 覆盖 乐队文件名格式记忆 / 重试退避 / 304 条件请求 / 断点续传
+#   python -m pytest -q anime-ai-backend/test_download_aya_stories.py
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import download_aya_stories as dl
+
+
+class StubServer:
+    """
+    routes: {文件名: 响应列表}，每次请求取下一个响应 (最后一个重复使用)；
+    响应为 (状态码, 正文, 响应头)。带 If-None-Match 且与 ETag 相同时回 304。
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = self.path.rsplit("/", 1)[-1]
+                with stub.lock:
+                    stub.requests.append((name, dict(self.headers)))
+                    responses = stub.routes.get(name) or [(404, b"", {})]
+                    status, body, headers = responses.pop(0) if len(responses) > 1 else responses[0]
+                if status == 200 and headers.get("ETag") and self.headers.get("If-None-Match") == headers["ETag"]:
+                    status, body = 304, b""
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/scenario/"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def serve(self, name, *responses):
+        self.routes[name] = list(responses)
+
+    def requested(self):
+        return [name for name, _ in self.requests]
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    stub = StubServer()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff_sleep(monkeypatch):
+    """退避不真的等待，只记录时长"""
+    sleeps = []
+    monkeypatch.setattr(dl.time, "sleep", sleeps.append)
+    monkeypatch.setattr(dl.random, "random", lambda: 0.0)
+    return sleeps
+
+
+def scenario_json(scenario_id):
+    return json.dumps({"Base": {"talkData": [{"body": scenario_id}]}}).encode("utf-8")
+
+
+def write_index(path, scenario_ids, band_id=4):
+    stories = {str(i): {"scenarioId": sid, "title": [f"标题{i}"], "publishedAt": ["1500000000000"]}
+               for i, sid in enumerate(scenario_ids)}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"4": {"bandId": band_id, "subTitle": ["第一章"], "stories": stories}}, f, ensure_ascii=False)
+
+
+def run(server, tmp_path, scenario_ids, **kwargs):
+    index_file = str(tmp_path / "bandstories.json")
+    write_index(index_file, scenario_ids)
+    return dl.download_scripts(base_url=server.base_url, output_dir=str(tmp_path / "out"), workers=1, rate=0,
+                               index_file=index_file, **kwargs)
+
+
+def test_band_format_is_memoised(server, tmp_path):
+    # 这个乐队只有旧格式文件名：第一次探测后，后续剧本直接请求旧格式
+    for n in (1, 2, 3):
+        server.serve(f"004_0{n}.json", (200, scenario_json(f"band4-00{n}"), {}))
+
+    counts = run(server, tmp_path, ["band4-001", "band4-002", "band4-003"])
+
+    assert counts["done"] == 3
+    assert server.requested() == ["band4-001.json", "004_01.json", "004_02.json", "004_03.json"]
+    with open(tmp_path / "out" / dl.MANIFEST_NAME, encoding='utf-8') as f:
+        assert json.load(f)["band_formats"] == {"band4": "legacy"}
+
+
+def test_retries_transient_errors_with_backoff(server, tmp_path, no_backoff_sleep):
+    server.serve("band4-001.json", (503, b"", {}), (502, b"", {}), (200, scenario_json("band4-001"), {}))
+    # 重试耗尽仍是 5xx：判定失败
+    server.serve("band4-002.json", (500, b"", {}))
+
+    counts = run(server, tmp_path, ["band4-001", "band4-002"])
+
+    assert counts == {"done": 1, "skipped": 0, "unchanged": 0, "failed": 1}
+    assert server.requested().count("band4-001.json") == 3
+    assert server.requested().count("band4-002.json") == dl.MAX_RETRIES + 1
+    # 指数退避: BACKOFF_BASE * 2^(n-1)
+    assert no_backoff_sleep[:2] == [dl.BACKOFF_BASE, dl.BACKOFF_BASE * 2]
+
+
+def test_revalidate_sends_conditional_request_and_handles_304(server, tmp_path):
+    server.serve("band4-001.json", (200, scenario_json("band4-001"), {"ETag": '"v1"'}))
+    assert run(server, tmp_path, ["band4-001"])["done"] == 1
+    saved = tmp_path / "out" / "band4-001.json"
+    before = saved.read_bytes()
+
+    counts = run(server, tmp_path, ["band4-001"], revalidate=True)
+
+    assert counts["unchanged"] == 1
+    _, headers = server.requests[-1]
+    assert headers.get("If-None-Match") == '"v1"'
+    assert saved.read_bytes() == before
+
+
+def test_rerun_resumes_only_missing_scenarios(server, tmp_path):
+    server.serve("band4-001.json", (200, scenario_json("band4-001"), {}))
+    server.serve("band4-002.json", (500, b"", {}))
+    first = run(server, tmp_path, ["band4-001", "band4-002"])
+    assert first["done"] == 1 and first["failed"] == 1
+    assert not os.path.exists(tmp_path / "out" / "band4-002.json")
+
+    server.requests.clear()
+    server.serve("band4-002.json", (200, scenario_json("band4-002"), {}))
+    second = run(server, tmp_path, ["band4-001", "band4-002"])
+
+    assert second == {"done": 1, "skipped": 1, "unchanged": 0, "failed": 0}
+    assert server.requested() == ["band4-002.json"]
@@ -0,0 +1,69 @@
+# test_intent_classifier.py
+# 意图分类：判定规则 (拿不准时走 RAG)、标注集与评估；本地缓存了真实模型时在标注集上做开启前的校验
+#   python -m pytest -q anime-ai-backend/test_intent_classifier.py
+import pytest
+
+from intent_classifier import (
+    CHITCHAT, INTENT_CLASSIFIER, LABELLED_SAMPLES, PROTOTYPES, STORY, IntentClassifier, evaluate
+)
+
+
+class LookupEmbeddings:
+    """闲聊原型在第一个坐标轴、剧情原型在第二个坐标轴，其余句子按给定向量"""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_query(self, text):
+        if text in self.vectors:
+            return self.vectors[text]
+        return [1.0, 0.0] if text in PROTOTYPES[CHITCHAT] else [0.0, 1.0]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+
+def test_labelled_samples_are_held_out_and_cover_both_labels():
+    texts = [text for text, _ in LABELLED_SAMPLES]
+    prototypes = {t for examples in PROTOTYPES.values() for t in examples}
+    assert len(set(texts)) == len(texts)
+    assert not set(texts) & prototypes
+    assert {label for _, label in LABELLED_SAMPLES} == {CHITCHAT, STORY}
+
+
+def test_uncertain_messages_go_to_story():
+    classifier = IntentClassifier(LookupEmbeddings({
+        "打招呼": [1.0, 0.1],
+        "拿不准": [1.0, 1.0],
+    }), margin=0.03)
+    assert classifier.classify("打招呼")[0] == CHITCHAT
+    # 两类得分相同 (未领先 margin)：宁可检索
+    assert classifier.classify("拿不准")[0] == STORY
+
+
+def test_evaluate_counts_the_dangerous_direction():
+    samples = [("打招呼", CHITCHAT), ("剧情", STORY), ("像闲聊的剧情", STORY)]
+    classifier = IntentClassifier(LookupEmbeddings({
+        "打招呼": [1.0, 0.0], "剧情": [0.0, 1.0], "像闲聊的剧情": [1.0, 0.0],
+    }))
+    result = evaluate(classifier, samples)
+    assert result["story_as_chitchat"] == 1 and result["chitchat_as_story"] == 0
+    assert result["accuracy"] == pytest.approx(2 / 3)
+
+
+def model_cached(model_name):
+    try:
+        from huggingface_hub import try_to_load_from_cache
+    except ImportError:
+        return False
+    return isinstance(try_to_load_from_cache(model_name, "config.json"), str)
+
+
+@pytest.mark.skipif(not INTENT_CLASSIFIER, reason="INTENT_CLASSIFIER 未开启")
+def test_enabled_classifier_never_skips_story_questions():
+    # 开启分类器的前提：在线上模型上，标注集里没有剧情问题被判成闲聊
+    from vector_backend import EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND, load_embeddings
+    if EMBEDDING_BACKEND == "hf" and not model_cached(EMBEDDING_MODEL_NAME):
+        pytest.skip(f"本地没有缓存 {EMBEDDING_MODEL_NAME}")
+    result = evaluate(IntentClassifier(load_embeddings()))
+    assert result["story_as_chitchat"] == 0, result["errors"]
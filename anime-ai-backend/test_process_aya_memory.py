@@ -0,0 +1,71 @@
+# test_process_aya_memory.py
+# 剧本转换的离线测试：说话人按字典换成中文简称，没有对白 / 转换失败的剧本记入清单后不再重复处理
+#   python -m pytest -q anime-ai-backend/test_process_aya_memory.py
+import os
+import json
+
+import process_aya_memory as pm
+
+GLOSSARY_PATH = os.path.join(os.path.dirname(pm.CURRENT_SCRIPT_DIR), "data_source", "00_glossary.txt")
+
+
+def write_scenario(raw_dir, scenario_id, talks):
+    with open(os.path.join(raw_dir, f"{scenario_id}.json"), 'w', encoding='utf-8') as f:
+        json.dump({"Base": {"talkData": talks}}, f, ensure_ascii=False)
+
+
+def talk(speaker, body):
+    return {"windowDisplayName": speaker, "body": body}
+
+
+def run(raw_dir, out_dir, **kwargs):
+    return pm.process_scenarios(str(raw_dir), str(out_dir), workers=1, glossary_path=GLOSSARY_PATH, **kwargs)
+
+
+def test_speakers_use_glossary_short_names(tmp_path):
+    raw, out = tmp_path / "raw", tmp_path / "out"
+    raw.mkdir()
+    write_scenario(raw, "band4-001", [talk("千聖", "彩ちゃん"), talk("千聖", "行くわよ"),
+                                      talk("イヴ", "ブシドー！"), talk("彩", "うん"), talk("", "（拍手）")])
+
+    assert run(raw, out) == ["E4_001.txt"]
+    text = (out / "E4_001.txt").read_text(encoding='utf-8')
+    assert "[关键人物: 千圣, 伊芙, 彩]" in text
+    assert "千圣：彩ちゃん" in text and "旁白：（拍手）" in text
+
+
+def test_empty_and_broken_scenarios_are_recorded(tmp_path, capsys):
+    raw, out = tmp_path / "raw", tmp_path / "out"
+    raw.mkdir()
+    write_scenario(raw, "band4-001", [talk("彩", "がんばります")])
+    write_scenario(raw, "band4-002", [talk("", "   ")])
+    (raw / "band4-003.json").write_text("{broken", encoding='utf-8')
+
+    assert run(raw, out) == ["E4_001.txt"]
+    manifest = json.loads((raw / pm.CONVERT_MANIFEST_NAME).read_text(encoding='utf-8'))
+    assert {k: v["status"] for k, v in manifest.items()} == {
+        "band4-001": "ok", "band4-002": "skipped", "band4-003": "failed"}
+
+    capsys.readouterr()
+    assert run(raw, out) == []
+    assert "无需转换" in capsys.readouterr().out
+
+    # 剧本更新后没有对白了：旧的记忆文件一并删除
+    write_scenario(raw, "band4-001", [])
+    assert run(raw, out) == []
+    assert not (out / "E4_001.txt").exists()
+
+
+def test_glossary_change_reconverts(tmp_path):
+    raw, out = tmp_path / "raw", tmp_path / "out"
+    raw.mkdir()
+    write_scenario(raw, "band4-001", [talk("千聖", "ええ")])
+    glossary = tmp_path / "glossary.txt"
+    glossary.write_text("", encoding='utf-8')
+
+    pm.process_scenarios(str(raw), str(out), workers=1, glossary_path=str(glossary))
+    assert "[关键人物: 千聖]" in (out / "E4_001.txt").read_text(encoding='utf-8')
+
+    glossary.write_text("- 千圣 / Chisato / 千聖 = 白鹭千圣 (PasPale贝斯)\n", encoding='utf-8')
+    assert pm.process_scenarios(str(raw), str(out), workers=1, glossary_path=str(glossary)) == ["E4_001.txt"]
+    assert "[关键人物: 千圣]" in (out / "E4_001.txt").read_text(encoding='utf-8')
@@ -0,0 +1,149 @@
+# test_story_index.py
+# 检索范围相关的纯函数测试：人物识别、过滤条件组合、按人物优先 + 按文件补齐的检索、多角色的索引裁剪
+#   python -m pytest -q anime-ai-backend/test_story_index.py
+import os
+
+import numpy as np
+
+import character
+from character import Character, get_character, register_character
+from story_index import (
+    build_character_filter, build_file_filter, build_keyword_index, combine_filters, index_character_names,
+    keyword_route, load_index_map, parse_glossary_aliases, parse_router_output, query_characters, restrict_index_map,
+    scoped_search, self_alias_names
+)
+from vector_bundle import BundleVectorStore, write_bundle
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+GLOSSARY_PATH = os.path.join(BACKEND_DIR, "..", "data_source", "00_glossary.txt")
+INDEX_MAP_PATH = os.path.join(BACKEND_DIR, "chroma_db", "index_map.txt")
+
+
+def load_aya_lookup():
+    with open(GLOSSARY_PATH, 'r', encoding='utf-8') as f:
+        aliases = parse_glossary_aliases(f.read())
+    index_text, file_index = load_index_map(INDEX_MAP_PATH)
+    names = index_character_names(build_keyword_index(index_text, file_index))
+    return aliases, names, self_alias_names(aliases, "丸山彩")
+
+
+def test_query_characters_uses_tag_names_and_skips_self():
+    aliases, names, self_names = load_aya_lookup()
+    assert query_characters("千圣对彩有多严格", aliases, names, exclude=self_names) == ["千圣"]
+    # 昵称展开成 [关键人物] 里的写法
+    assert query_characters("ksm和日菜一起做过什么", aliases, names, exclude=self_names) == ["香澄", "日菜"]
+    # 乐队名不是人物
+    assert query_characters("PasPale 第一次演出发生了什么", aliases, names, exclude=self_names) == []
+
+
+def test_query_characters_ignores_single_char_aliases_inside_words():
+    aliases, names, self_names = load_aya_lookup()
+    # "开心" 里的 "心" 不是弦卷心
+    assert query_characters("彩最开心的一次演出是哪次", aliases, names, exclude=self_names) == []
+    # "熊猫" 里的 "熊" 不是美咲 (米歇尔)
+    assert query_characters("千圣带彩去看熊猫", aliases, names, exclude=self_names) == ["千圣"]
+    # "灯光" / "巴士" 里的单字同理
+    assert query_characters("演出时灯光坏了，大家坐巴士回去", aliases, names, exclude=self_names) == []
+    # 单独出现的单字昵称仍然算
+    assert query_characters("兰？她和彩熟吗", aliases, names, exclude=self_names) == ["兰"]
+
+
+def test_keyword_route_needs_a_real_hit():
+    aliases, _, _ = load_aya_lookup()
+    index_text, file_index = load_index_map(INDEX_MAP_PATH)
+    keyword_index = build_keyword_index(index_text, file_index)
+    assert keyword_route("千圣的狗叫什么名字", keyword_index, aliases) == ["B1"]
+    assert keyword_route("你们拍丧尸电影那次发生了什么", keyword_index, aliases) == ["A10"]
+    # 只有英文字母或一两个字巧合：不限范围
+    for query in ["hello", "哈哈哈好可爱", "我今天心情不好", "她们之前为什么吵架"]:
+        assert keyword_route(query, keyword_index, aliases) == [], query
+
+
+def test_combined_filter_shape():
+    assert combine_filters(build_file_filter(["B2"]), build_character_filter("千圣")) == {
+        "$and": [{"file_id": "B2"}, {"char:千圣": True}]
+    }
+    assert combine_filters(build_file_filter(["B2", "B7"]), None) == {"file_id": {"$in": ["B2", "B7"]}}
+    assert combine_filters() is None
+
+
+class AxisEmbeddings:
+    """查询向量固定为第一个坐标轴，片段与查询的距离只由构造时给定的向量决定"""
+
+    def embed_query(self, text):
+        return [1.0, 0.0]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+
+def test_scoped_search_prefers_characters_then_fills(tmp_path):
+    # B1 有千圣 (离查询较远)，B2 没有 (离查询更近)
+    documents = [f"B1-{i}" for i in range(3)] + [f"B2-{i}" for i in range(5)]
+    metadatas = ([{"file_id": "B1", "file_idx": 0, "part_idx": i, "char:千圣": True} for i in range(3)]
+                 + [{"file_id": "B2", "file_idx": 1, "part_idx": i} for i in range(5)])
+    vectors = [[0.5, 0.1 * i] for i in range(3)] + [[1.0, 0.1 * i] for i in range(5)]
+    path = str(tmp_path / "test.bundle")
+    write_bundle(path, np.asarray(vectors), documents, metadatas, {"B1": 0, "B2": 1}, dtype="float32")
+    store = BundleVectorStore(path, AxisEmbeddings())
+
+    docs = scoped_search(store, "千圣", 4, ["B1", "B2"], ["千圣"])
+    assert [d.page_content for d in docs] == ["B1-0", "B1-1", "B1-2", "B2-0"]
+
+    # 不指定人物 / 旧库：只按文件过滤
+    plain = [d.page_content for d in scoped_search(store, "千圣", 4, ["B1", "B2"])]
+    assert plain == ["B2-0", "B2-1", "B2-2", "B2-3"]
+
+
+def test_bundle_stores_parsed_aliases(tmp_path):
+    with open(GLOSSARY_PATH, 'r', encoding='utf-8') as f:
+        glossary = f.read()
+    path = str(tmp_path / "aliases.bundle")
+    write_bundle(path, np.zeros((1, 2)), ["x"], [{"file_id": "B1"}], {"B1": 0}, glossary_text=glossary)
+    store = BundleVectorStore(path, AxisEmbeddings())
+    assert "aliases" in store.header["sections"]
+    assert store.aliases() == parse_glossary_aliases(glossary)
+
+
+def test_second_character_scopes_index_and_filters(monkeypatch):
+    # 第二个角色与彩共用 collection，只能看到自己的几个档案；走与 main.CharacterRuntime 相同的构建步骤
+    monkeypatch.setattr(character, "CHARACTERS", dict(character.CHARACTERS))
+    register_character(Character(
+        key="chisato", name="白鹭千圣", short_name="白鹭千圣", band="Pastel*Palettes",
+        system_prompt="", speech_style="", fallback_reply="", error_reply="",
+        collection_name="aya_memory_v3", index_map_path=INDEX_MAP_PATH, glossary_path=GLOSSARY_PATH,
+        file_ids=["A1", "A10"],
+    ))
+    chisato = get_character("chisato")
+    assert get_character().key == "aya"
+
+    index_text, file_index = load_index_map(chisato.index_map_path)
+    scoped_text, scoped_index = restrict_index_map(index_text, file_index, chisato.file_ids)
+    # file_idx 保持原值，与向量库 metadata 一致
+    assert scoped_index == {i: file_index[i] for i in ["A1", "A10"]}
+    assert [line.split(":")[0] for line in scoped_text.splitlines()] == ["- A1.txt", "- A10.txt"]
+    assert restrict_index_map(index_text, file_index, None) == (index_text, file_index)
+
+    # Router 选中范围外的文件会被丢弃
+    assert parse_router_output("A10.txt, B2.txt", scoped_index) == ["A10"]
+
+    with open(chisato.glossary_path, 'r', encoding='utf-8') as f:
+        aliases = parse_glossary_aliases(f.read())
+    names = index_character_names(build_keyword_index(scoped_text, scoped_index))
+    self_names = self_alias_names(aliases, chisato.short_name)
+    assert {"千圣", "cst"} <= self_names
+    # 千圣自己的称呼不参与过滤，其他人物照常按 [关键人物] 标签过滤
+    people = query_characters("千圣和美咲在商场整蛊了谁", aliases, names, exclude=self_names)
+    assert people == ["美咲"]
+    assert combine_filters(build_file_filter(["A10"]), build_character_filter(people[0])) == {
+        "$and": [{"file_id": "A10"}, {"char:美咲": True}]
+    }
+
+def test_bundle_norms_match_stored_precision(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((5, 16)).astype(np.float32)
+    path = str(tmp_path / "fp16.bundle")
+    write_bundle(path, vectors, ["x"] * 5, [{"file_id": "B1"}] * 5, {"B1": 0}, dtype="float16")
+    store = BundleVectorStore(path, AxisEmbeddings())
+    widened = np.asarray(store.vectors, dtype=np.float32)
+    np.testing.assert_array_equal(store.sq_norms, (widened ** 2).sum(axis=1))
@@ -0,0 +1,160 @@
+# vector_backend.py
+# 向量检索后端：进程内 (每个 worker 自己加载模型) 或 sidecar (所有 worker 共用一个检索服务)
+import os
+
+import httpx
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from embedding_batcher import MicroBatchEmbeddings
+from vector_bundle import BundleVectorStore
+
+# 构建与查询必须使用同一个模型
+EMBEDDING_MODEL_NAME = "shibing624/text2vec-base-chinese"
+
+# hf: PyTorch fp32 (HuggingFaceEmbeddings)；onnx: ONNX Runtime (见 onnx_embeddings.py)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "hf")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_text2vec"))
+ONNX_MODEL_FILE = os.getenv("ONNX_MODEL_FILE", "model.int8.onnx")
+ONNX_NUM_THREADS = int(os.getenv("ONNX_NUM_THREADS", "0")) or None
+
+# local: 进程内加载 Embedding + Chroma；sidecar: 通过 vector_service.py 检索；
+# bundle: 检索 mmap 映射的二进制向量包 (见 vector_bundle.py)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "local")
+# bundle 模式下查询向量的来源 — local: 进程内加载 Embedding 模型；
+# remote: 由 sidecar 的 /embed 计算，worker 启动时只需映射向量包，不加载模型
+BUNDLE_EMBEDDINGS = os.getenv("BUNDLE_EMBEDDINGS", "local")
+# sidecar 地址：优先使用 Unix socket，其次 HTTP
+VECTOR_SERVICE_UDS = os.getenv("VECTOR_SERVICE_UDS", "")
+VECTOR_SERVICE_URL = os.getenv("VECTOR_SERVICE_URL", "http://127.0.0.1:8001")
+VECTOR_SERVICE_TIMEOUT = float(os.getenv("VECTOR_SERVICE_TIMEOUT", "10"))
+
+# 查询向量的动态微批处理 (见 embedding_batcher.py)
+EMBED_BATCH_ENABLED = os.getenv("EMBED_BATCH_ENABLED", "1") == "1"
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", "32"))
+EMBED_BATCH_MAX_WAIT_MS = float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", "3"))
+
+
+def load_hf_embeddings():
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+
+
+def load_embeddings():
+    """按 EMBEDDING_BACKEND 加载 Embedding 模型 (构建与查询共用)"""
+    if EMBEDDING_BACKEND == "onnx":
+        from onnx_embeddings import OnnxEmbeddings
+        return OnnxEmbeddings(ONNX_MODEL_DIR, ONNX_MODEL_FILE, ONNX_NUM_THREADS)
+    return load_hf_embeddings()
+
+
+def describe_embeddings():
+    if EMBEDDING_BACKEND == "onnx":
+        return f"{EMBEDDING_MODEL_NAME} (ONNX: {ONNX_MODEL_FILE})"
+    return EMBEDDING_MODEL_NAME
+
+
+def load_query_embeddings():
+    """服务端查询用的 Embedding：默认套一层微批处理"""
+    base = load_embeddings()
+    if not EMBED_BATCH_ENABLED:
+        return base
+    return MicroBatchEmbeddings(base, EMBED_BATCH_MAX_SIZE, EMBED_BATCH_MAX_WAIT_MS)
+
+
+def embedding_metrics(embeddings):
+    """微批处理的统计数据，未启用时返回 None"""
+    if isinstance(embeddings, MicroBatchEmbeddings):
+        return embeddings.metrics()
+    return None
+
+
+def open_chroma(persist_dir, collection_name, embeddings):
+    from langchain_community.vectorstores import Chroma
+    return Chroma(
+        persist_directory=persist_dir,
+        embedding_function=embeddings,
+        collection_name=collection_name  # 必须与 build_vector_db.py 中的名称一致
+    )
+
+
+def open_bundle(bundle_path, embeddings):
+    store = BundleVectorStore(bundle_path, embeddings)
+    built_with = store.header.get("embedding_model")
+    if built_with and built_with != EMBEDDING_MODEL_NAME:
+        print(f"⚠️ 向量包由 {built_with} 生成，与当前模型 {EMBEDDING_MODEL_NAME} 不一致")
+    return store
+
+
+def sample_metadata(store):
+    """取一条片段的 metadata，用于判断数据库格式 (本地 / 远程通用)"""
+    if isinstance(store, (RemoteVectorStore, BundleVectorStore)):
+        return store.sample_metadata()
+    sample = store._collection.get(limit=1, include=["metadatas"])["metadatas"]
+    return (sample[0] or {}) if sample else None
+
+
+_http_client = None
+
+
+def get_http_client():
+    """所有 RemoteVectorStore 共用一个带连接池的 httpx 客户端 (线程安全)"""
+    global _http_client
+    if _http_client is None:
+        if VECTOR_SERVICE_UDS:
+            _http_client = httpx.Client(
+                transport=httpx.HTTPTransport(uds=VECTOR_SERVICE_UDS),
+                base_url="http://vector-service",
+                timeout=VECTOR_SERVICE_TIMEOUT,
+            )
+        else:
+            _http_client = httpx.Client(base_url=VECTOR_SERVICE_URL, timeout=VECTOR_SERVICE_TIMEOUT)
+    return _http_client
+
+
+class RemoteVectorStore:
+    """
+    sidecar 模式下的向量库代理，只实现 main.py 用到的接口。
+    worker 进程不加载模型，只做 I/O。
+    """
+
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+
+    def _post(self, path, payload):
+        res = get_http_client().post(path, json=payload)
+        res.raise_for_status()
+        return res.json()
+
+    def similarity_search(self, query, k=4, filter=None):
+        return self.batch_similarity_search([query], k=k, filter=filter)[0]
+
+    def batch_similarity_search(self, queries, k=4, filter=None):
+        """多条查询一次请求、一次前向计算"""
+        data = self._post("/search", {
+            "collection": self.collection_name,
+            "queries": list(queries),
+            "k": k,
+            "filter": filter,
+        })
+        return [
+            [Document(page_content=d["page_content"], metadata=d["metadata"]) for d in docs]
+            for docs in data["results"]
+        ]
+
+    def sample_metadata(self):
+        res = get_http_client().get("/info", params={"collection": self.collection_name})
+        res.raise_for_status()
+        return res.json().get("sample_metadata")
+
+
+class RemoteEmbeddings(Embeddings):
+    """sidecar 模式下的 Embedding 代理 (如意图分类需要查询向量时使用)"""
+
+    def embed_documents(self, texts):
+        res = get_http_client().post("/embed", json={"texts": list(texts)})
+        res.raise_for_status()
+        return res.json()["vectors"]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
@@ -0,0 +1,310 @@
+# vector_bundle.py
+# 只读的二进制向量包 (bundle)：一个文件里放齐查询端需要的全部数据，
+#   向量矩阵 (float16/float32) / 片段文本 / 片段 metadata / 路由索引 / 世界观字典 (及解析好的昵称表)
+# 服务端用 mmap 直接映射，不解析 sqlite / HNSW，多个 worker 共享同一份物理内存页。
+#
+# 导出: python build_vector_db.py --export-bundle [--bundle-dtype float16]
+# 使用: VECTOR_BACKEND=bundle python main.py
+#       VECTOR_SERVICE_STORE=bundle python vector_service.py   (sidecar 同样可以挂载向量包)
+#
+# 文件布局 (小端):
+#   MAGIC (8 字节) | version (uint32) | header 长度 (uint32) | header (JSON, UTF-8)
+#   | 按 ALIGNMENT 对齐的各数据段，偏移与长度记录在 header["sections"] 中
+import os
+import json
+import mmap
+import time
+import struct
+
+import numpy as np
+from langchain_core.documents import Document
+
+from story_index import canonical_file_id, parse_glossary_aliases
+
+MAGIC = b"AYAVBNDL"
+BUNDLE_VERSION = 1
+ALIGNMENT = 64
+PREFIX = struct.Struct("<8sII")
+# 暴力检索时每次转换/计算的行数，限制 float16 -> float32 的临时内存
+BLOCK_ROWS = 8192
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _blob(strings):
+    """把字符串列表编码成 (偏移数组, 连续字节串)，第 i 条为 blob[offsets[i]:offsets[i+1]]"""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.uint64)
+    return offsets, b"".join(encoded)
+
+
+def write_bundle(path, embeddings, documents, metadatas, file_index, index_map_text="", glossary_text="",
+                 collection_name="", embedding_model="", dtype="float16"):
+    """
+    把一个 collection 的全部片段写成 bundle。file_index 为路由索引的 {file_id: file_idx}。
+    片段按 (file_idx, section_idx, part_idx) 排序，同一文件的片段在矩阵里连续存放，
+    查询时按文件过滤只需要切片，不需要逐行比较。
+    """
+    if dtype not in ("float16", "float32"):
+        raise ValueError(f"不支持的向量精度: {dtype}")
+
+    metadatas = [dict(m or {}) for m in metadatas]
+    for meta in metadatas:
+        meta.setdefault("file_id", canonical_file_id(meta.get("source", "")))
+
+    order = sorted(range(len(documents)), key=lambda i: (
+        file_index.get(metadatas[i]["file_id"], len(file_index)), metadatas[i]["file_id"],
+        metadatas[i].get("section_idx", 0), metadatas[i].get("part_idx", 0),
+    ))
+    vectors = np.asarray([embeddings[i] for i in order], dtype=np.float32)
+    documents = [documents[i] or "" for i in order]
+    metadatas = [metadatas[i] for i in order]
+
+    count = len(documents)
+    dim = vectors.shape[1] if count else 0
+
+    # 每个文件对应的行区间 [start, end)，没有片段的文件为空区间
+    files = {i: {"idx": idx, "rows": [0, 0]} for i, idx in sorted(file_index.items(), key=lambda x: x[1])}
+    for row, meta in enumerate(metadatas):
+        entry = files.setdefault(meta["file_id"], {"idx": meta.get("file_idx"), "rows": [0, 0]})
+        if entry["rows"] == [0, 0]:
+            entry["rows"] = [row, row]
+        entry["rows"][1] = row + 1
+
+    text_offsets, text_blob = _blob(documents)
+    meta_offsets, meta_blob = _blob([json.dumps(m, ensure_ascii=False) for m in metadatas])
+    # 范数按存储精度计算：查询时点积用的是 float16 还原的向量，两者必须来自同一份数据，否则接近的片段排序会漂移
+    stored = vectors.astype(dtype)
+    sections = {
+        "vectors": stored.tobytes(),
+        # 预先算好 ||d||^2，查询时 L2 距离只剩一次矩阵乘法
+        "sq_norms": (stored.astype(np.float32) ** 2).sum(axis=1).tobytes(),
+        "text_offsets": text_offsets.tobytes(),
+        "text": text_blob,
+        "meta_offsets": meta_offsets.tobytes(),
+        "meta": meta_blob,
+        "index_map": index_map_text.encode("utf-8"),
+        "glossary": glossary_text.encode("utf-8"),
+        # 降级路由用的昵称表在导出时解析好，启动时直接读取
+        "aliases": json.dumps(parse_glossary_aliases(glossary_text), ensure_ascii=False).encode("utf-8"),
+    }
+
+    header = {
+        "version": BUNDLE_VERSION,
+        "collection": collection_name,
+        "embedding_model": embedding_model,
+        "dtype": dtype,
+        "count": count,
+        "dim": dim,
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "files": files,
+        "sections": {},
+    }
+
+    # header 里要写入各段的偏移，而偏移又取决于 header 长度：先按占位长度估算，不够再重算
+    header_room = 4096
+    while True:
+        offset = _align(PREFIX.size + header_room)
+        for name, data in sections.items():
+            header["sections"][name] = [offset, len(data)]
+            offset = _align(offset + len(data))
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        if len(header_bytes) <= header_room:
+            break
+        header_room = _align(len(header_bytes))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(PREFIX.pack(MAGIC, BUNDLE_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, data in sections.items():
+            f.seek(header["sections"][name][0])
+            f.write(data)
+    os.replace(tmp_path, path)
+    return header
+
+
+class BundleVectorStore:
+    """
+    基于 bundle 的只读向量库，接口与 main.py 用到的 Chroma / RemoteVectorStore 保持一致。
+    向量矩阵是 mmap 上的零拷贝视图，float32 包全量检索时也不复制矩阵。
+    """
+
+    def __init__(self, path, embeddings):
+        self.path = path
+        self.embeddings = embeddings
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_len = PREFIX.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"不是有效的向量包: {path}")
+        if version != BUNDLE_VERSION:
+            raise ValueError(f"向量包版本 {version} 与当前程序 ({BUNDLE_VERSION}) 不兼容，请重新导出")
+
+        self.header = json.loads(self._mm[PREFIX.size:PREFIX.size + header_len].decode("utf-8"))
+        count, dim = self.header["count"], self.header["dim"]
+        self.count = count
+        self.vectors = self._array("vectors", self.header["dtype"]).reshape(count, dim)
+        self.sq_norms = self._array("sq_norms", np.float32)
+        self.text_offsets = self._array("text_offsets", np.uint64)
+        self.meta_offsets = self._array("meta_offsets", np.uint64)
+        self.files = self.header["files"]
+
+    def _section(self, name):
+        return self.header["sections"][name]
+
+    def _array(self, name, dtype):
+        offset, length = self._section(name)
+        dtype = np.dtype(dtype)
+        return np.frombuffer(self._mm, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+
+    def _string(self, name, start=0, end=None):
+        offset, length = self._section(name)
+        end = length if end is None else end
+        return self._mm[offset + start:offset + end].decode("utf-8")
+
+    # ---------- 片段 ----------
+    def text(self, row):
+        return self._string("text", int(self.text_offsets[row]), int(self.text_offsets[row + 1]))
+
+    def metadata(self, row):
+        return json.loads(self._string("meta", int(self.meta_offsets[row]), int(self.meta_offsets[row + 1])))
+
+    def document(self, row):
+        return Document(page_content=self.text(row), metadata=self.metadata(row))
+
+    # ---------- 路由索引 / 字典 ----------
+    def index_map(self):
+        """与 story_index.load_index_map 相同的返回格式: (原始文本, {file_id: file_idx})"""
+        file_index = {file_id: entry["idx"] for file_id, entry in self.files.items() if entry["idx"] is not None}
+        return self._string("index_map"), file_index
+
+    def glossary(self):
+        return self._string("glossary")
+
+    def aliases(self):
+        """与 story_index.parse_glossary_aliases 相同的昵称表；早期导出的包没有这一段，现场解析"""
+        if "aliases" in self.header["sections"]:
+            return json.loads(self._string("aliases"))
+        return parse_glossary_aliases(self.glossary())
+
+    def sample_metadata(self):
+        return self.metadata(0) if self.count else None
+
+    # ---------- 过滤 ----------
+    @staticmethod
+    def _file_ids_in(condition):
+        """单个 file_id / source 条件 -> 文件 ID 列表；其他条件返回 None"""
+        if len(condition) != 1:
+            return None
+        (key, value), = condition.items()
+        if key not in ("file_id", "source"):
+            return None
+        if isinstance(value, dict):
+            if set(value) == {"$in"}:
+                value = value["$in"]
+            elif set(value) == {"$eq"}:
+                value = [value["$eq"]]
+            else:
+                return None
+        elif not isinstance(value, list):
+            value = [value]
+        return [canonical_file_id(v) for v in value]
+
+    def _rows_of_files(self, file_ids):
+        ranges = [self.files[i]["rows"] for i in dict.fromkeys(file_ids) if i in self.files]
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, end) for start, end in ranges])
+
+    @classmethod
+    def _match(cls, meta, condition):
+        """在单条 metadata 上求值 Chroma 风格的 where 条件 (用于非文件类过滤)"""
+        if "$and" in condition:
+            return all(cls._match(meta, c) for c in condition["$and"])
+        if "$or" in condition:
+            return any(cls._match(meta, c) for c in condition["$or"])
+        for key, expected in condition.items():
+            value = meta.get(key)
+            if isinstance(expected, dict):
+                (op, operand), = expected.items()
+                ok = {
+                    "$eq": lambda: value == operand,
+                    "$ne": lambda: value != operand,
+                    "$in": lambda: value in operand,
+                    "$nin": lambda: value not in operand,
+                }.get(op, lambda: False)()
+            else:
+                ok = value == expected
+            if not ok:
+                return False
+        return True
+
+    def candidate_rows(self, where=None):
+        """
+        过滤后的候选行，None 表示全部。
+        file_id / source 条件直接换算成行区间；其余条件再逐条解码 metadata 检查。
+        """
+        if not where:
+            return None
+        conditions = where["$and"] if set(where) == {"$and"} else [where]
+
+        rows, rest = None, []
+        for condition in conditions:
+            file_ids = self._file_ids_in(condition)
+            if file_ids is None:
+                rest.append(condition)
+                continue
+            matched = self._rows_of_files(file_ids)
+            rows = matched if rows is None else np.intersect1d(rows, matched)
+
+        if rest:
+            scan = np.arange(self.count) if rows is None else rows
+            meta_filter = {"$and": rest}
+            rows = np.asarray([r for r in scan if self._match(self.metadata(r), meta_filter)], dtype=np.int64)
+        return rows
+
+    # ---------- 检索 ----------
+    def search_by_vectors(self, query_vectors, k=4, where=None):
+        """返回每条查询的 [(行号, L2 距离)]，按距离升序"""
+        q = np.asarray(query_vectors, dtype=np.float32)
+        rows = self.candidate_rows(where)
+        total = self.count if rows is None else len(rows)
+        if total == 0 or k <= 0:
+            return [[] for _ in q]
+
+        # ||q - d||^2 = ||q||^2 - 2 q·d + ||d||^2
+        distances = np.empty((len(q), total), dtype=np.float32)
+        for start in range(0, total, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, total)
+            index = slice(start, end) if rows is None else rows[start:end]
+            block = self.vectors[index].astype(np.float32, copy=False)
+            distances[:, start:end] = self.sq_norms[index][None, :] - 2 * (q @ block.T)
+        distances += (q ** 2).sum(axis=1)[:, None]
+
+        k = min(k, total)
+        results = []
+        for dist in distances:
+            top = np.argpartition(dist, k - 1)[:k]
+            top = top[np.argsort(dist[top])]
+            row_ids = top if rows is None else rows[top]
+            results.append([(int(r), float(dist[t])) for r, t in zip(row_ids, top)])
+        return results
+
+    def similarity_search(self, query, k=4, filter=None):
+        return self.batch_similarity_search([query], k=k, filter=filter)[0]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None):
+        """查询向量已经算好时直接检索 (sidecar 用)"""
+        return [self.document(row) for row, _ in self.search_by_vectors([embedding], k=k, where=filter)[0]]
+
+    def batch_similarity_search(self, queries, k=4, filter=None):
+        vectors = self.embeddings.embed_documents(list(queries))
+        return [
+            [self.document(row) for row, _ in hits]
+            for hits in self.search_by_vectors(vectors, k=k, where=filter)
+        ]
@@ -0,0 +1,131 @@
+# vector_service.py
+# 独立的 Embedding + 向量检索服务 (sidecar)。
+# 多个 FastAPI worker 共用这一个进程里的模型和索引，内存不再随 worker 数线性增长。
+#
+# 启动:
+#   python vector_service.py                         # HTTP: 127.0.0.1:8001
+#   python vector_service.py --uds /tmp/aya_vec.sock  # Unix socket
+#   VECTOR_SERVICE_STORE=bundle python vector_service.py  # 挂载向量包而不是 Chroma
+# 然后以 VECTOR_BACKEND=sidecar 启动 main.py (见 vector_backend.py 的环境变量)；
+# 也可以 VECTOR_BACKEND=bundle BUNDLE_EMBEDDINGS=remote，worker 自己映射向量包，只向这里要查询向量
+import os
+import sys
+import argparse
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from character import CHARACTERS
+from vector_backend import (
+    describe_embeddings, embedding_metrics, load_query_embeddings, open_bundle, open_chroma, sample_metadata
+)
+from process_utils import rss_mb
+from vector_bundle import BundleVectorStore
+
+# chroma: 挂载 Chroma 目录；bundle: 映射 build_vector_db.py --export-bundle 导出的向量包
+VECTOR_SERVICE_STORE = os.getenv("VECTOR_SERVICE_STORE", "chroma")
+
+app = FastAPI()
+
+
+class SearchRequest(BaseModel):
+    collection: str
+    queries: List[str]
+    k: int = 4
+    filter: Optional[dict] = None
+
+
+class EmbedRequest(BaseModel):
+    texts: List[str]
+
+
+# ==================== 资源初始化 ====================
+print("🔄 正在初始化检索服务...")
+try:
+    # 来自不同 worker 的并发查询在这里被微批处理合并
+    embeddings = load_query_embeddings()
+    print(f"✅ Embedding 模型已加载: {describe_embeddings()}")
+except Exception as e:
+    print(f"❌ 模型加载失败: {e}")
+    sys.exit(1)
+
+# 注册表里所有角色用到的 collection 都在这里挂载一次
+STORES = {}
+for character in CHARACTERS.values():
+    if character.collection_name in STORES:
+        continue
+    if VECTOR_SERVICE_STORE == "bundle":
+        if not os.path.exists(character.bundle_path):
+            print(f"⚠️ 未找到向量包 {character.bundle_path}，请先运行 'python build_vector_db.py --export-bundle'")
+            continue
+        STORES[character.collection_name] = open_bundle(character.bundle_path, embeddings)
+        print(f"✅ 已映射: {character.bundle_path}")
+    elif os.path.exists(character.persist_dir):
+        STORES[character.collection_name] = open_chroma(character.persist_dir, character.collection_name, embeddings)
+        print(f"✅ 已挂载: {character.persist_dir} / {character.collection_name}")
+
+
+def get_store(collection):
+    store = STORES.get(collection)
+    if store is None:
+        raise HTTPException(status_code=404, detail=f"未挂载的 collection: {collection}")
+    return store
+
+
+# ==================== API 接口 ====================
+@app.post("/search")
+def search(request: SearchRequest):
+    store = get_store(request.collection)
+    if not request.queries:
+        return {"results": []}
+
+    # 一批查询只做一次前向计算 (并与其他请求的查询合批)
+    vectors = embeddings.embed_documents(request.queries)
+    results = []
+    for vector in vectors:
+        docs = store.similarity_search_by_vector(vector, k=request.k, filter=request.filter)
+        results.append([{"page_content": d.page_content, "metadata": d.metadata} for d in docs])
+    return {"results": results}
+
+
+@app.post("/embed")
+def embed(request: EmbedRequest):
+    return {"vectors": embeddings.embed_documents(request.texts) if request.texts else []}
+
+
+@app.get("/info")
+def info(collection: str):
+    store = get_store(collection)
+    count = store.count if isinstance(store, BundleVectorStore) else store._collection.count()
+    return {"collection": collection, "count": count, "sample_metadata": sample_metadata(store)}
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "store": VECTOR_SERVICE_STORE, "collections": list(STORES), "rss_mb": rss_mb()}
+
+
+@app.get("/metrics")
+def metrics():
+    return {"embedding_batcher": embedding_metrics(embeddings)}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Embedding + 向量检索 sidecar 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--uds", default="", help="监听 Unix socket 路径 (优先于 host/port)")
+    args = parser.parse_args()
+
+    if args.uds:
+        print(f"🚀 启动检索服务: unix:{args.uds}")
+        uvicorn.run(app, uds=args.uds)
+    else:
+        print(f"🚀 启动检索服务: http://{args.host}:{args.port}")
+        uvicorn.run(app, host=args.host, port=args.port)
@@ -1,11 +1,53 @@
 "use client";
 import React, { useEffect, useRef, useState } from "react";
+import { appendUserTurn } from "./chatTurns.mjs";
 
 interface ChatMessage {
   role: "user" | "ai";
   content: string;
 }
 
+interface ChatReply {
+  text: string;
+  emotion: string;
+}
+
+interface InFlight {
+  controller: AbortController;
+  streamId?: string;
+  // 已经输出的回复；被新消息打断时由 handleSend 记入聊天记录
+  partial: string;
+}
+
+// 后端地址，部署时在 .env.local 中设置 NEXT_PUBLIC_API_BASE
+const API_BASE = (process.env.NEXT_PUBLIC_API_BASE || "http://localhost:8000").replace(/\/+$/, "");
+// 流式回复断线后的最大续传次数
+const MAX_RESUME_ATTEMPTS = 3;
+
+// 解析一个 SSE 事件块 ("id: 3\nevent: delta\ndata: {...}")
+const parseEvent = (block: string) => {
+  let id = -1;
+  let event = "message";
+  let data = "";
+  for (const line of block.split("\n")) {
+    if (line.startsWith("id: ")) id = Number(line.slice(4));
+    else if (line.startsWith("event: ")) event = line.slice(7);
+    else if (line.startsWith("data: ")) data += line.slice(6);
+  }
+  return data ? { id, event, data: JSON.parse(data) } : null;
+};
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// 中止请求，并通知后端立即停止生成 (仅断开连接时后端会保留一段时间等待续传)
+const abortInFlight = (current: InFlight | null) => {
+  if (!current) return;
+  current.controller.abort();
+  if (current.streamId) {
+    fetch(`${API_BASE}/chat/stream/${current.streamId}`, { method: "DELETE", keepalive: true }).catch(() => {});
+  }
+};
+
 const Waifu = () => {
   const canvasRef = useRef<HTMLCanvasElement>(null);
   const [model, setModel] = useState<any>(null);
@@ -13,7 +55,16 @@ const Waifu = () => {
   const [chatHistory, setChatHistory] = useState<ChatMessage[]>([]);
   const [isThinking, setIsThinking] = useState(false);
   const [bubbleText, setBubbleText] = useState("丸之山上缤纷彩！我是丸山彩！请多指教！( > < )");
+  // 正在流式生成的回复 (完成后才写入 chatHistory)
+  const [streamingText, setStreamingText] = useState("");
   const messagesEndRef = useRef<HTMLDivElement>(null);
+  // 与 chatHistory 同步，排队中的发送读取的是最新历史而不是旧闭包
+  const historyRef = useRef<ChatMessage[]>([]);
+  // 当前在途的请求；同一时刻只有一个
+  const inFlightRef = useRef<InFlight | null>(null);
+  // 发送串行化：每次发送排在上一次结束之后，序号用来跳过已被更新消息取代的发送
+  const sendChainRef = useRef<Promise<void>>(Promise.resolve());
+  const sendSeqRef = useRef(0);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
@@ -21,7 +72,16 @@ const Waifu = () => {
 
   useEffect(() => {
     scrollToBottom();
-  }, [chatHistory]);
+  }, [chatHistory, streamingText]);
+
+  // 离开页面时取消还在生成的回复：直接读 ref，而不是调用首次渲染闭包里的函数
+  useEffect(() => {
+    const inFlight = inFlightRef;
+    return () => {
+      abortInFlight(inFlight.current);
+      inFlight.current = null;
+    };
+  }, []);
 
   useEffect(() => {
     if ((window as any).isLive2DInitialized) return;
@@ -81,47 +141,148 @@ const Waifu = () => {
     initLive2D();
   }, []);
 
-// 修改 handleSend 函数，在发送请求时带上 chatHistory
-  const handleSend = async () => {
-    if (!inputMsg.trim()) return;
+  const appendMessage = (msg: ChatMessage) => {
+    historyRef.current = [...historyRef.current, msg];
+    setChatHistory(historyRef.current);
+  };
 
-    const userText = inputMsg;
-    // 先更新本地显示
-    const newHistory = [...chatHistory, { role: "user" as const, content: userText }];
-    setChatHistory(newHistory);
-    setInputMsg("");
+  // 中止在途请求 (用户发送新消息时)
+  const cancelInFlight = () => {
+    const current = inFlightRef.current;
+    inFlightRef.current = null;
+    abortInFlight(current);
+  };
+
+  // 读取一段 SSE 连接，直到收到 done (返回回复) 或连接中断 (返回 null，由调用方续传)
+  const readStream = async (
+    body: ReadableStream<Uint8Array>,
+    onEvent: (id: number, event: string, data: any) => void,
+  ): Promise<ChatReply | null> => {
+    const reader = body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) return null;
+      buffer += decoder.decode(value, { stream: true });
+      const blocks = buffer.split("\n\n");
+      buffer = blocks.pop() || "";
+      for (const block of blocks) {
+        const parsed = parseEvent(block);
+        if (!parsed) continue;
+        onEvent(parsed.id, parsed.event, parsed.data);
+        if (parsed.event === "done") return parsed.data;
+        if (parsed.event === "error") throw new Error(`stream ${parsed.data.detail}`);
+      }
+    }
+  };
+
+  // 请求 /chat/stream，逐段回调增量文本；连接意外断开时带 Last-Event-ID 从断点续传
+  const streamChat = async (
+    inFlight: InFlight,
+    message: string,
+    history: ChatMessage[],
+    onDelta: (text: string) => void,
+  ): Promise<ChatReply> => {
+    const { signal } = inFlight.controller;
+    let response: Response | null = await fetch(`${API_BASE}/chat/stream`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ message, history }),
+      signal,
+    });
+
+    let lastEventId = -1;
+    let attempts = 0;
+    while (true) {
+      if (response && (!response.ok || !response.body)) {
+        // 429 等快速拒绝时后端仍以角色口吻返回 text
+        const data = await response.json().catch(() => ({}));
+        if (data.text) return { text: data.text, emotion: data.emotion || "cry" };
+        throw new Error(`HTTP ${response.status}`);
+      }
+
+      if (response?.body) {
+        try {
+          const reply = await readStream(response.body, (id, event, data) => {
+            lastEventId = id;
+            if (event === "meta") inFlight.streamId = data.stream_id;
+            else if (event === "delta") onDelta(data.text);
+          });
+          if (reply) return reply;
+        } catch (error) {
+          // 主动取消或后端报错不续传，只有网络中断才续传
+          if (signal.aborted || !(error instanceof TypeError)) throw error;
+        }
+      }
+
+      if (!inFlight.streamId || ++attempts > MAX_RESUME_ATTEMPTS) {
+        throw new Error("stream lost");
+      }
+      await sleep(500 * attempts);
+      response = await fetch(`${API_BASE}/chat/stream/${inFlight.streamId}`, {
+        headers: { "Last-Event-ID": String(lastEventId) },
+        signal,
+      }).catch((error) => {
+        if (signal.aborted) throw error;
+        return null;
+      });
+    }
+  };
+
+  const sendMessage = async (userText: string, seq: number) => {
+    const inFlight: InFlight = { controller: new AbortController(), partial: "" };
+    inFlightRef.current = inFlight;
     setIsThinking(true);
 
+    // 只发最近 6 条记录 (含刚发出的这条)，避免 Token 爆炸，也足够让 AI 理解上下文
+    const contextHistory = historyRef.current.slice(-6);
+
     try {
-      // 关键修改：将 history 一并发送给后端
-      // 我们只发最近的 6 条记录，避免 Token 爆炸，也足够让 AI 理解上下文
-      const contextHistory = newHistory.slice(-6);
-
-      const response = await fetch("http://localhost:8000/chat", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-            message: userText,
-            history: contextHistory // 新增字段
-        }),
+      const reply = await streamChat(inFlight, userText, contextHistory, (text) => {
+        if (inFlight.controller.signal.aborted) return;
+        inFlight.partial += text;
+        setStreamingText(inFlight.partial);
       });
+      const aiText = reply.text || "呜呜...听不到你在说什么...";
 
-      const data = await response.json();
-      const aiText = data.text || "呜呜...听不到你在说什么...";
-      const emotion = data.emotion || "idle";
-
-      setChatHistory(prev => [...prev, { role: "ai", content: aiText }]);
+      appendMessage({ role: "ai", content: aiText });
       setBubbleText(aiText);
-      setIsThinking(false);
-      triggerMotion(emotion);
+      triggerMotion(reply.emotion || "idle");
 
     } catch (error) {
-      console.error("API Error:", error);
-      setBubbleText("后端连接失败了... ( > < )");
-      setIsThinking(false);
+      // 被新消息打断时半句话已经由 handleSend 记下，这里不再追加
+      if (!inFlight.controller.signal.aborted) {
+        console.error("API Error:", error);
+        setBubbleText("后端连接失败了... ( > < )");
+      }
+    } finally {
+      if (inFlightRef.current === inFlight) inFlightRef.current = null;
+      setStreamingText("");
+      if (seq === sendSeqRef.current) setIsThinking(false);
     }
   };
 
+  const handleSend = () => {
+    const userText = inputMsg.trim();
+    if (!userText) return;
+
+    // 新消息打断正在生成的旧回复：先同步记下已经说出口的半句话，再追加新消息，
+    // 保证记录 (以及下一次请求的 history) 是 "旧提问 → 半句回复 → 新提问" 的顺序
+    const interrupted = inFlightRef.current;
+    cancelInFlight();
+    historyRef.current = appendUserTurn(historyRef.current, interrupted?.partial || "", userText);
+    setChatHistory(historyRef.current);
+    setInputMsg("");
+
+    // 新消息排在旧请求结束之后发送：同一时刻只有一个请求，回复按顺序到达。
+    // 连续快速发送时，排队期间又被更新消息取代的发送直接跳过 (它已经包含在后者的 history 里)
+    const seq = ++sendSeqRef.current;
+    sendChainRef.current = sendChainRef.current.then(() =>
+      seq === sendSeqRef.current ? sendMessage(userText, seq) : undefined
+    );
+  };
+
   const triggerMotion = (emotion: string) => {
     if (!model) return;
     try {
@@ -148,7 +309,7 @@ const Waifu = () => {
         <div className="absolute top-1/4 right-10 bg-white p-5 rounded-3xl shadow-lg border-2 border-pink-200 max-w-[240px] animate-bounce-slow z-10">
             <p className="text-pink-600 font-bold text-sm mb-1">丸山彩</p>
             <p className="text-gray-700 text-sm leading-relaxed">
-              {isThinking ? "正在检索记忆..." : bubbleText}
+              {isThinking ? streamingText || "正在检索记忆..." : bubbleText}
             </p>
              <div className="absolute bottom-0 -left-2 w-4 h-4 bg-white border-b-2 border-l-2 border-pink-200 transform rotate-45"></div>
         </div>
@@ -195,6 +356,13 @@ const Waifu = () => {
                 </div>
               </div>
             ))}
+            {streamingText && (
+              <div className="flex justify-start">
+                <div className="max-w-[80%] px-6 py-4 rounded-3xl text-lg shadow-sm leading-relaxed bg-white text-gray-800 border border-gray-100 rounded-tl-none shadow-gray-100">
+                  {streamingText}
+                </div>
+              </div>
+            )}
             <div ref={messagesEndRef} />
           </div>
 
@@ -208,13 +376,12 @@ const Waifu = () => {
                 onKeyDown={(e) => e.key === "Enter" && handleSend()}
                 placeholder="发送消息..."
                 className="flex-1 px-6 py-4 rounded-full border-2 border-pink-100 focus:border-pink-400 focus:outline-none bg-pink-50/50 text-lg transition-all focus:shadow-inner"
-                disabled={isThinking}
               />
               <button
                 onClick={handleSend}
-                disabled={isThinking}
+                disabled={!inputMsg.trim()}
                 className={`px-8 py-4 rounded-full font-bold text-white text-lg shadow-lg transition-all active:scale-95 hover:shadow-xl ${
-                  isThinking ? "bg-gray-300 cursor-not-allowed" : "bg-gradient-to-r from-pink-400 to-pink-500 hover:from-pink-500 hover:to-pink-600"
+                  !inputMsg.trim() ? "bg-gray-300 cursor-not-allowed" : "bg-gradient-to-r from-pink-400 to-pink-500 hover:from-pink-500 hover:to-pink-600"
                 }`}
               >
                 发送
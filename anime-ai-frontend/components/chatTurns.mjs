@@ -0,0 +1,16 @@
+// 聊天记录的轮次顺序 (纯函数，可以直接用 node --test 测试)
+
+/**
+ * 用户发送新消息时的聊天记录：被打断的回复先以半句话落入记录，再追加新的用户消息。
+ * 这样界面和下一次请求的 history 里都是 "旧提问 → 半句回复 → 新提问"，
+ * 后端看到的 history 最后一条也始终是当前这条用户消息。
+ *
+ * @param {{role: string, content: string}[]} history 当前聊天记录
+ * @param {string} interruptedPartial 被打断的回复已经输出的部分 (没有则为空字符串)
+ * @param {string} userText 新的用户消息
+ */
+export const appendUserTurn = (history, interruptedPartial, userText) => [
+  ...history,
+  ...(interruptedPartial ? [{ role: "ai", content: `${interruptedPartial}……` }] : []),
+  { role: "user", content: userText },
+];
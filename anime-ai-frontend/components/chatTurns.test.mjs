@@ -0,0 +1,23 @@
+// node --test (npm test)
+import test from "node:test";
+import assert from "node:assert/strict";
+
+import { appendUserTurn } from "./chatTurns.mjs";
+
+test("打断生成中的回复再发送：半句回复排在新提问之前", () => {
+  let history = appendUserTurn([], "", "千圣的狗叫什么名字");
+  // 回复输出到一半时用户又发了一条
+  history = appendUserTurn(history, "千圣家的狗叫", "那它是什么品种");
+  assert.deepEqual(history, [
+    { role: "user", content: "千圣的狗叫什么名字" },
+    { role: "ai", content: "千圣家的狗叫……" },
+    { role: "user", content: "那它是什么品种" },
+  ]);
+  // 下一次请求带的 history (最近 6 条) 以当前提问结尾
+  assert.deepEqual(history.slice(-6).at(-1), { role: "user", content: "那它是什么品种" });
+});
+
+test("还没输出任何内容就被打断：不留空回复", () => {
+  const history = appendUserTurn([{ role: "user", content: "你好" }], "", "在吗");
+  assert.deepEqual(history.map((m) => m.role), ["user", "user"]);
+});
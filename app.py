@@ -5,6 +5,12 @@ from openai import OpenAI
 from langchain_community.vectorstores import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "anime-ai-backend"))
+from story_index import (
+    load_index_map, parse_router_output, build_keyword_index, parse_glossary_aliases,
+    index_character_names, query_characters, scoped_search, self_alias_names
+)
+
 # --- 1. 页面基础配置 ---
 st.set_page_config(page_title="Pastel Chat", page_icon="🌸", layout="centered")
 st.title("🌸 丸山彩 AI Chatbot 🌸")
@@ -57,23 +63,29 @@ def load_resources():
     index_map_path = os.path.join("anime-ai-backend", "chroma_db", "index_map.txt")
     glossary_path = os.path.join("data_source", "00_glossary.txt")
 
-    story_index = ""
     world_view = ""
 
-    if os.path.exists(index_map_path):
-        with open(index_map_path, 'r', encoding='utf-8') as f:
-            story_index = f.read()
+    story_index, file_index = load_index_map(index_map_path)
+
+    # 旧库只有 source 字段，新库带规范的 file_id
+    sample = vectordb._collection.get(limit=1, include=["metadatas"])["metadatas"]
+    legacy_metadata = bool(sample) and "file_id" not in (sample[0] or {})
 
     if os.path.exists(glossary_path):
         with open(glossary_path, 'r', encoding='utf-8') as f:
             world_view = f.read()
 
     status_text.empty()  # 清除加载提示
-    return vectordb, story_index, world_view
+    return vectordb, story_index, file_index, legacy_metadata, world_view
 
 
 # 执行加载
-vectordb, STORY_INDEX_CONTEXT, WORLD_VIEW_CONTEXT = load_resources()
+vectordb, STORY_INDEX_CONTEXT, STORY_FILE_INDEX, LEGACY_METADATA, WORLD_VIEW_CONTEXT = load_resources()
+
+# 检索时按问题里提到的人物缩小范围，彩自己的称呼不算
+ALIASES = parse_glossary_aliases(WORLD_VIEW_CONTEXT)
+CHARACTER_NAMES = index_character_names(build_keyword_index(STORY_INDEX_CONTEXT, STORY_FILE_INDEX))
+SELF_NAMES = self_alias_names(ALIASES, "丸山彩")
 
 
 # --- 4. 核心逻辑函数 ---
@@ -104,9 +116,9 @@ def rewrite_query(user_msg):
 
 
 def detect_story_scope(search_query):
-    """DeepSeek 路由判断"""
+    """DeepSeek 路由判断，返回 index_map 中存在的规范文件 ID 列表"""
     if not STORY_INDEX_CONTEXT:
-        return "NONE"
+        return []
 
     prompt = f"""
     你是一个《BanG Dream!》剧情导航员。从下方索引中找出相关文件名。
@@ -124,9 +136,9 @@ def detect_story_scope(search_query):
             messages=[{"role": "user", "content": prompt}],
             temperature=0.0
         )
-        return response.choices[0].message.content.strip()
+        return parse_router_output(response.choices[0].message.content.strip(), STORY_FILE_INDEX)
     except:
-        return "NONE"
+        return []
 
 
 # --- 5. 聊天界面逻辑 (注意：这里必须顶格写，不能有缩进) ---
@@ -158,33 +170,23 @@ if prompt := st.chat_input("和彩彩聊聊吧..."):
         # 1. 重写
         search_query = rewrite_query(prompt)
         # 2. 路由
-        target_files_str = detect_story_scope(search_query)
+        raw_files = detect_story_scope(search_query)
 
         context_text = ""
         retrieved_flag = False  # 标记是否成功检索到资料
 
-        # 3. 检索 (修复版路径匹配)
-        if target_files_str != "NONE" and "txt" in target_files_str:
-            raw_files = [f.strip() for f in target_files_str.split(",") if "txt" in f]
-
-            # 构建“全方位拦截”的路径列表
-            target_sources = []
-            for fname in raw_files:
-                target_sources.append(fname)
-                target_sources.append(f"data_source/{fname}")
-                target_sources.append(f"data_source\\{fname}")
-
+        # 3. 检索 (按规范文件 ID 精确过滤)
+        if raw_files:
             # 调试信息
             with st.sidebar:
                 st.write("🔍 **Debug 路由信息**")
                 st.write(f"路由锁定: {raw_files}")
 
             try:
-                docs = vectordb.similarity_search(
-                    search_query,
-                    k=20,
-                    filter={"source": {"$in": target_sources}}
+                people = [] if LEGACY_METADATA else query_characters(
+                    search_query, ALIASES, CHARACTER_NAMES, exclude=SELF_NAMES
                 )
+                docs = scoped_search(vectordb, search_query, 20, raw_files, people, legacy=LEGACY_METADATA)
 
                 if docs:
                     context_text = "\n\n".join([d.page_content for d in docs])